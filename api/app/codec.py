@@ -0,0 +1,45 @@
+"""
+Decoding of structured values stored in Redis by Poseidon
+(see poseidon/helpers/codec.py, which also encodes them).
+"""
+import ast
+import json
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+def _msgpack_loads(raw):
+    if msgpack is None:  # pragma: no cover
+        raise ValueError('msgpack encoded value, but msgpack is not installed')
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+TAGGED_LOADS = {
+    b'j1:': json.loads,
+    b'm1:': _msgpack_loads,
+}
+TAG_LEN = 3
+
+
+def is_tagged(raw):
+    if isinstance(raw, str):
+        raw = raw[:TAG_LEN].encode('ascii', 'replace')
+    return raw[:TAG_LEN] in TAGGED_LOADS
+
+
+def decode_value(raw):
+    ''' decode a tagged value, or a legacy Python repr. '''
+    if raw is None:
+        return None
+    tag = raw[:TAG_LEN]
+    if isinstance(tag, str):
+        tag = tag.encode('ascii', 'replace')
+    loads = TAGGED_LOADS.get(tag, None)
+    if loads is not None:
+        return loads(raw[TAG_LEN:])
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')
+    return ast.literal_eval(raw)
@@ -1,4 +1,3 @@
-import ast
 import ipaddress
 import json
 import os
@@ -9,6 +8,8 @@ import falcon
 import redis
 from natural.date import duration
 
+from .codec import decode_value
+from .codec import is_tagged
 from .constants import NO_DATA
 from .routes import paths
 from .routes import version
@@ -49,20 +50,33 @@ class Nodes:
     def connect_redis(self):
         self.r = None
         try:
+            # responses are decoded by hgetall()/smembers(), as encoded
+            # values may be binary.
             self.r = redis.StrictRedis(host=os.getenv('REDIS_HOST', 'redis'),
                                        port=6379,
-                                       db=0,
-                                       decode_responses=True)
+                                       db=0)
         except Exception as e:  # pragma: no cover
             return (False, 'unable to connect to redis because: ' + str(e))
         return (True, 'connected')
 
+    def hgetall(self, key):
+        ''' get a hash, with text fields and values (except binary encoded values). '''
+        values = {}
+        for field, value in self.r.hgetall(key).items():
+            if not is_tagged(value):
+                value = value.decode('utf-8')
+            values[field.decode('utf-8')] = value
+        return values
+
+    def smembers(self, key):
+        return {member.decode('utf-8') for member in self.r.smembers(key)}
+
     def build_nodes(self):
         status = self.connect_redis()
         if status[0] and self.r:
             mac_addresses = []
             try:
-                mac_addresses = self.r.smembers('mac_addresses')
+                mac_addresses = self.smembers('mac_addresses')
             except Exception as e:  # pragma: no cover
                 print(
                     'Unable to retrieve any endpoints because: {0}'.format(str(e)))
@@ -76,7 +90,7 @@ class Nodes:
                 # grab from mac info
                 mac_info = {}
                 try:
-                    mac_info = self.r.hgetall(mac)
+                    mac_info = self.hgetall(mac)
                 except Exception as e:  # pragma: no cover
                     print(
                         'Unable to retrieve endpoint metadata because: {0}'.format(str(e)))
@@ -87,18 +101,21 @@ class Nodes:
                     if 'id' in node:
                         node['id'] = mac_info['poseidon_hash']
                     try:
-                        poseidon_info = self.r.hgetall(
+                        poseidon_info = self.hgetall(
                             mac_info['poseidon_hash'])
 
                         for key in node:
                             if key in poseidon_info:
-                                node[key] = poseidon_info[key]
+                                value = poseidon_info[key]
+                                if is_tagged(value):
+                                    value = str(decode_value(value))
+                                node[key] = value
 
                         if 'ignored' in node and 'ignore' in poseidon_info:
                             node['ignored'] = poseidon_info['ignore']
 
                         if 'prev_states' in poseidon_info:
-                            prev_states = ast.literal_eval(
+                            prev_states = decode_value(
                                 poseidon_info['prev_states'])
                             if 'first_seen' in node:
                                 node['first_seen'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(
@@ -108,7 +125,7 @@ class Nodes:
                                     prev_states[-1][1])) + ' (' + duration(prev_states[-1][1]) + ')'
 
                         if 'endpoint_data' in poseidon_info:
-                            endpoint_data = ast.literal_eval(
+                            endpoint_data = decode_value(
                                 poseidon_info['endpoint_data'])
                             for key in node:
                                 if key in endpoint_data:
@@ -127,7 +144,7 @@ class Nodes:
                                     if subnet_key in node:
                                         subnet = ipaddress.ip_network(ipv).supernet(new_prefix=prefix)
                                         node[subnet_key] = str(subnet)
-                                    ip_info = self.r.hgetall('_'.join(('p0f', ipv)))
+                                    ip_info = self.hgetall('_'.join(('p0f', ipv)))
                                     if ip_info and 'short_os' in ip_info:
                                         node['%s_os' % ip_field] = ip_info['short_os']
                     except Exception as e:  # pragma: no cover
@@ -137,12 +154,12 @@ class Nodes:
                 if 'role' in node:
                     if 'timestamps' in mac_info:
                         try:
-                            timestamps = ast.literal_eval(
+                            timestamps = decode_value(
                                 mac_info['timestamps'])
-                            ml_info = self.r.hgetall(
+                            ml_info = self.hgetall(
                                 '_'.join(('networkml', mac, str(timestamps[-1]))))
                             for _poseidon_hash, raw_results in ml_info.items():
-                                results = ast.literal_eval(raw_results)
+                                results = decode_value(raw_results)
                                 classification = results.get('classification', {})
                                 labels = classification.get('labels', None)
                                 confidences = classification.get('confidences', None)
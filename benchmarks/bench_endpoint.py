@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare memory use and throughput of Endpoint against the previous model,
+which built two transitions.Machine instances per endpoint.
+
+Usage: python benchmarks/bench_endpoint.py [--count 100000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+from transitions import Machine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from poseidon.helpers.endpoint import Endpoint  # noqa: E402
+from poseidon.helpers.endpoint import endpoint_factory  # noqa: E402
+
+
+class LegacyEndpoint:
+
+    def __init__(self, hashed_val):
+        self.name = hashed_val.strip()
+        self.ignore = False
+        self.copro_ignores = False
+        self.endpoint_data = None
+        self.p_next_state = None
+        self.p_prev_states = []
+        self.p_next_copro_state = None
+        self.p_prev_copross_states = []
+        self.acl_data = []
+        self.metadata = {}
+        self.history = []
+        self.state = None
+        self.copro_state = None
+
+    _add_history_entry = Endpoint._add_history_entry
+    update_state_history = Endpoint.update_state_history
+    update_copro_history = Endpoint.update_copro_history
+
+
+def legacy_endpoint_factory(hashed_val):
+    endpoint = LegacyEndpoint(hashed_val)
+    machine = Machine(
+        model=endpoint,
+        states=Endpoint.states,
+        transitions=Endpoint.transitions,
+        initial='unknown',
+        send_event=True)
+    machine.name = endpoint.name[:8]+' '
+    endpoint.machine = machine
+    copro_endpoint = LegacyEndpoint(hashed_val)
+    copro_machine = Machine(
+        model=copro_endpoint,
+        states=Endpoint.copro_states,
+        transitions=Endpoint.copro_transitions,
+        initial='copro_unknown',
+        send_event=True)
+    copro_machine.name = endpoint.name[:8]+'_copro'
+    endpoint.copro_machine = copro_machine
+    return endpoint
+
+
+def make_endpoints(factory, count):
+    endpoints = []
+    for i in range(count):
+        endpoint = factory('%040x' % i)
+        endpoint.endpoint_data = {
+            'tenant': 'VLAN100', 'mac': '00:00:00:%02x:%02x:%02x' % (
+                (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff),
+            'segment': 'switch1', 'port': str(i % 48), 'active': 1}
+        endpoints.append(endpoint)
+    return endpoints
+
+
+def run_triggers(endpoints):
+    for endpoint in endpoints:
+        endpoint.mirror()
+        endpoint.known()
+        endpoint.trigger('inactive')
+
+
+def bench(label, factory, count):
+    tracemalloc.start()
+    endpoints = make_endpoints(factory, count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del endpoints
+
+    start = time.perf_counter()
+    endpoints = make_endpoints(factory, count)
+    create_time = time.perf_counter() - start
+    start = time.perf_counter()
+    run_triggers(endpoints)
+    trigger_time = time.perf_counter() - start
+    print('{0:8} {1:10.1f} {2:10.0f} {3:10.2f} {4:12.0f}'.format(
+        label, current / 1024 / 1024, current / count, create_time,
+        count * 3 / trigger_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+    print('{0:8} {1:>10} {2:>10} {3:>10} {4:>12}'.format(
+        'model', 'MiB', 'bytes/ep', 'create s', 'triggers/s'))
+    bench('legacy', legacy_endpoint_factory, args.count)
+    bench('compact', endpoint_factory, args.count)
+
+
+if __name__ == '__main__':
+    main()
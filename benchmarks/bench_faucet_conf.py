@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure mirror/unmirror throughput against a large local FAUCET config,
+with and without the parsed config cache in FaucetLocalConfGetSetter.
+
+Each mirror or unmirror reads the config several times (to find the switch,
+its mirror port and the ports already mirrored) and writes it once.
+
+Usage: python benchmarks/bench_faucet_conf.py [--dps 300] [--ports 16] [--count 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from poseidon.controllers.faucet.config import FaucetLocalConfGetSetter  # noqa: E402
+from poseidon.controllers.faucet.parser import Parser  # noqa: E402
+
+
+class UncachedConfGetSetter(FaucetLocalConfGetSetter):
+
+    @staticmethod
+    def _conf_stat(config_file):
+        return None
+
+
+def make_config(dps, ports):
+    faucet_conf = {'vlans': {'office': {'vid': 100}}, 'dps': {}}
+    for dp in range(dps):
+        interfaces = {port: {'native_vlan': 'office'} for port in range(1, ports)}
+        interfaces[ports] = {'output_only': True}
+        faucet_conf['dps']['sw{0}'.format(dp)] = {
+            'dp_id': dp + 1, 'hardware': 'Open vSwitch', 'interfaces': interfaces}
+    return faucet_conf
+
+
+def bench(label, getsetter_cl, args, faucet_conf, tmpdir):
+    config_file = os.path.join(tmpdir, '{0}.yaml'.format(label))
+    with open(config_file, 'w') as f:
+        yaml.dump(faucet_conf, f)
+    mirror_ports = {dp: args.ports for dp in faucet_conf['dps']}
+    parser = Parser(mirror_ports=mirror_ports)
+    parser.faucetconfgetsetter = getsetter_cl()
+    parser.faucetconfgetsetter.DEFAULT_CONFIG_FILE = config_file
+    switches = list(mirror_ports)
+    start = time.perf_counter()
+    for i in range(args.count):
+        switch = switches[i % len(switches)]
+        port = (i % (args.ports - 1)) + 1
+        parser.config_mirror('mirror', switch, port)
+        parser.config_mirror('unmirror', switch, port)
+    elapsed = time.perf_counter() - start
+    print('{0:10} {1:10.1f} {2:10.1f}'.format(
+        label, args.count * 2 / elapsed, elapsed / (args.count * 2) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dps', type=int, default=300)
+    parser.add_argument('--ports', type=int, default=16)
+    parser.add_argument('--count', type=int, default=5)
+    args = parser.parse_args()
+    faucet_conf = make_config(args.dps, args.ports)
+    print('{0:10} {1:>10} {2:>10}'.format('config', 'ops/s', 'ms/op'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bench('uncached', UncachedConfGetSetter, args, faucet_conf, tmpdir)
+        bench('cached', FaucetLocalConfGetSetter, args, faucet_conf, tmpdir)
+
+
+if __name__ == '__main__':
+    main()
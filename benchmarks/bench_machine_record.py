@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare copying machines into endpoint_data with deepcopy against sharing
+immutable MachineRecords, as find_new_machines does for new and changed
+endpoints.
+
+Usage: python benchmarks/bench_machine_record.py [--count 100000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from poseidon.helpers.endpoint import MachineRecord  # noqa: E402
+
+
+def make_machines(count):
+    return [{
+        'mac': '00:00:00:%02x:%02x:%02x' % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff),
+        'segment': 'switch1', 'port': str(i % 48), 'vlan': 'VLAN100',
+        'tenant': 'VLAN100', 'active': 1, 'ipv4': '10.0.%u.%u' % ((i >> 8) & 0xff, i & 0xff),
+        'ipv4_subnet': '10.0.%u.0/24' % ((i >> 8) & 0xff), 'ipv4_rdns': 'NO DATA',
+        'ipv6': 0, 'ipv6_subnet': 'NO DATA', 'ipv6_rdns': 'NO DATA',
+        'ether_vendor': 'HP', 'controller_type': 'faucet', 'controller': '',
+        'name': None} for i in range(count)]
+
+
+def copy_deepcopy(machines):
+    # endpoint_data, plus the copy persistence keeps to detect changes.
+    endpoint_data = [deepcopy(machine) for machine in machines]
+    persisted = [dict(data) for data in endpoint_data]
+    return (endpoint_data, persisted)
+
+
+def copy_record(machines):
+    endpoint_data = [MachineRecord(machine) for machine in machines]
+    persisted = endpoint_data
+    return (endpoint_data, persisted)
+
+
+def bench(label, copy_func, machines):
+    tracemalloc.start()
+    result = copy_func(machines)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    start = time.perf_counter()
+    copy_func(machines)
+    elapsed = time.perf_counter() - start
+    print('{0:10} {1:10.1f} {2:10.0f} {3:10.3f}'.format(
+        label, current / 1024 / 1024, current / len(machines), elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+    machines = make_machines(args.count)
+    print('{0:10} {1:>10} {2:>10} {3:>10}'.format(
+        'copy', 'MiB', 'bytes/ep', 'seconds'))
+    bench('deepcopy', copy_deepcopy, machines)
+    bench('record', copy_record, machines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare publishing actions over a new RabbitMQ connection per action, as
+SDNConnect.publish_action used to, against the long lived RabbitPublisher.
+
+No broker is needed: a local stand-in for pika.BlockingConnection charges
+a fixed latency for the connection handshake and for each broker round
+trip (exchange declare, tx select, tx commit). A publish on its own is
+only a write to the socket.
+
+Usage: python benchmarks/bench_publisher.py [--count 2000] [--handshake-ms 5] [--rtt-ms 0.2]
+"""
+import argparse
+import os
+import sys
+import time
+
+import pika
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from poseidon.helpers.rabbit import RabbitPublisher  # noqa: E402
+
+
+class StandInChannel:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+
+    def exchange_declare(self, exchange, exchange_type):
+        self.connection.round_trip()
+
+    def tx_select(self):
+        self.connection.round_trip()
+
+    def tx_commit(self):
+        self.connection.round_trip()
+
+    def basic_publish(self, exchange, routing_key, body):
+        StandInConnection.published += 1
+
+
+class StandInConnection:
+
+    handshake = 0.005
+    rtt = 0.0002
+    connections = 0
+    published = 0
+
+    def __init__(self, parameters):
+        StandInConnection.connections += 1
+        self.is_open = True
+        time.sleep(self.handshake)
+
+    def round_trip(self):
+        time.sleep(self.rtt)
+
+    def channel(self):
+        self.round_trip()
+        return StandInChannel(self)
+
+    def close(self):
+        self.round_trip()
+        self.is_open = False
+
+
+def publish_per_connection(messages):
+    for routing_key, body in messages:
+        connection = StandInConnection(pika.ConnectionParameters(host='localhost'))
+        channel = connection.channel()
+        channel.exchange_declare(
+            exchange='topic-poseidon-internal', exchange_type='topic')
+        channel.basic_publish(
+            exchange='topic-poseidon-internal', routing_key=routing_key, body=body)
+        connection.close()
+
+
+def publish_pooled(messages):
+    publisher = RabbitPublisher('localhost', connection_cl=StandInConnection)
+    for routing_key, body in messages:
+        publisher.publish(routing_key, body)
+    publisher.close()
+
+
+def publish_batched(messages):
+    publisher = RabbitPublisher('localhost', connection_cl=StandInConnection)
+    publisher.publish_batch(messages)
+    publisher.close()
+
+
+def bench(label, publish_func, messages):
+    StandInConnection.connections = 0
+    start = time.perf_counter()
+    publish_func(messages)
+    elapsed = time.perf_counter() - start
+    print('{0:16} {1:12.0f} {2:12}'.format(
+        label, len(messages) / elapsed, StandInConnection.connections))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--handshake-ms', type=float, default=5)
+    parser.add_argument('--rtt-ms', type=float, default=0.2)
+    args = parser.parse_args()
+    StandInConnection.handshake = args.handshake_ms / 1000
+    StandInConnection.rtt = args.rtt_ms / 1000
+    messages = [('poseidon.action.change', '[["%040x", "known"]]' % i)
+                for i in range(args.count)]
+    print('{0:16} {1:>12} {2:>12}'.format('publisher', 'actions/s', 'connections'))
+    bench('per connection', publish_per_connection, messages)
+    bench('pooled', publish_pooled, messages)
+    bench('pooled batch', publish_batched, messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Run the threaded and asyncio runtimes of the main service on the same
+workload, and compare how long RabbitMQ messages wait to be handled.
+
+No services are needed: stand-ins charge a fixed latency for each external
+call. Every scan checks FAUCET (--check-ms) and stores endpoints in Redis
+(--store-ms), while action messages arrive at --rate per second and each
+take --handle-ms to handle.
+
+Usage: python benchmarks/bench_runtime.py [--seconds 5] [--scan-interval 0.5]
+           [--rate 200] [--check-ms 20] [--store-ms 10] [--handle-ms 0.5]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from poseidon.async_main import AsyncMonitor  # noqa: E402
+from poseidon.controllers.faucet.parser import FaucetEventBuffer  # noqa: E402
+from poseidon.helpers.dispatch import AsyncDispatcher  # noqa: E402
+from poseidon.helpers.dispatch import Dispatcher  # noqa: E402
+from poseidon.main import CTRL_C  # noqa: E402
+from poseidon.main import Monitor  # noqa: E402
+
+
+class StandInSchedule:
+
+    def __init__(self, interval, job):
+        self.interval = interval
+        self.job = job
+        self.next_run = time.time() + interval
+        self.runs = 0
+
+    def run_pending(self):
+        if time.time() >= self.next_run:
+            self.next_run += self.interval
+            self.runs += 1
+            self.job()
+
+    def idle_seconds(self):
+        return self.next_run - time.time()
+
+
+class StandInSDNConnect:
+
+    def __init__(self, args):
+        self.args = args
+
+    def check_endpoints(self):
+        time.sleep(self.args.check_ms / 1000)
+
+    def refresh_endpoints(self):
+        time.sleep(self.args.store_ms / 1000)
+
+
+class StandInMonitor(Monitor):
+
+    def __init__(self, args, dispatcher_cl):
+        self.args = args
+        self.logger = logging.getLogger('bench')
+        self.s = StandInSDNConnect(args)
+        self.faucet_event = FaucetEventBuffer()
+        self.dispatcher = dispatcher_cl()
+        self.job_queue = self.dispatcher.queue('jobs')
+        self.m_queue = self.dispatcher.queue('rabbit')
+        self.schedule = StandInSchedule(
+            args.scan_interval, self.schedule_job_kickurl)
+
+    def job_kickurl(self):
+        self.s.check_endpoints()
+
+    def format_rabbit_message(self, item):
+        time.sleep(self.args.handle_ms / 1000)
+        return ({}, True)
+
+    def schedule_mirroring(self):
+        return
+
+
+class ThreadedMonitor(StandInMonitor):
+
+    def __init__(self, args):
+        super().__init__(args, Dispatcher)
+
+
+class StandInAsyncMonitor(AsyncMonitor, StandInMonitor):
+
+    def __init__(self, args):
+        StandInMonitor.__init__(self, args, AsyncDispatcher)
+        self.state_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def produce(args, put, stop):
+    ''' put action messages at a fixed rate, then stop the monitor. '''
+    start = time.time()
+    sent = 0
+    while time.time() - start < args.seconds:
+        put(('poseidon.action.ignore', '[]'))
+        sent += 1
+        time.sleep(max(start + sent / args.rate - time.time(), 0))
+    stop()
+
+
+def run_threaded(args):
+    monitor = ThreadedMonitor(args)
+
+    def stop():
+        CTRL_C['STOP'] = True
+        monitor.dispatcher.notify()
+
+    producer = threading.Thread(
+        target=produce, args=(args, monitor.m_queue.put, stop))
+    producer.start()
+    monitor.process()
+    producer.join()
+    return monitor
+
+
+def run_async(args):
+    monitor = StandInAsyncMonitor(args)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        # messages are delivered on the event loop, as by the AMQP adapter.
+        producer = threading.Thread(target=produce, args=(
+            args,
+            lambda item: loop.call_soon_threadsafe(monitor.m_queue.put, item),
+            lambda: loop.call_soon_threadsafe(monitor.stop)))
+        producer.start()
+        await monitor.process_async()
+        producer.join()
+
+    asyncio.run(run())
+    return monitor
+
+
+def bench(label, run_func, args):
+    CTRL_C['STOP'] = False
+    monitor = run_func(args)
+    CTRL_C['STOP'] = False
+    latencies = sorted(monitor.dispatcher.pop_latencies().get('rabbit', []))
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+    print('{0:10} {1:>8} {2:>10} {3:>10.1f} {4:>10.1f} {5:>10.1f}'.format(
+        label, monitor.schedule.runs, len(latencies),
+        percentile(0.5), percentile(0.95), latencies[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--scan-interval', type=float, default=0.5)
+    parser.add_argument('--rate', type=float, default=200)
+    parser.add_argument('--check-ms', type=float, default=20)
+    parser.add_argument('--store-ms', type=float, default=10)
+    parser.add_argument('--handle-ms', type=float, default=0.5)
+    args = parser.parse_args()
+    logging.getLogger('bench').setLevel(logging.WARNING)
+    print('{0:10} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        'runtime', 'scans', 'messages', 'p50 ms', 'p95 ms', 'max ms'))
+    bench('threaded', run_threaded, args)
+    bench('asyncio', run_async, args)
+
+
+if __name__ == '__main__':
+    main()
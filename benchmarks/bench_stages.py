@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure what timing a main loop stage costs per call, with the stage timer
+disabled and enabled, against an untimed function.
+
+Usage: python benchmarks/bench_stages.py [--count 1000000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from poseidon.helpers.stages import StageTimer  # noqa: E402
+from poseidon.helpers.stages import timed  # noqa: E402
+
+
+def stage():
+    return None
+
+
+def bench(label, call, count, timer=None):
+    start = time.perf_counter()
+    for _ in range(count):
+        call()
+    elapsed = time.perf_counter() - start
+    if timer is not None:
+        timer.pop()
+    print('{0:24} {1:10.0f}'.format(label, elapsed / count * 1e9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=1000000)
+    args = parser.parse_args()
+    print('{0:24} {1:>10}'.format('stage', 'ns/call'))
+    bench('untimed', stage, args.count)
+    for enabled in (False, True):
+        timer = StageTimer(enabled=enabled)
+        state = 'enabled' if enabled else 'disabled'
+        bench('decorator ' + state, timed('bench', timer=timer)(stage),
+              args.count, timer=timer)
+
+        def context_manager(timer=timer):
+            with timer.stage('bench', 'routing.key'):
+                stage()
+
+        bench('context manager ' + state, context_manager, args.count, timer=timer)
+
+
+if __name__ == '__main__':
+    main()
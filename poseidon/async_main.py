@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio runtime for the Poseidon main service, used when runtime = asyncio.
+
+One event loop runs the RabbitMQ connection (with pika's asyncio adapter),
+the timers and the dispatcher. The blocking calls Poseidon makes (Redis,
+faucetconfrpc and network_tap) run off the loop, so it keeps consuming and
+sending acks and heartbeats while they are in flight:
+
+- handling messages and jobs changes endpoint state, so it runs on the
+  single state_executor thread, one batch at a time as in the threaded
+  runtime. Its Redis, FAUCET and network_tap calls are serialized there,
+  not run concurrently.
+- reverse DNS lookups don't hold up scans; names are filled in on a later
+  scan once the lookup finishes.
+"""
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import poseidon.main
+from poseidon.helpers.dispatch import AsyncDispatcher
+from poseidon.helpers.rabbit import AsyncRabbitConsumer
+from poseidon.main import logger
+from poseidon.main import Monitor
+
+
+class AsyncMonitor(Monitor):
+
+    dispatcher_cl = AsyncDispatcher
+
+    def __init__(self, skip_rabbit, controller=None):
+        super().__init__(skip_rabbit, controller=controller)
+        self.s.dns_resolver.blocking = False
+        self.state_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='poseidon_state')
+
+    def stop(self):
+        ''' stop processing, e.g. on CTRL_C. '''
+        poseidon.main.CTRL_C['STOP'] = True
+        self.dispatcher.notify()
+
+    async def process_async(self):
+        '''
+        handle work as it arrives, as process() does, without blocking the
+        event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        while not poseidon.main.CTRL_C['STOP']:
+            self.schedule.run_pending()
+            await loop.run_in_executor(self.state_executor, self.process_ready)
+            if not poseidon.main.CTRL_C['STOP']:
+                await self.dispatcher.wait(self.idle_seconds())
+
+        await loop.run_in_executor(self.state_executor, self.s.refresh_endpoints)
+
+    async def run(self):
+        ''' consume from RabbitMQ and process until stopped. '''
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.stop)
+        except (NotImplementedError, RuntimeError) as e:  # pragma: no cover
+            self.logger.debug(
+                'Unable to handle CTRL_C in the event loop: {0}'.format(str(e)))
+        self.rabbit_consumer = self.make_rabbit_consumer(
+            consumer_cl=AsyncRabbitConsumer)
+        consumer_task = self.rabbit_consumer.start()
+        try:
+            await self.process_async()
+        finally:
+            self.rabbit_consumer.stop()
+            try:
+                await asyncio.wait_for(consumer_task, 5)
+            except (asyncio.TimeoutError, Exception) as e:  # pragma: no cover
+                self.logger.debug(
+                    'RabbitMQ consumer did not stop cleanly: {0}'.format(str(e)))
+            self.state_executor.shutdown(wait=False)
+
+
+def async_main(skip_rabbit=False):  # pragma: no cover
+    pmain = AsyncMonitor(skip_rabbit=skip_rabbit)
+    try:
+        asyncio.run(pmain.run())
+    except Exception as e:
+        logger.error('process() exception: {0}'.format(str(e)))
+
+    pmain.shutdown()
@@ -49,14 +49,10 @@ class Commands:
         return endpoints.values()
 
     def _inactive_endpoints(self):
-        return [
-            endpoint for endpoint in self.sdnc.endpoints.values()
-            if endpoint.state == 'inactive']
+        return self.sdnc.endpoints.by_state('inactive')
 
     def _ignored_endpoints(self):
-        return [
-            endpoint for endpoint in self.sdnc.endpoints.values()
-            if endpoint.ignore]
+        return self.sdnc.endpoints.ignored()
 
     def what_is(self, args):
         ''' what is a specific thing '''
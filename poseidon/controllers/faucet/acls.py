@@ -7,6 +7,7 @@ Created on 4 March 2020
 import logging
 import os
 from poseidon.controllers.faucet.config import FaucetLocalConfGetSetter, FaucetRemoteConfGetSetter
+from poseidon.helpers.stages import timed
 
 
 class ACLs:
@@ -155,6 +156,7 @@ class ACLs:
                         endpoint.endpoint_data['mac'], switch, port, orig_rule_acls))
         return obj_doc, all_rule_acls
 
+    @timed('apply_acls')
     def apply_acls(self, rules_file, endpoints, force_apply_rules,
                    force_remove_rules, coprocess_rules_files, obj_doc,
                    rules_doc):
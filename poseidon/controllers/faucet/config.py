@@ -2,9 +2,12 @@
 import logging
 import os
 import sys
+from contextlib import contextmanager
+
 import yaml
 from faucetconfrpc.faucetconfrpc_client_lib import FaucetConfRpcClient
 from poseidon.controllers.faucet.helpers import get_config_file, yaml_in, yaml_out
+from poseidon.helpers.stages import timed
 
 
 class FaucetConfGetSetter:
@@ -13,15 +16,99 @@ class FaucetConfGetSetter:
 
     def __init__(self, **_kwargs):
         self.faucet_conf = {}
+        self._transaction_depth = 0
+        self._pending_confs = {}
+        self._pending_port_confs = {}
+        self._pending_switch_confs = {}
 
     @staticmethod
     def config_file_path(config_file):
         return config_file
 
+    @contextmanager
+    def transaction(self):
+        '''
+        collect the port and switch changes made in the block, and write them
+        once at the end (so FAUCET reloads once). Nothing is written if the
+        block raises. Transactions can be nested; the outermost one writes.
+        '''
+        outermost = self._transaction_depth == 0
+        if outermost:
+            self._pending_confs = {}
+            self._pending_port_confs = {}
+            self._pending_switch_confs = {}
+        self._transaction_depth += 1
+        try:
+            yield self
+        except Exception:
+            if outermost:
+                self._pending_confs = {}
+                self._pending_port_confs = {}
+                self._pending_switch_confs = {}
+                # changes in memory weren't written, so read them again.
+                self.faucet_conf = {}
+            raise
+        finally:
+            self._transaction_depth -= 1
+        if outermost:
+            confs, self._pending_confs = self._pending_confs, {}
+            port_confs, self._pending_port_confs = self._pending_port_confs, {}
+            switch_confs, self._pending_switch_confs = self._pending_switch_confs, {}
+            if confs or port_confs or switch_confs:
+                self._write_changes(confs, port_confs, switch_confs)
+
+    def _in_transaction(self, config_file):
+        return self._transaction_depth > 0 and (
+            not config_file or config_file == self.DEFAULT_CONFIG_FILE)
+
+    def _apply_changes(self, confs, port_confs, switch_confs):
+        ''' apply top level, port and switch changes to the config in memory. '''
+        self.faucet_conf.update(confs)
+        dps = self.faucet_conf.get('dps', {})
+        for dp, switch_conf in switch_confs.items():
+            if dp in dps:
+                dps[dp].update(switch_conf)
+        for (dp, port), port_conf in port_confs.items():
+            if dp in dps:
+                dps[dp].setdefault('interfaces', {})[port] = port_conf
+
+    def _read_pending(self, config_file):
+        ''' apply the changes pending in a transaction to a config just read. '''
+        if self._in_transaction(config_file):
+            self._apply_changes(
+                self._pending_confs, self._pending_port_confs,
+                self._pending_switch_confs)
+
+    def _write_changes(self, confs, port_confs, switch_confs):
+        raise NotImplementedError
+
+    def _transaction_has_dp(self, dp):
+        ''' return True if dp is in the config, reading it if it hasn't been yet. '''
+        if not self.faucet_conf:
+            self.read_faucet_conf(config_file=None)
+        if dp in self.faucet_conf.get('dps', {}):
+            return True
+        logging.warning('Not changing config of unknown dp {0}'.format(dp))
+        return False
+
     def set_acls(self, acls):
+        return self._set_conf('acls', acls)
+
+    def set_include(self, include):
+        return self._set_conf('include', include)
+
+    def _set_conf(self, key, value):
+        ''' set a top level section of the config. '''
+        if self._in_transaction(None):
+            self._pending_confs[key] = value
+            self._apply_changes({key: value}, {}, {})
+            return True
+        return self._write_conf(key, value)
+
+    def _write_conf(self, key, value):
         self.read_faucet_conf(config_file=None)
-        self.faucet_conf['acls'] = acls
-        self.write_faucet_conf(config_file=None)
+        self.faucet_conf[key] = value
+        return self.write_faucet_conf(config_file=None)
 
     def get_dps(self):
         raise NotImplementedError
@@ -60,24 +147,73 @@ class FaucetConfGetSetter:
         self.set_port_conf(dp, port, mirror_interface_conf)
 
     def set_port_conf(self, dp, port, port_conf):
-        raise NotImplementedError
+        if self._in_transaction(None):
+            if not self._transaction_has_dp(dp):
+                return None
+            self._pending_port_confs[(dp, port)] = port_conf
+            self._apply_changes({}, {(dp, port): port_conf}, {})
+            return True
+        return self._write_changes({}, {(dp, port): port_conf}, {})
 
     def update_switch_conf(self, dp, switch_conf):
-        raise NotImplementedError
+        if self._in_transaction(None):
+            if not self._transaction_has_dp(dp):
+                return None
+            self._pending_switch_confs.setdefault(dp, {}).update(switch_conf)
+            self._apply_changes({}, {}, {dp: switch_conf})
+            return True
+        return self._write_changes({}, {}, {dp: switch_conf})
 
 
 class FaucetLocalConfGetSetter(FaucetConfGetSetter):
+    '''
+    get and set FAUCET config in a local file.
+
+    The parsed config is cached, and only parsed again when the file's
+    mtime or size changes (our own writes update the cache rather than
+    invalidating it). Reads return the cached config itself rather than a
+    copy, so changes to it must be written back with write_faucet_conf().
+    '''
+
+    def __init__(self, **_kwargs):
+        super(FaucetLocalConfGetSetter, self).__init__(**_kwargs)
+        self._cached_conf = None
+        self._cached_stat = None
+
+    @staticmethod
+    def _conf_stat(config_file):
+        try:
+            stat = os.stat(config_file)
+        except (OSError, TypeError):
+            return None
+        return (config_file, stat.st_mtime_ns, stat.st_size)
+
+    def _cache_conf(self, conf_stat):
+        if conf_stat is None:
+            self._cached_conf = None
+        else:
+            self._cached_conf = self.faucet_conf
+        self._cached_stat = conf_stat
 
     def read_faucet_conf(self, config_file):
+        in_transaction = self._in_transaction(config_file)
         if not config_file:
             config_file = self.DEFAULT_CONFIG_FILE
         config_file = get_config_file(config_file)
+        conf_stat = self._conf_stat(config_file)
+        # faucet_conf may have been replaced since it was cached.
+        if (conf_stat is not None and conf_stat == self._cached_stat and
+                self.faucet_conf is self._cached_conf):
+            return self.faucet_conf
         faucet_conf = yaml_in(config_file)
         if faucet_conf is None:
             logging.error('Faucet config is empty, exiting.')
             sys.exit(1)
         if isinstance(faucet_conf, dict):
             self.faucet_conf = faucet_conf
+            self._cache_conf(conf_stat)
+            if in_transaction:
+                self._read_pending(None)
         return self.faucet_conf
 
     def write_faucet_conf(self, config_file=None, faucet_conf=None):
@@ -87,28 +223,33 @@ class FaucetLocalConfGetSetter(FaucetConfGetSetter):
             faucet_conf = self.faucet_conf
         self.faucet_conf = faucet_conf
         config_file = get_config_file(config_file)
-        return yaml_out(config_file, self.faucet_conf)
+        return self._write_conf_file(config_file)
+
+    @timed('write_faucet_conf')
+    def _write_conf_file(self, config_file):
+        result = yaml_out(config_file, self.faucet_conf)
+        conf_stat = None
+        if result:
+            conf_stat = self._conf_stat(config_file)
+        self._cache_conf(conf_stat)
+        return result
 
     def get_dps(self):
         self.read_faucet_conf(config_file=None)
         return self.faucet_conf.get('dps', {})
 
-    def set_port_conf(self, dp, port, port_conf):
-        switch_conf = self.get_switch_conf(dp)
-        if not switch_conf:
-            return None
-        switch_conf['interfaces'][port] = port_conf
-        self.write_faucet_conf()
-
-    def update_switch_conf(self, dp, switch_conf):
-        self.faucet_conf['dps'][dp].update(switch_conf)
-        self.write_faucet_conf()
+    def _write_changes(self, confs, port_confs, switch_confs):
+        # the file may have changed since the transaction started.
+        self.read_faucet_conf(config_file=None)
+        self._apply_changes(confs, port_confs, switch_confs)
+        return self.write_faucet_conf()
 
 
 class FaucetRemoteConfGetSetter(FaucetConfGetSetter):
 
     def __init__(self, client_key=None, client_cert=None,
                  ca_cert=None, server_addr=None):
+        super(FaucetRemoteConfGetSetter, self).__init__()
         self.client = FaucetConfRpcClient(
             client_key=client_key, client_cert=client_cert,
             ca_cert=ca_cert, server_addr=server_addr)
@@ -125,26 +266,48 @@ class FaucetRemoteConfGetSetter(FaucetConfGetSetter):
         if self.faucet_conf is None:
             logging.error('Faucet config is empty, exiting.')
             sys.exit(1)
+        self._read_pending(config_file)
         return self.faucet_conf
 
+    @timed('write_faucet_conf')
+    def _set_config_file(self, config_file, faucet_conf, merge):
+        return self.client.set_config_file(
+            faucet_conf,
+            config_filename=self.config_file_path(config_file),
+            merge=merge)
+
     def write_faucet_conf(self, config_file=None, faucet_conf=None, merge=False):
         if not config_file:
             config_file = self.DEFAULT_CONFIG_FILE
         if faucet_conf is None:
             faucet_conf = self.faucet_conf
-        return self.client.set_config_file(
-            self.faucet_conf,
-            config_filename=self.config_file_path(config_file),
-            merge=merge)
+        return self._set_config_file(config_file, faucet_conf, merge)
 
     def get_dps(self):
         self.read_faucet_conf(config_file=None)
         return self.faucet_conf.get('dps', {})
 
-    def set_port_conf(self, dp, port, port_conf):
-        return self.client.set_dp_interfaces(
-            [(dp, {port: yaml.dump(port_conf)})])
+    @timed('write_faucet_conf')
+    def _set_dp_interfaces(self, dp_interfaces):
+        return self.client.set_dp_interfaces(dp_interfaces)
 
-    def update_switch_conf(self, dp, switch_conf):
-        return self.write_faucet_conf(
-            faucet_conf={'dps': {dp: switch_conf}}, merge=True)
+    def _set_conf(self, key, value):
+        # top level sections can only be set with the whole config, so
+        # aren't deferred.
+        return self._write_conf(key, value)
+
+    def _write_changes(self, _confs, port_confs, switch_confs):
+        '''
+        send only the changed interfaces and switches, so changes made to the
+        rest of the config since it was read aren't overwritten.
+        '''
+        result = True
+        if port_confs:
+            dp_interfaces = {}
+            for (dp, port), port_conf in port_confs.items():
+                dp_interfaces.setdefault(dp, {})[port] = yaml.dump(port_conf)
+            result = self._set_dp_interfaces(list(dp_interfaces.items()))
+        if switch_confs:
+            result = self.write_faucet_conf(
+                faucet_conf={'dps': switch_confs}, merge=True)
+        return result
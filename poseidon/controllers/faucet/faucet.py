@@ -30,6 +30,7 @@ class FaucetProxy(Parser):
         self.ignore_vlans = controller['ignore_vlans']
         self.ignore_ports = controller['ignore_ports']
         self.faucetconfrpc_address = controller['faucetconfrpc_address']
+        self.mac_history_size = controller['mac_history_size']
 
         super(FaucetProxy, self).__init__(
             self.mirror_ports,
@@ -41,6 +42,7 @@ class FaucetProxy(Parser):
             self.tunnel_vlan,
             self.tunnel_name,
             faucetconfrpc_address=self.faucetconfrpc_address,
+            mac_history_size=self.mac_history_size,
             *args, **kwargs)
 
         # parse volos config
@@ -48,6 +50,8 @@ class FaucetProxy(Parser):
         self.coprocessor = Coprocessor(controller)
         self.logger = logging.getLogger('faucet')
         self.mac_table = {}
+        self.touched_macs = set()
+        self.port_macs = {}
 
     @staticmethod
     def format_endpoints(data):
@@ -56,17 +60,18 @@ class FaucetProxy(Parser):
         '''
         ret_list = list()
         for d in data:
-            md = d[0]
-            d.reverse()
-            for i, _ in enumerate(d):
+            # copy, so the parser's mac_table entries aren't changed.
+            md = dict(d[0])
+            # oldest first, so the newest addresses win.
+            for entry in reversed(d):
                 ipv4_set = False
                 ipv6_set = False
-                if 'ip-address' in d[i]:
-                    if ':' in d[i]['ip-address']:
-                        md['ipv6'] = d[i]['ip-address']
+                if 'ip-address' in entry:
+                    if ':' in entry['ip-address']:
+                        md['ipv6'] = entry['ip-address']
                         ipv6_set = True
                     else:
-                        md['ipv4'] = d[i]['ip-address']
+                        md['ipv4'] = entry['ip-address']
                         ipv4_set = True
                 if 'ipv4' in md:
                     ipv4_set = True
@@ -88,7 +93,11 @@ class FaucetProxy(Parser):
             ret_list.append(md)
         return ret_list
 
-    def get_endpoints(self, messages=None):
+    def get_endpoints(self, messages=None, changed_only=False):
+        '''
+        return mac_table entries, or with changed_only just those changed
+        by events since the last call.
+        '''
         retval = []
 
         if messages:
@@ -96,7 +105,12 @@ class FaucetProxy(Parser):
             for message in messages:
                 if not self.ignore_event(message):
                     self.event(message)
-        for mac in self.mac_table:
+        macs = self.pop_touched_macs()
+        if not changed_only:
+            macs = self.mac_table
+        for mac in macs:
+            if mac not in self.mac_table:
+                continue
             if self.learn_pub_adds:
                 retval.append(self.mac_table[mac])
             else:
@@ -3,7 +3,10 @@
 Created on 19 November 2017
 @author: Charlie Lewis
 """
+import copy
+import itertools
 import logging
+from collections import OrderedDict
 
 from poseidon.controllers.faucet.acls import ACLs
 from poseidon.controllers.faucet.config import FaucetLocalConfGetSetter, FaucetRemoteConfGetSetter
@@ -11,6 +14,125 @@ from poseidon.controllers.faucet.helpers import parse_rules
 from poseidon.volos.acls import Acl
 
 
+class MacHistory:
+    '''
+    the most recent distinct learn records for a MAC, newest first. Learning
+    a record again moves it to the front, and the oldest records are evicted
+    beyond max_records.
+    '''
+
+    KEY_FIELDS = ('ip-address', 'mac', 'segment', 'port', 'vlan')
+
+    def __init__(self, max_records):
+        self.max_records = max_records
+        self._records = OrderedDict()
+
+    @classmethod
+    def record_key(cls, record):
+        return tuple(record.get(field, None) for field in cls.KEY_FIELDS)
+
+    def add(self, record):
+        ''' add a record as the newest, returning any records evicted. '''
+        key = self.record_key(record)
+        self._records.pop(key, None)
+        self._records[key] = record
+        evicted = []
+        while len(self._records) > max(self.max_records, 1):
+            evicted.append(self._records.popitem(last=False)[1])
+        return evicted
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return reversed(self._records.values())
+
+    def __reversed__(self):
+        return iter(self._records.values())
+
+    def __contains__(self, record):
+        return self.record_key(record) in self._records
+
+    def __getitem__(self, index):
+        if index == 0 and self._records:
+            return next(reversed(self._records.values()))
+        return list(self)[index]
+
+
+class FaucetEventBuffer:
+    '''
+    FAUCET events waiting for the next scan, in arrival order. Events that
+    supersede earlier ones are coalesced: only the latest L2 learn (and an
+    expire after it) is kept per (dp, MAC), and only the latest port down
+    per (dp, port), as a port coming up changes nothing. Once maxsize keys
+    are buffered, events for new keys are dropped.
+    '''
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._events = OrderedDict()
+        self._unkeyed = itertools.count()
+        self.coalesced = 0
+        self.dropped = 0
+
+    @staticmethod
+    def event_key(message):
+        dp_name = message.get('dp_name', None)
+        for message_type in ('L2_LEARN', 'L2_EXPIRE'):
+            message_body = message.get(message_type, None)
+            if message_body:
+                return (dp_name, 'L2', message_body.get('eth_src', None))
+        message_body = message.get('PORT_CHANGE', None)
+        if message_body:
+            return (dp_name, 'PORT_CHANGE', message_body.get('port_no', None))
+        return None
+
+    def full(self):
+        return self.maxsize > 0 and len(self._events) >= self.maxsize
+
+    def add(self, message):
+        ''' buffer an event, returning False if it was dropped. '''
+        key = self.event_key(message)
+        events = self._events.get(key, None) if key is not None else None
+        if events is None:
+            if self.full():
+                self.dropped += 1
+                return False
+            if key is None:
+                key = ('unkeyed', next(self._unkeyed))
+            self._events[key] = [message]
+            return True
+        pending = len(events) + 1
+        if key[1] == 'PORT_CHANGE':
+            if message['PORT_CHANGE'].get('status', True):
+                self.coalesced += 1
+                return True
+            events = [message]
+        elif 'L2_LEARN' in message:
+            events = [message]
+        elif 'L2_LEARN' in events[0]:
+            events = [events[0], message]
+        else:
+            events = [message]
+        del self._events[key]
+        self._events[key] = events
+        self.coalesced += pending - len(events)
+        return True
+
+    def pop_all(self):
+        ''' return the buffered events in order, and empty the buffer. '''
+        events = list(self)
+        self._events = OrderedDict()
+        return events
+
+    def __len__(self):
+        return len(self._events)
+
+    def __iter__(self):
+        for events in self._events.values():
+            yield from events
+
+
 class Parser:
 
     def __init__(self,
@@ -25,7 +147,8 @@ class Parser:
                  faucetconfrpc_address=None,
                  copro_port=None,
                  copro_vlan=None,
-                 faucetconfgetsetter_cl=FaucetRemoteConfGetSetter):
+                 faucetconfgetsetter_cl=FaucetRemoteConfGetSetter,
+                 mac_history_size=16):
         self.logger = logging.getLogger('parser')
         self.mirror_ports = mirror_ports
         self.proxy_mirror_ports = proxy_mirror_ports
@@ -44,9 +167,19 @@ class Parser:
             client_cert='/certs/faucetconfrpc.crt',
             ca_cert='/certs/faucetconfrpc-ca.crt',
             server_addr=faucetconfrpc_address)
+        self.mac_history_size = mac_history_size
+        self.mac_history_evictions = 0
         self.mac_table = {}
+        # MACs whose mac_table entries changed since the last pop_touched_macs().
+        self.touched_macs = set()
+        # (dp_name, port) -> MACs with a mac_table entry on that port.
+        self.port_macs = {}
         self._set_default_switch_conf()
 
+    def config_transaction(self):
+        ''' return a context manager that writes FAUCET config changes once, when it exits. '''
+        return self.faucetconfgetsetter.transaction()
+
     def _read_faucet_conf(self):
         return self.faucetconfgetsetter.read_faucet_conf(config_file=None)
 
@@ -84,6 +217,11 @@ class Parser:
         self.faucetconfgetsetter.set_mirror_config(switch, port, ports)
 
     def _set_default_switch_conf(self):
+        # one write for all the switches, rather than one each.
+        with self.config_transaction():
+            self._update_default_switch_conf()
+
+    def _update_default_switch_conf(self):
         # TODO: make smarter with more complex configs (backup original values, etc)
         if self.mirror_ports:
             root_stack_switch = self._get_stack_root_switch()
@@ -172,13 +310,14 @@ class Parser:
         return (mirror_port, existing_mirror_ports)
 
     def clear_mirrors(self):
-        dps = self._get_dps()
-        if not dps:
-            return False
-        for switch in dps:
-            mirror_port, _ = self.check_mirror(switch)
-            if mirror_port:
-                self._set_mirror_config(switch, mirror_port)
+        with self.config_transaction():
+            dps = self._get_dps()
+            if not dps:
+                return False
+            for switch in dps:
+                mirror_port, _ = self.check_mirror(switch)
+                if mirror_port:
+                    self._set_mirror_config(switch, mirror_port)
 
     def config_mirror(self, action, switch, port):
         switch, port = self.proxy_mirror_port(switch, port)
@@ -198,14 +337,32 @@ class Parser:
             self.logger.error(
                 f'Unable to mirror {switch}:{port} due to warnings')
 
+    @staticmethod
+    def _conf_port_conf(faucet_conf, switch, port):
+        return faucet_conf.get('dps', {}).get(switch, {}).get('interfaces', {}).get(port, None)
+
     def config_acls(self, rules_file, endpoints, force_apply_rules, force_remove_rules, coprocess_rules_files):
         rules_doc = parse_rules(rules_file)
-        self._read_faucet_conf()
-        self.faucetconfgetsetter.faucet_conf = ACLs().apply_acls(
-            rules_file, endpoints,
-            force_apply_rules, force_remove_rules,
-            coprocess_rules_files, self.faucetconfgetsetter.faucet_conf, rules_doc)
-        self._write_faucet_conf()
+        with self.config_transaction():
+            faucet_conf = self._read_faucet_conf()
+            orig_include = copy.deepcopy(faucet_conf.get('include', None))
+            orig_port_confs = {}
+            for endpoint in endpoints or []:
+                switch = endpoint.endpoint_data['segment']
+                port = int(endpoint.endpoint_data['port'])
+                orig_port_confs[(switch, port)] = copy.deepcopy(
+                    self._conf_port_conf(faucet_conf, switch, port))
+            faucet_conf = ACLs().apply_acls(
+                rules_file, endpoints,
+                force_apply_rules, force_remove_rules,
+                coprocess_rules_files, faucet_conf, rules_doc)
+            # set only what changed, so it is written with the transaction.
+            if faucet_conf.get('include', None) != orig_include:
+                self.faucetconfgetsetter.set_include(faucet_conf['include'])
+            for (switch, port), orig_port_conf in orig_port_confs.items():
+                port_conf = self._conf_port_conf(faucet_conf, switch, port)
+                if port_conf != orig_port_conf:
+                    self._set_port_conf(switch, port, port_conf)
 
     def config(self, action, port, switch, rules_file=None,
                endpoints=None, force_apply_rules=None, force_remove_rules=None,
@@ -250,12 +407,29 @@ class Parser:
         # Not a message we are interested in, ignore it.
         return True
 
+    def _unindex_port_mac(self, mac, evicted):
+        port_key = (evicted['segment'], evicted['port'])
+        for data in self.mac_table[mac]:
+            if (data['segment'], data['port']) == port_key:
+                return
+        port_macs = self.port_macs.get(port_key, set())
+        port_macs.discard(mac)
+        if not port_macs:
+            self.port_macs.pop(port_key, None)
+
+    def pop_touched_macs(self):
+        ''' return MACs changed by events since the last call, and reset them. '''
+        touched_macs = self.touched_macs
+        self.touched_macs = set()
+        return touched_macs
+
     def event(self, message):
         dp_name = str(message['dp_name'])
 
         def make_mac_inactive(mac):
             if mac in self.mac_table:
                 self.mac_table[mac][0]['active'] = 0
+                self.touched_macs.add(mac)
 
         if 'L2_LEARN' in message:
             self.logger.debug(
@@ -273,12 +447,15 @@ class Parser:
                 'tenant': vlan_str,
                 'active': 1}
 
-            if eth_src in self.mac_table:
-                if data in self.mac_table[eth_src]:
-                    self.mac_table[eth_src].remove(data)
-                self.mac_table[eth_src].insert(0, data)
-            else:
-                self.mac_table[eth_src] = [data]
+            mac_history = self.mac_table.get(eth_src, None)
+            if mac_history is None:
+                mac_history = MacHistory(self.mac_history_size)
+                self.mac_table[eth_src] = mac_history
+            for evicted in mac_history.add(data):
+                self.mac_history_evictions += 1
+                self._unindex_port_mac(eth_src, evicted)
+            self.port_macs.setdefault((dp_name, data['port']), set()).add(eth_src)
+            self.touched_macs.add(eth_src)
         elif 'L2_EXPIRE' in message:
             self.logger.debug(
                 'got faucet message for l2_expire: {0}'.format(message))
@@ -290,8 +467,5 @@ class Parser:
             message = message['PORT_CHANGE']
             port_no_str = str(message['port_no'])
             if not message['status']:
-                m_table = self.mac_table.copy()
-                for mac in m_table:
-                    for data in m_table[mac]:
-                        if port_no_str == data['port'] and dp_name == data['segment']:
-                            make_mac_inactive(mac)
+                for mac in self.port_macs.get((dp_name, port_no_str), ()):
+                    make_mac_inactive(mac)
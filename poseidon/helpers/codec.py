@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Codecs for structured values stored in Redis.
+
+Encoded values are prefixed with a tag naming the codec and schema version
+(e.g. j1: for version 1 JSON), so readers don't need to know how a value was
+written. Untagged values are legacy Python reprs, decoded with
+ast.literal_eval.
+"""
+import ast
+import json
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+SCHEMA_VERSION = 1
+
+
+class JSONCodec:
+
+    name = 'json'
+    tag = ('j%u:' % SCHEMA_VERSION).encode('ascii')
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(raw):
+        return json.loads(raw)
+
+
+class MsgpackCodec:
+
+    name = 'msgpack'
+    tag = ('m%u:' % SCHEMA_VERSION).encode('ascii')
+
+    @staticmethod
+    def dumps(value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    @staticmethod
+    def loads(raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec, MsgpackCodec)}
+TAGGED_CODECS = {codec.tag: codec for codec in CODECS.values()}
+TAG_LEN = len(JSONCodec.tag)
+STRUCTURED_TYPES = (dict, list, tuple)
+
+
+def get_codec(name):
+    ''' return the codec for a name, e.g. from the redis_codec setting. '''
+    codec = CODECS.get(name, None)
+    if codec is None:
+        raise ValueError('Unknown Redis codec: {0}'.format(name))
+    if codec is MsgpackCodec and msgpack is None:
+        raise ValueError('The msgpack Redis codec requires msgpack to be installed')
+    return codec
+
+
+def encode_value(value, codec=JSONCodec):
+    '''
+    encode a value for Redis. Structured values are encoded with the codec,
+    everything else is stored as its string representation.
+    '''
+    if isinstance(value, STRUCTURED_TYPES):
+        return codec.tag + codec.dumps(value)
+    return str(value)
+
+
+def get_value_codec(raw):
+    ''' return the codec a raw Redis value was encoded with, or None if legacy. '''
+    if isinstance(raw, str):
+        return TAGGED_CODECS.get(raw[:TAG_LEN].encode('ascii', 'replace'), None)
+    return TAGGED_CODECS.get(raw[:TAG_LEN], None)
+
+
+def decode_value(raw):
+    ''' decode a raw Redis value written by encode_value() or as a legacy repr. '''
+    if raw is None:
+        return None
+    codec = get_value_codec(raw)
+    if codec is not None:
+        return codec.loads(raw[TAG_LEN:])
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')
+    return ast.literal_eval(raw)
@@ -63,8 +63,8 @@ class Collector(object):
             if response[0]:
                 self.logger.info(
                     'Successfully started the collector for: {0}'.format(self.id))
-                self.endpoint.endpoint_data['container_id'] = response[1].rsplit(
-                    ':', 1)[-1].strip()
+                self.endpoint.update_endpoint_data(container_id=response[1].rsplit(
+                    ':', 1)[-1].strip())
                 status = True
             else:
                 self.logger.error(
@@ -34,7 +34,25 @@ class Config():
             'reinvestigation_frequency': 900,
             'max_concurrent_reinvestigations': 2,
             'logger_level': 'INFO',
-            'faucetconfrpc_address': 'faucetconfrpc:59999'
+            'faucetconfrpc_address': 'faucetconfrpc:59999',
+            'write_behind_endpoints': True,
+            'redis_pipeline_chunk_size': 1000,
+            'redis_codec': 'json',
+            'reconcile_frequency': 300,
+            'mac_history_size': 16,
+            'rdns_workers': 8,
+            'rdns_cache_size': 4096,
+            'rdns_ttl': 3600,
+            'rdns_negative_ttl': 300,
+            'rdns_nonblocking': False,
+            'rabbit_prefetch_count': 100,
+            'event_queue_size': 10000,
+            'runtime': 'threaded',
+            'rabbit_max_backoff': 60,
+            'rabbit_lag_frequency': 15,
+            'prometheus_endpoint_series_limit': 10000,
+            'prometheus_aggregate_only': False,
+            'stage_metrics': True,
         }
 
         config_map = {
@@ -49,12 +67,28 @@ class Config():
             'automated_acls': ('AUTOMATED_ACLS', [ast.literal_eval]),
             'FA_RABBIT_PORT': ('FA_RABBIT_PORT', [int]),
             'scan_frequency': ('scan_frequency', [int]),
+            'reconcile_frequency': ('reconcile_frequency', [int]),
             'reinvestigation_frequency': ('reinvestigation_frequency', [int]),
             'max_concurrent_reinvestigations': ('max_concurrent_reinvestigations', [int]),
             'ignore_vlans': ('ignore_vlans', [json.loads]),
             'ignore_ports': ('ignore_ports', [json.loads]),
             'trunk_ports': ('trunk_ports', [json.loads]),
+            'mac_history_size': ('mac_history_size', [int]),
             'logger_level': ('logger_level', []),
+            'write_behind_endpoints': ('write_behind_endpoints', [ast.literal_eval]),
+            'redis_pipeline_chunk_size': ('redis_pipeline_chunk_size', [int]),
+            'rdns_workers': ('rdns_workers', [int]),
+            'rdns_cache_size': ('rdns_cache_size', [int]),
+            'rdns_ttl': ('rdns_ttl', [int]),
+            'rdns_negative_ttl': ('rdns_negative_ttl', [int]),
+            'rdns_nonblocking': ('rdns_nonblocking', [ast.literal_eval]),
+            'rabbit_prefetch_count': ('rabbit_prefetch_count', [int]),
+            'event_queue_size': ('event_queue_size', [int]),
+            'rabbit_max_backoff': ('rabbit_max_backoff', [int]),
+            'rabbit_lag_frequency': ('rabbit_lag_frequency', [int]),
+            'prometheus_endpoint_series_limit': ('prometheus_endpoint_series_limit', [int]),
+            'prometheus_aggregate_only': ('prometheus_aggregate_only', [ast.literal_eval]),
+            'stage_metrics': ('stage_metrics', [ast.literal_eval]),
         }
 
         for section in self.config.sections():
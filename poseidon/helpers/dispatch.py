@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Wake the main loop when there is work to do.
+
+Work arrives on several queues (RabbitMQ messages, scheduled jobs), and the
+main loop also has timers to run. Rather than polling each of them, the
+queues share one wakeup event that is set whenever something is put on any
+of them, so the loop can sleep until there is work or a timer is due.
+"""
+import asyncio
+import queue
+import threading
+import time
+
+
+class DispatchQueue(queue.Queue):
+    '''
+    a queue that wakes its dispatcher on put, and records how long each
+    item waited before it was taken off the queue.
+    '''
+
+    def __init__(self, wakeup, name, maxsize=0):
+        super().__init__(maxsize=maxsize)
+        self.wakeup = wakeup
+        self.name = name
+        self.latencies = []
+
+    def _put(self, item):
+        super()._put((time.monotonic(), item))
+        self.wakeup.set()
+
+    def _get(self):
+        queued_at, item = super()._get()
+        self.latencies.append(time.monotonic() - queued_at)
+        return item
+
+
+class Dispatcher:
+    '''
+    a set of queues sharing one wakeup event, so a single thread can wait
+    on all of them (and a timeout) at once.
+    '''
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.queues = []
+
+    def queue(self, name, maxsize=0):
+        ''' return a new queue that wakes this dispatcher. '''
+        dispatch_queue = DispatchQueue(self.wakeup, name, maxsize=maxsize)
+        self.queues.append(dispatch_queue)
+        return dispatch_queue
+
+    def notify(self):
+        ''' wake the waiting thread, e.g. to shut down. '''
+        self.wakeup.set()
+
+    def wait(self, timeout=None):
+        '''
+        wait until something is put on a queue or the timeout expires,
+        returning True if woken by a put. Items put while the caller was
+        busy wake it straight away.
+        '''
+        woken = self.wakeup.wait(timeout)
+        self.wakeup.clear()
+        return woken
+
+    def pop_latencies(self):
+        ''' return {queue name: [seconds waited]} since the last call. '''
+        latencies = {}
+        for dispatch_queue in self.queues:
+            if dispatch_queue.latencies:
+                latencies[dispatch_queue.name] = dispatch_queue.latencies
+                dispatch_queue.latencies = []
+        return latencies
+
+
+class AsyncWakeup:
+    '''
+    a wakeup event for an asyncio event loop. The asyncio.Event is made on
+    first use, so it belongs to the loop that uses it.
+    '''
+
+    def __init__(self):
+        self._event = None
+
+    @property
+    def event(self):
+        if self._event is None:
+            self._event = asyncio.Event()
+        return self._event
+
+    def set(self):
+        self.event.set()
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self, timeout=None):
+        if self.event.is_set():
+            return True
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class AsyncDispatchQueue(DispatchQueue):
+    '''
+    a DispatchQueue put to from an asyncio event loop, where a put mustn't
+    block. Items are taken off by the state executor thread, so it is still
+    a thread safe queue, but put() never waits: it raises queue.Full when
+    the queue is full, so the producer can hold off until there is room.
+    '''
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block=False)
+
+
+class AsyncDispatcher(Dispatcher):
+    '''
+    a Dispatcher for an asyncio event loop. Its queues are only put to from
+    the loop, so a put to a full queue raises queue.Full instead of blocking.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.wakeup = AsyncWakeup()
+
+    def queue(self, name, maxsize=0):
+        ''' return a new queue that wakes this dispatcher. '''
+        dispatch_queue = AsyncDispatchQueue(self.wakeup, name, maxsize=maxsize)
+        self.queues.append(dispatch_queue)
+        return dispatch_queue
+
+    async def wait(self, timeout=None):
+        woken = await self.wakeup.wait(timeout)
+        self.wakeup.clear()
+        return woken
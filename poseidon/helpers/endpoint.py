@@ -6,14 +6,67 @@ Created on 3 December 2018
 import hashlib
 import json
 import time
+from collections import namedtuple
+from contextlib import contextmanager
 
-from transitions import Machine
+from transitions import MachineError
 
 MACHINE_IP_FIELDS = {
     'ipv4': ('ipv4_rdns', 'ipv4_subnet'),
     'ipv6': ('ipv6_rdns', 'ipv6_subnet')}
 MACHINE_IP_PREFIXES = {
     'ipv4': 24, 'ipv6': 64}
+# endpoint_data fields that ACLs are applied by.
+ACL_FIELDS = frozenset(('mac', 'segment', 'port'))
+# metadata fields that ACL rules match on.
+ACL_METADATA_FIELDS = frozenset(('role', 'os', 'behavior'))
+# attributes that EndpointIndex looks up endpoints by.
+INDEXED_ATTRS = frozenset(('state', 'ignore', 'endpoint_data'))
+# attributes that EndpointIndex journals, so state changes can be rolled back.
+JOURNALED_ATTRS = frozenset(
+    ('state', 'copro_state', 'p_next_state', 'p_next_copro_state'))
+
+
+# stand-ins for the transitions EventData passed to history callbacks.
+TransitionData = namedtuple('TransitionData', ('source', 'dest'))
+EventData = namedtuple('EventData', ('transition',))
+
+
+class MachineRecord(dict):
+    '''
+    immutable endpoint_data record. A record can be shared between the
+    parser, endpoints and persistence without copying; changes are made by
+    updated(), which returns a new record.
+    '''
+
+    __slots__ = ()
+
+    def _immutable(self, *_args, **_kwargs):
+        raise TypeError('MachineRecord is immutable, use updated()')
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    __ior__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+    def updated(self, *args, **kwargs):
+        ''' return a copy of the record with some fields changed. '''
+        data = dict(self)
+        data.update(*args, **kwargs)
+        return MachineRecord(data)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, _memo):
+        return self
+
+    def __reduce__(self):
+        return (MachineRecord, (dict(self),))
 
 
 class HistoryTypes():
@@ -25,6 +78,12 @@ class HistoryTypes():
 
 class Endpoint:
 
+    __slots__ = (
+        'name', 'ignore', 'copro_ignores', 'endpoint_data', 'p_next_state',
+        'p_prev_states', 'p_next_copro_state', 'p_prev_copross_states',
+        'acl_data', 'metadata', 'history', 'state', 'copro_state',
+        'changed_fields', '_persisted', '_index')
+
     states = ['known', 'unknown', 'mirroring', 'inactive', 'abnormal',
               'shutdown', 'reinvestigating', 'queued']
 
@@ -139,6 +198,11 @@ class Endpoint:
 
     ]
 
+    # (trigger, source state) -> (state attribute, dest, callback, event data)
+    # shared by all endpoints and filled in by _compile_transitions().
+    _transition_table = {}
+    _triggers = {}
+
     def __init__(self, hashed_val):
         self.name = hashed_val.strip()
         self.ignore = False
@@ -153,6 +217,150 @@ class Endpoint:
         self.history = []
         self.state = None
         self.copro_state = None
+        # endpoint_data fields changed since the endpoint was last stored,
+        # and ACL_METADATA_FIELDS changed since ACLs were last applied.
+        self.changed_fields = set()
+        self._persisted = None
+        self._index = None
+
+    @classmethod
+    def _compile_transitions(cls):
+        ''' build the transition table and a method for each trigger. '''
+        for state_attr, transitions in (
+                ('state', cls.transitions), ('copro_state', cls.copro_transitions)):
+            for transition in transitions:
+                trigger = transition['trigger']
+                source = transition['source']
+                dest = transition['dest']
+                cls._transition_table[(trigger, source)] = (
+                    state_attr, dest, transition['before'],
+                    EventData(TransitionData(source, dest)))
+                if not hasattr(cls, trigger):
+                    setattr(cls, trigger, cls._trigger_method(trigger))
+        cls._triggers = {
+            trigger: state_attr for (trigger, _), (state_attr, _, _, _) in cls._transition_table.items()}
+
+    @staticmethod
+    def _trigger_method(trigger_name):
+        def _trigger(self):
+            return self.trigger(trigger_name)
+        _trigger.__name__ = trigger_name
+        _trigger.__doc__ = ''' trigger the {0} transition. '''.format(
+            trigger_name)
+        return _trigger
+
+    def trigger(self, trigger_name):
+        ''' transition to a new state, as transitions.Machine.trigger() would. '''
+        state_attr = self._triggers.get(trigger_name, None)
+        if state_attr is None:
+            raise AttributeError(
+                "Do not know event named '{0}'.".format(trigger_name))
+        source = getattr(self, state_attr)
+        transition = self._transition_table.get((trigger_name, source), None)
+        if transition is None:
+            raise MachineError("{0} Can't trigger event {1} from state {2}!".format(
+                self.name[:8], trigger_name, source))
+        _, dest, before, event_data = transition
+        self._journal()
+        getattr(self, before)(event_data)
+        setattr(self, state_attr, dest)
+        return True
+
+    def __setattr__(self, name, value):
+        if name in JOURNALED_ATTRS:
+            self._journal()
+        object.__setattr__(self, name, value)
+        if name in INDEXED_ATTRS:
+            index = getattr(self, '_index', None)
+            if index is not None:
+                index.reindex(self)
+
+    def _journal(self):
+        ''' record the state before it changes, if the index is journaling. '''
+        index = getattr(self, '_index', None)
+        if index is not None and index.journal is not None:
+            if self.name not in index.journal:
+                index.journal[self.name] = (self, self.state_snapshot())
+
+    def state_snapshot(self):
+        ''' return the state and state history, for restore_state(). '''
+        return (self.state, self.copro_state, self.p_next_state,
+                self.p_next_copro_state, len(self.p_prev_states),
+                len(self.p_prev_copross_states), len(self.history))
+
+    def restore_state(self, snapshot):
+        '''
+        undo state changes made since state_snapshot() was called. The
+        endpoint is stored again, as Redis may have the undone state.
+        '''
+        (state, copro_state, p_next_state, p_next_copro_state,
+         prev_states, prev_copro_states, history) = snapshot
+        del self.p_prev_states[prev_states:]
+        del self.p_prev_copross_states[prev_copro_states:]
+        del self.history[history:]
+        self.p_next_state = p_next_state
+        self.p_next_copro_state = p_next_copro_state
+        self.copro_state = copro_state
+        self.state = state
+        self.mark_dirty()
+
+    def update_endpoint_data(self, *args, **kwargs):
+        ''' replace endpoint_data with a record with some fields changed. '''
+        self.changed_fields.update(dict(*args, **kwargs))
+        endpoint_data = self.endpoint_data
+        if isinstance(endpoint_data, MachineRecord):
+            self.endpoint_data = endpoint_data.updated(*args, **kwargs)
+        else:
+            endpoint_data = dict(endpoint_data or {})
+            endpoint_data.update(*args, **kwargs)
+            self.endpoint_data = MachineRecord(endpoint_data)
+
+    def _persist_key(self):
+        '''
+        summarize everything that changes when an endpoint needs storing. The
+        lists are copied, so entries replaced in place are noticed too.
+        '''
+        return (self.state, self.copro_state, self.ignore, self.p_next_state,
+                tuple(self.p_prev_states), tuple(self.acl_data), tuple(self.history))
+
+    def mark_dirty(self):
+        ''' force the endpoint to be stored on the next persistence cycle. '''
+        self._persisted = None
+
+    def mark_persisted(self, encoded):
+        ''' record the endpoint as in sync with its stored encoding. '''
+        endpoint_data = self.endpoint_data
+        # records are immutable, so only plain dicts need copying.
+        if isinstance(endpoint_data, dict) and not isinstance(endpoint_data, MachineRecord):
+            endpoint_data = dict(endpoint_data)
+        self._persisted = (self._persist_key(), endpoint_data, encoded)
+        # metadata changes are left for the ACL stage.
+        self.changed_fields.intersection_update(ACL_METADATA_FIELDS)
+
+    def is_dirty(self):
+        ''' return True if the endpoint changed since it was last stored. '''
+        if self._persisted is None or not ACL_METADATA_FIELDS.issuperset(self.changed_fields):
+            return True
+        persist_key, endpoint_data, _ = self._persisted
+        if persist_key != self._persist_key():
+            return True
+        # a record that hasn't been replaced hasn't changed.
+        return endpoint_data is not self.endpoint_data and endpoint_data != self.endpoint_data
+
+    def update_metadata(self, metadata):
+        ''' replace metadata, marking the fields ACL rules match on that changed. '''
+        old_acl_metadata = acl_metadata(self.metadata or {})
+        new_acl_metadata = acl_metadata(metadata)
+        self.changed_fields.update(
+            field for field in ACL_METADATA_FIELDS
+            if old_acl_metadata[field] != new_acl_metadata[field])
+        self.metadata = metadata
+
+    def persisted_encoding(self):
+        ''' return the last stored encoding, or None if not stored. '''
+        if self._persisted is None:
+            return None
+        return self._persisted[2]
 
     def encode(self):
         endpoint_d = {
@@ -215,35 +423,207 @@ class Endpoint:
         return post_h
 
 
+Endpoint._compile_transitions()
+
+
+def acl_metadata(metadata):
+    ''' return {field: set of values} for each metadata field ACL rules match on. '''
+    fields = {field: set() for field in ACL_METADATA_FIELDS}
+    for mac, mac_metadata in metadata.get('mac_addresses', {}).items():
+        for timestamp, record in mac_metadata.items():
+            if not isinstance(record, dict):
+                continue
+            if 'labels' in record:
+                fields['role'].add((mac, timestamp, tuple(record['labels']),
+                                    tuple(record.get('confidences', ()))))
+            if 'behavior' in record:
+                fields['behavior'].add((mac, timestamp, record['behavior']))
+    for ip_field in ('ipv4_addresses', 'ipv6_addresses'):
+        for ip, ip_metadata in metadata.get(ip_field, {}).items():
+            if isinstance(ip_metadata, dict) and 'os' in ip_metadata:
+                fields['os'].add((ip, ip_metadata['os']))
+    return fields
+
+
 def endpoint_factory(hashed_val):
     endpoint = Endpoint(hashed_val)
-    machine = Machine(
-        model=endpoint,
-        states=Endpoint.states,
-        transitions=Endpoint.transitions,
-        initial='unknown',
-        send_event=True)
-    machine.name = endpoint.name[:8]+' '
-    endpoint.machine = machine
-    copro_endpoint = Endpoint(hashed_val)
-    copro_machine = Machine(
-        model=copro_endpoint,
-        states=Endpoint.copro_states,
-        transitions=Endpoint.copro_transitions,
-        initial='copro_unknown',
-        send_event=True)
-    copro_machine.name = endpoint.name[:8]+'_copro'
-    endpoint.copro_machine = copro_machine
+    endpoint.state = 'unknown'
+    endpoint.copro_state = 'copro_unknown'
     return endpoint
 
 
+class EndpointIndex(dict):
+    '''
+    dict of endpoints by name, with secondary indexes by MAC, IP, state and
+    ignored flag. Endpoints notify the index when state, ignore or
+    endpoint_data are assigned; in place changes to the mac/ipv4/ipv6
+    fields of endpoint_data need an explicit reindex().
+    '''
+
+    # verify every index against a full scan after each change (for tests).
+    self_check = False
+
+    def __init__(self, *args, **kwargs):
+        super(EndpointIndex, self).__init__()
+        # {name: (endpoint, state_snapshot)} while in rollback_on_error().
+        self.journal = None
+        self._keys = {}
+        self._by_mac = {}
+        self._by_ip = {}
+        self._by_state = {}
+        self._ignored = {}
+        self.update(*args, **kwargs)
+
+    @staticmethod
+    def _index_keys(endpoint):
+        endpoint_data = endpoint.endpoint_data or {}
+        ips = tuple(ip for ip in (endpoint_data.get('ipv4', None), endpoint_data.get('ipv6', None)) if ip)
+        return (endpoint_data.get('mac', None), ips, endpoint.state, bool(endpoint.ignore))
+
+    @staticmethod
+    def _bucket_add(index, key, name, endpoint):
+        if key is not None:
+            index.setdefault(key, {})[name] = endpoint
+
+    @staticmethod
+    def _bucket_del(index, key, name):
+        if key is not None:
+            bucket = index.get(key, {})
+            bucket.pop(name, None)
+            if not bucket:
+                index.pop(key, None)
+
+    def _add(self, name, endpoint):
+        mac, ips, state, ignore = self._index_keys(endpoint)
+        self._keys[name] = (mac, ips, state, ignore)
+        self._bucket_add(self._by_mac, mac, name, endpoint)
+        for ip in ips:
+            self._bucket_add(self._by_ip, ip, name, endpoint)
+        self._bucket_add(self._by_state, state, name, endpoint)
+        if ignore:
+            self._ignored[name] = endpoint
+
+    def _remove(self, name):
+        mac, ips, state, _ = self._keys.pop(name)
+        self._bucket_del(self._by_mac, mac, name)
+        for ip in ips:
+            self._bucket_del(self._by_ip, ip, name)
+        self._bucket_del(self._by_state, state, name)
+        self._ignored.pop(name, None)
+
+    def _changed(self):
+        if self.self_check:
+            self.check()
+
+    def reindex(self, endpoint):
+        ''' update the indexes after an endpoint has changed. '''
+        name = endpoint.name
+        if self.get(name, None) is not endpoint:
+            return
+        if self._keys.get(name, None) != self._index_keys(endpoint):
+            self._remove(name)
+            self._add(name, endpoint)
+        self._changed()
+
+    @contextmanager
+    def rollback_on_error(self):
+        '''
+        if the block raises, restore the state machine states (state,
+        copro_state, their next states and history) of endpoints changed in
+        it. Other changes, such as to ignore, acl_data or endpoint_data, and
+        endpoints added or removed, are not undone.
+        '''
+        if self.journal is not None:
+            yield
+            return
+        self.journal = {}
+        try:
+            yield
+        except Exception:
+            for endpoint, snapshot in self.journal.values():
+                endpoint.restore_state(snapshot)
+            raise
+        finally:
+            self.journal = None
+
+    def __setitem__(self, name, endpoint):
+        if name in self:
+            self._remove(name)
+        super(EndpointIndex, self).__setitem__(name, endpoint)
+        self._add(name, endpoint)
+        endpoint._index = self
+        self._changed()
+
+    def __delitem__(self, name):
+        endpoint = self[name]
+        self._remove(name)
+        super(EndpointIndex, self).__delitem__(name)
+        if endpoint._index is self:
+            endpoint._index = None
+        self._changed()
+
+    def pop(self, name, *default):
+        if name not in self:
+            return super(EndpointIndex, self).pop(name, *default)
+        endpoint = self[name]
+        del self[name]
+        return endpoint
+
+    def popitem(self):
+        name = next(reversed(self.keys()))
+        return (name, self.pop(name))
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, endpoint in dict(*args, **kwargs).items():
+            self[name] = endpoint
+
+    def clear(self):
+        for name in list(self.keys()):
+            del self[name]
+
+    def by_mac(self, mac):
+        ''' return endpoints with a MAC address. '''
+        return list(self._by_mac.get(mac, {}).values())
+
+    def by_ip(self, ip):
+        ''' return endpoints with an IPv4 or IPv6 address. '''
+        return list(self._by_ip.get(ip, {}).values())
+
+    def by_state(self, state):
+        ''' return endpoints in a state. '''
+        return list(self._by_state.get(state, {}).values())
+
+    def ignored(self):
+        ''' return ignored endpoints. '''
+        return list(self._ignored.values())
+
+    def check(self):
+        ''' verify the indexes match a full scan of the endpoints. '''
+        expected = EndpointIndex.__new__(EndpointIndex)
+        for index in ('_keys', '_by_mac', '_by_ip', '_by_state', '_ignored'):
+            setattr(expected, index, {})
+        for name, endpoint in self.items():
+            expected._add(name, endpoint)
+        for index in ('_keys', '_by_mac', '_by_ip', '_by_state', '_ignored'):
+            if getattr(self, index) != getattr(expected, index):
+                raise AssertionError(
+                    'Endpoint index {0} is inconsistent: {1} != {2}'.format(
+                        index, getattr(self, index), getattr(expected, index)))
+
+
 class EndpointDecoder:
 
     def __init__(self, endpoint):
         e = json.loads(endpoint)
         self.endpoint = endpoint_factory(e['name'])
+        self.encoded = endpoint
         self.endpoint.state = e['state']
-        self.endpoint.copro_state = e['copro_state']
+        self.endpoint.copro_state = e.get('copro_state', None) or 'copro_unknown'
         if 'ignore' in e:
             if e['ignore']:
                 self.endpoint.ignore = True
@@ -263,9 +643,17 @@ class EndpointDecoder:
             self.endpoint.acl_data = e['acl_data']
         else:
             self.endpoint.acl_data = []
-        self.endpoint.endpoint_data = e['endpoint_data']
+        endpoint_data = e['endpoint_data']
+        if isinstance(endpoint_data, dict):
+            endpoint_data = MachineRecord(endpoint_data)
+        self.endpoint.endpoint_data = endpoint_data
         self.endpoint.p_next_state = e['p_next_state']
         self.endpoint.p_prev_states = e['p_prev_states']
 
     def get_endpoint(self):
         return self.endpoint
+
+    def get_persisted_endpoint(self):
+        ''' return the endpoint, marked as in sync with its stored encoding. '''
+        self.endpoint.mark_persisted(self.encoded)
+        return self.endpoint
@@ -3,32 +3,162 @@
 Created on 19 February 2019
 @author: Charlie Lewis
 """
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
-import functools
+from concurrent.futures import wait
+import os
 import socket
+import time
 
 from poseidon.constants import NO_DATA
+from poseidon.helpers.stages import timed
+
+
+class OUIDatabase:
+    '''
+    MAC prefix to vendor lookup, loaded once from a nmap-mac-prefixes style
+    file and reloaded when the file changes. Prefixes are indexed as integers
+    by length, so 24-bit OUIs and longer MA-M/MA-S prefixes can be mixed and
+    the longest matching prefix wins.
+    '''
+
+    def __init__(self, lookup_path):
+        self.lookup_path = lookup_path
+        self.mtime = None
+        self.prefixes = {}
+        self.prefix_lens = []
+
+    def _load(self):
+        prefixes = {}
+        with open(self.lookup_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2 or line.startswith('#'):
+                    continue
+                prefix = fields[0].upper()
+                try:
+                    prefixes.setdefault(len(prefix), {})[int(prefix, 16)] = fields[1].strip()
+                except ValueError:
+                    continue
+        self.prefixes = prefixes
+        self.prefix_lens = sorted(prefixes, reverse=True)
+
+    def refresh(self):
+        ''' reload the prefixes if the file changed, returning False if it can't be read. '''
+        try:
+            mtime = os.stat(self.lookup_path).st_mtime
+            if mtime != self.mtime:
+                self._load()
+                self.mtime = mtime
+        except Exception:  # pragma: no cover
+            self.mtime = None
+            self.prefixes = {}
+            self.prefix_lens = []
+            return False
+        return True
+
+    def _lookup(self, mac):
+        mac = ''.join(mac.split(':')).upper()
+        for prefix_len in self.prefix_lens:
+            if prefix_len > len(mac):
+                continue
+            try:
+                vendor = self.prefixes[prefix_len].get(int(mac[:prefix_len], 16), None)
+            except ValueError:
+                return None
+            if vendor is not None:
+                return vendor
+        return None
+
+    def lookup(self, macs):
+        ''' return the vendor for each of a list of MACs. '''
+        if not self.refresh():
+            return {mac: NO_DATA for mac in macs}
+        return {mac: self._lookup(mac) for mac in macs}
+
+
+OUI_DATABASES = {}
+
+
+def get_ether_vendors(macs, lookup_path):
+    """
+    Takes a list of MAC addresses and returns a dict of their vendors.
+    """
+    oui_database = OUI_DATABASES.get(lookup_path, None)
+    if oui_database is None:
+        oui_database = OUIDatabase(lookup_path)
+        OUI_DATABASES[lookup_path] = oui_database
+    return oui_database.lookup(macs)
 
 
-@functools.lru_cache()
 def get_ether_vendor(mac, lookup_path):
     """
     Takes a MAC address and looks up and returns the vendor for it.
     """
-    mac = ''.join(mac.split(':'))[:6].upper()
-    try:
-        with open(lookup_path, 'r') as f:
-            for line in f:
-                if line.startswith(mac):
-                    return line.split()[1].strip()
-    except Exception:  # pragma: no cover
-        return NO_DATA
+    return get_ether_vendors([mac], lookup_path)[mac]
 
 
 class DNSResolver:
+    '''
+    resolve reverse DNS for IPs on a long lived worker pool, caching results
+    (and failures, for a shorter time) in a size bounded LRU cache.
+
+    In non-blocking mode, resolve_ips() only returns cached results (even if
+    expired, while they are refreshed) and NO_DATA for IPs still being looked
+    up; lookups finished since the last call are available from
+    pop_resolved().
+    '''
 
     TIMEOUT = 5
 
+    def __init__(self, max_workers=8, cache_size=4096, ttl=3600, negative_ttl=300, blocking=True):
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.blocking = blocking
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.resolved = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='rdns')
+
+    def _cache_get(self, ip, now):
+        ''' return the cached result for an IP, and whether it is still fresh. '''
+        cached = self.cache.get(ip, None)
+        if cached is None:
+            return (None, False)
+        result, expiry = cached
+        self.cache.move_to_end(ip)
+        return (result, expiry >= now)
+
+    def _cache_set(self, ip, result, now):
+        ttl = self.ttl
+        if result == NO_DATA:
+            ttl = self.negative_ttl
+        self.cache[ip] = (result, now + ttl)
+        self.cache.move_to_end(ip)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _collect_pending(self, now):
+        for ip, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[ip]
+                try:
+                    result = future.result()
+                except Exception:  # pragma: no cover
+                    result = NO_DATA
+                self._cache_set(ip, result, now)
+                self.resolved[ip] = result
+
+    def pop_resolved(self):
+        ''' return lookups finished since the last call, and reset them. '''
+        now = time.time()
+        self._collect_pending(now)
+        resolved = self.resolved
+        self.resolved = {}
+        return resolved
+
     def _resolve_ip(self, ip):
         try:
             result = socket.getnameinfo((ip, 0), 0)[0]
@@ -38,6 +168,26 @@ class DNSResolver:
         except socket.gaierror:
             return NO_DATA
 
+    @timed('resolve_ips')
     def resolve_ips(self, ips):
-        with ThreadPoolExecutor() as executor:
-            return {ip: result for ip, result in zip(ips, executor.map(self._resolve_ip, list(ips)))}
+        now = time.time()
+        self._collect_pending(now)
+        results = {}
+        for ip in ips:
+            result, fresh = self._cache_get(ip, now)
+            if not fresh and ip not in self.pending:
+                self.pending[ip] = self.executor.submit(self._resolve_ip, ip)
+            # in non-blocking mode, expired results are used until refreshed.
+            if fresh or not self.blocking:
+                results[ip] = result
+        if self.blocking:
+            wait([self.pending[ip] for ip in ips if ip in self.pending],
+                 timeout=self.TIMEOUT)
+            self._collect_pending(time.time())
+            for ip in ips:
+                if ip not in results:
+                    results[ip], _ = self._cache_get(ip, now)
+        for ip in ips:
+            if results.get(ip, None) is None:
+                results[ip] = NO_DATA
+        return results
@@ -7,8 +7,27 @@ import logging
 import socket
 from binascii import hexlify
 
+from prometheus_client import Counter
 from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
 from prometheus_client import start_http_server
+from prometheus_client.core import GaugeMetricFamily
+
+from poseidon.constants import NO_DATA
+from poseidon.helpers.endpoint import MACHINE_IP_FIELDS
+
+
+def ip2int(ip):
+    ''' convert ip quad octet string to an int '''
+    if not ip or ip in ['None', '::']:
+        res = 0
+    elif ':' in ip:
+        res = int(hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
+    else:
+        o = list(map(int, ip.split('.')))
+        res = (16777216 * o[0]) + (65536 * o[1]) + (256 * o[2]) + o[3]
+    return res
 
 
 class Prometheus():
@@ -18,56 +37,39 @@ class Prometheus():
         self.prom_metrics = {}
 
     def initialize_metrics(self):
-        self.prom_metrics['inactive'] = Gauge('poseidon_endpoint_inactive',
-                                              'Number of endpoints that are inactive')
-        self.prom_metrics['active'] = Gauge('poseidon_endpoint_active',
-                                            'Number of endpoints that are active')
-        self.prom_metrics['behavior'] = Gauge('poseidon_endpoint_behavior',
-                                              'Behavior of an endpoint, 0 is normal, 1 is abnormal',
-                                              ['ipv4',
-                                               'mac',
-                                               'tenant',
-                                               'segment',
-                                               'port',
-                                               'role',
-                                               'ipv4_os',
-                                               'source'])
-        self.prom_metrics['ipv4_table'] = Gauge('poseidon_endpoint_ip_table',
-                                                'IP Table',
-                                                ['mac',
-                                                 'tenant',
-                                                 'segment',
-                                                 'port',
-                                                 'role',
-                                                 'ipv4_os',
-                                                 'hash_id',
-                                                 'source'])
-        self.prom_metrics['roles'] = Gauge('poseidon_endpoint_roles',
-                                           'Number of endpoints by role',
-                                           ['source',
-                                            'role'])
-        self.prom_metrics['oses'] = Gauge('poseidon_endpoint_oses',
-                                          'Number of endpoints by OS',
-                                          ['source',
-                                           'ipv4_os'])
-        self.prom_metrics['current_states'] = Gauge('poseidon_endpoint_current_states',
-                                                    'Number of endpoints by current state',
-                                                    ['source',
-                                                     'current_state'])
-        self.prom_metrics['vlans'] = Gauge('poseidon_endpoint_vlans',
-                                           'Number of endpoints by VLAN',
-                                           ['source',
-                                            'tenant'])
-        self.prom_metrics['sources'] = Gauge('poseidon_endpoint_sources',
-                                             'Number of endpoints by record source',
-                                             ['source'])
-        self.prom_metrics['port_tenants'] = Gauge('poseidon_endpoint_port_tenants',
-                                                  'Number of tenants by port',
-                                                  ['port',
-                                                   'tenant'])
-        self.prom_metrics['port_hosts'] = Gauge('poseidon_endpoint_port_hosts',
-                                                'Number of hosts by port',
-                                                ['port'])
+        self.prom_metrics['endpoints_stored'] = Counter('poseidon_endpoints_stored',
+                                                        'Number of endpoints considered for storing in Redis, by whether they were written or skipped as unchanged',
+                                                        ['result'])
+        self.prom_metrics['endpoint_store_flush_time'] = Histogram('poseidon_endpoint_store_flush_seconds',
+                                                                   'Time taken to flush changed endpoints to Redis')
+        self.prom_metrics['mac_history_evictions'] = Counter('poseidon_mac_history_evictions',
+                                                             'Number of MAC learn records evicted from the bounded per MAC history')
+        self.prom_metrics['event_queue_depth'] = Gauge('poseidon_event_queue_depth',
+                                                       'Number of messages waiting to be processed, by queue',
+                                                       ['queue'])
+        self.prom_metrics['dispatch_latency'] = Histogram('poseidon_dispatch_latency_seconds',
+                                                          'Time messages and jobs waited before the main loop handled them, by queue',
+                                                          ['queue'],
+                                                          buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60))
+        self.prom_metrics['faucet_events_coalesced'] = Counter('poseidon_faucet_events_coalesced',
+                                                               'Number of FAUCET events superseded by a later event before being processed')
+        self.prom_metrics['faucet_events_dropped'] = Counter('poseidon_faucet_events_dropped',
+                                                             'Number of FAUCET events dropped because the event buffer was full')
+        self.prom_metrics['rabbit_consumer_lag'] = Gauge('poseidon_rabbitmq_consumer_lag',
+                                                         'Number of messages waiting in a RabbitMQ queue for Poseidon to consume',
+                                                         ['exchange',
+                                                          'queue'])
+        self.prom_metrics['rabbit_reconnects'] = Counter('poseidon_rabbitmq_reconnects',
+                                                         'Number of attempts to reconnect the RabbitMQ consumer')
+        self.prom_metrics['stage_time'] = Histogram('poseidon_stage_seconds',
+                                                    'Time taken by each stage of the main loop, and by routing key for RabbitMQ message handling',
+                                                    ['stage',
+                                                     'routing_key'],
+                                                    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30))
+        self.prom_metrics['stage_errors'] = Counter('poseidon_stage_errors',
+                                                    'Number of times a stage of the main loop raised an exception',
+                                                    ['stage',
+                                                     'routing_key'])
         self.prom_metrics['last_rabbitmq_routing_key_time'] = Gauge('last_rabbitmq_routing_key_time',
                                                                     'Epoch time when last received a RabbitMQ message',
                                                                     ['routing_key'])
@@ -92,146 +94,187 @@ class Prometheus():
                    'actives': 0}
         return metrics
 
-    def update_metrics(self, hosts):
+    def register_endpoint_collector(self, get_endpoints, series_limit=0,
+                                    aggregate_only=False, registry=REGISTRY):
+        ''' report endpoint metrics from get_endpoints() on each scrape. '''
+        collector = EndpointCollector(
+            get_endpoints, series_limit=series_limit,
+            aggregate_only=aggregate_only)
+        registry.register(collector)
+        self.endpoint_collector = collector
+        return collector
+
+    @staticmethod
+    def start(port=9304):
+        start_http_server(port)
+
+
+class EndpointCollector():
+    '''
+    collect endpoint metrics from the endpoints held in memory, when
+    Prometheus scrapes. Series are built fresh on each scrape, so labels for
+    endpoints that have gone away are not left behind.
+
+    Each active endpoint gets its own behavior and IP table series. At most
+    series_limit endpoints (0 for no limit) are reported this way, abnormal
+    ones first, and with aggregate_only none are; the rest only count
+    towards the aggregates.
+    '''
 
-        def ip2int(ip):
-            ''' convert ip quad octet string to an int '''
-            if not ip or ip in ['None', '::']:
-                res = 0
-            elif ':' in ip:
-                res = int(hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
-            else:
-                o = list(map(int, ip.split('.')))
-                res = (16777216 * o[0]) + (65536 * o[1]) + (256 * o[2]) + o[3]
-            return res
+    BEHAVIOR_LABELS = ['ipv4', 'mac', 'tenant', 'segment',
+                       'port', 'role', 'ipv4_os', 'source']
+    IPV4_TABLE_LABELS = ['mac', 'tenant', 'segment', 'port',
+                         'role', 'ipv4_os', 'hash_id', 'source']
 
+    def __init__(self, get_endpoints, series_limit=0, aggregate_only=False):
+        self.logger = logging.getLogger('prometheus')
+        self.get_endpoints = get_endpoints
+        self.series_limit = series_limit
+        self.aggregate_only = aggregate_only
+
+    @staticmethod
+    def _families():
+        return {
+            'inactive': GaugeMetricFamily('poseidon_endpoint_inactive',
+                                          'Number of endpoints that are inactive'),
+            'active': GaugeMetricFamily('poseidon_endpoint_active',
+                                        'Number of endpoints that are active'),
+            'behavior': GaugeMetricFamily('poseidon_endpoint_behavior',
+                                          'Behavior of an endpoint, 0 is normal, 1 is abnormal',
+                                          labels=EndpointCollector.BEHAVIOR_LABELS),
+            'ipv4_table': GaugeMetricFamily('poseidon_endpoint_ip_table',
+                                            'IP Table',
+                                            labels=EndpointCollector.IPV4_TABLE_LABELS),
+            'roles': GaugeMetricFamily('poseidon_endpoint_roles',
+                                       'Number of endpoints by role',
+                                       labels=['source', 'role']),
+            'oses': GaugeMetricFamily('poseidon_endpoint_oses',
+                                      'Number of endpoints by OS',
+                                      labels=['source', 'ipv4_os']),
+            'current_states': GaugeMetricFamily('poseidon_endpoint_current_states',
+                                                'Number of endpoints by current state',
+                                                labels=['source', 'current_state']),
+            'vlans': GaugeMetricFamily('poseidon_endpoint_vlans',
+                                       'Number of endpoints by VLAN',
+                                       labels=['source', 'tenant']),
+            'sources': GaugeMetricFamily('poseidon_endpoint_sources',
+                                         'Number of endpoints by record source',
+                                         labels=['source']),
+            'port_tenants': GaugeMetricFamily('poseidon_endpoint_port_tenants',
+                                              'Number of tenants by port',
+                                              labels=['port', 'tenant']),
+            'port_hosts': GaugeMetricFamily('poseidon_endpoint_port_hosts',
+                                            'Number of hosts by port',
+                                            labels=['port']),
+            'series': GaugeMetricFamily('poseidon_endpoint_series',
+                                        'Number of per endpoint series reported'),
+            'series_omitted': GaugeMetricFamily('poseidon_endpoint_series_omitted',
+                                                'Number of active endpoints left out of the per endpoint series')}
+
+    @staticmethod
+    def host(endpoint):
+        ''' summarize an endpoint with the fields the API reports for it. '''
+        endpoint_data = endpoint.endpoint_data or {}
+        metadata = endpoint.metadata or {}
+        host = {'id': endpoint.name,
+                'state': endpoint.state,
+                'active': endpoint_data.get('active', 0),
+                'source': endpoint_data.get('source', NO_DATA),
+                'mac': endpoint_data.get('mac', 0),
+                'tenant': endpoint_data.get('tenant', 0),
+                'segment': endpoint_data.get('segment', 0),
+                'port': endpoint_data.get('port', 0),
+                'ipv4': endpoint_data.get('ipv4', 0),
+                'role': NO_DATA,
+                'behavior': 0}
+        for ip_field in MACHINE_IP_FIELDS:
+            ip_addresses = metadata.get('_'.join((ip_field, 'addresses')), {})
+            ip_info = ip_addresses.get(endpoint_data.get(ip_field, None), {})
+            host['_'.join((ip_field, 'os'))] = ip_info.get('os', NO_DATA)
+        timestamps = metadata.get('mac_addresses', {}).get(host['mac'], {})
+        if timestamps:
+            newest = timestamps[sorted(timestamps)[-1]]
+            labels = newest.get('labels', None)
+            if labels:
+                host['role'] = labels[0]
+            if newest.get('behavior', '').lower() == 'abnormal':
+                host['behavior'] = 1
+        return host
+
+    def select_series_hosts(self, hosts):
+        ''' pick which active hosts get per endpoint series. '''
+        if self.aggregate_only:
+            return []
+        if self.series_limit and len(hosts) > self.series_limit:
+            # stable across scrapes, so series don't come and go.
+            hosts = sorted(hosts, key=lambda host: (-host['behavior'], host['id']))
+            return hosts[:self.series_limit]
+        return hosts
+
+    def describe(self):
+        return list(self._families().values())
+
+    def collect(self):
+        families = self._families()
         metrics = Prometheus.get_metrics()
-        for host in hosts:
-            if host['active'] == 0:
-                metrics['inactives'] += 1
-            if host['active'] == 1:
-                metrics['actives'] += 1
-            if (host['source'], host['role']) in metrics['roles']:
-                if host['active'] == 1:
-                    metrics['roles'][(host['source'],
-                                      host['role'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['roles'][(host['source'], host['role'])] = 1
-                else:
-                    metrics['roles'][(host['source'], host['role'])] = 0
-
-            if (host['source'], host['ipv4_os']) in metrics['oses']:
-                if host['active'] == 1:
-                    metrics['oses'][(host['source'], host['ipv4_os'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['oses'][(host['source'], host['ipv4_os'])] = 1
-                else:
-                    metrics['oses'][(host['source'], host['ipv4_os'])] = 0
-
-            if (host['source'], host['state']) in metrics['current_states']:
-                if host['active'] == 1:
-                    metrics['current_states'][(host['source'],
-                                               host['state'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['current_states'][(host['source'],
-                                               host['state'])] = 1
-                else:
-                    metrics['current_states'][(host['source'],
-                                               host['state'])] = 0
-
-            if (host['source'], host['tenant']) in metrics['vlans']:
-                if host['active'] == 1:
-                    metrics['vlans'][(host['source'],
-                                      host['tenant'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['vlans'][(host['source'],
-                                      host['tenant'])] = 1
-                else:
-                    metrics['vlans'][(host['source'],
-                                      host['tenant'])] = 0
-
-            if (host['source']) in metrics['sources']:
-                if host['active'] == 1:
-                    metrics['sources'][(host['source'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['sources'][(host['source'])] = 1
-                else:
-                    metrics['sources'][(host['source'])] = 0
-
-            if (host['port'], host['tenant']) in metrics['port_tenants']:
-                if host['active'] == 1:
-                    metrics['port_tenants'][(
-                        host['port'], host['tenant'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['port_tenants'][(host['port'], host['tenant'])] = 1
-                else:
-                    metrics['port_tenants'][(host['port'], host['tenant'])] = 0
-
-            if (host['port']) in metrics['port_hosts']:
-                if host['active'] == 1:
-                    metrics['port_hosts'][(host['port'])] += 1
-            else:
-                if host['active'] == 1:
-                    metrics['port_hosts'][(host['port'])] = 1
-                else:
-                    metrics['port_hosts'][(host['port'])] = 0
+        try:
+            endpoints = list(self.get_endpoints())
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to get endpoints for Prometheus because {0}'.format(str(e)))
+            endpoints = []
 
+        def count(metric, key, active):
+            metrics[metric][key] = metrics[metric].get(key, 0) + active
+
+        active_hosts = []
+        for endpoint in endpoints:
             try:
-                if host['active'] == 1:
-                    self.prom_metrics['behavior'].labels(ipv4=host['ipv4'],
-                                                         mac=host['mac'],
-                                                         tenant=host['tenant'],
-                                                         segment=host['segment'],
-                                                         port=host['port'],
-                                                         role=host['role'],
-                                                         ipv4_os=host['ipv4_os'],
-                                                         source=host['source']).set(host['behavior'])
-                    self.prom_metrics['ipv4_table'].labels(mac=host['mac'],
-                                                           tenant=host['tenant'],
-                                                           segment=host['segment'],
-                                                           port=host['port'],
-                                                           role=host['role'],
-                                                           ipv4_os=host['ipv4_os'],
-                                                           hash_id=host['id'],
-                                                           source=host['source']).set(ip2int(host['ipv4']))
+                host = self.host(endpoint)
+                active = 1 if host['active'] == 1 else 0
+                if active:
+                    metrics['actives'] += 1
+                else:
+                    metrics['inactives'] += 1
+                source = str(host['source'])
+                tenant = str(host['tenant'])
+                port = str(host['port'])
+                count('roles', (source, str(host['role'])), active)
+                count('oses', (source, str(host['ipv4_os'])), active)
+                count('current_states', (source, str(host['state'])), active)
+                count('vlans', (source, tenant), active)
+                count('sources', (source,), active)
+                count('port_tenants', (port, tenant), active)
+                count('port_hosts', (port,), active)
+                if active:
+                    active_hosts.append(host)
             except Exception as e:  # pragma: no cover
                 self.logger.error(
-                    'Unable to send {0} results to prometheus because {1}'.format(host, str(e)))
+                    'Unable to send {0} results to prometheus because {1}'.format(endpoint.name, str(e)))
 
-        try:
-            for role in metrics['roles']:
-                self.prom_metrics['roles'].labels(source=role[0],
-                                                  role=role[1]).set(metrics['roles'][role])
-            for os_t in metrics['oses']:
-                self.prom_metrics['oses'].labels(source=os_t[0],
-                                                 ipv4_os=os_t[1]).set(metrics['oses'][os_t])
-            for current_state in metrics['current_states']:
-                self.prom_metrics['current_states'].labels(source=current_state[0],
-                                                           current_state=current_state[1]).set(metrics['current_states'][current_state])
-            for vlan in metrics['vlans']:
-                self.prom_metrics['vlans'].labels(source=vlan[0],
-                                                  tenant=vlan[1]).set(metrics['vlans'][vlan])
-            for source in metrics['sources']:
-                self.prom_metrics['sources'].labels(source=source).set(
-                    metrics['sources'][source])
-            for port_tenant in metrics['port_tenants']:
-                self.prom_metrics['port_tenants'].labels(port=port_tenant[0],
-                                                         tenant=port_tenant[1]).set(metrics['port_tenants'][port_tenant])
-            for port_host in metrics['port_hosts']:
-                self.prom_metrics['port_hosts'].labels(
-                    port=port_host).set(metrics['port_hosts'][port_host])
-            self.prom_metrics['inactive'].set(metrics['inactives'])
-            self.prom_metrics['active'].set(metrics['actives'])
-        except Exception as e:  # pragma: no cover
-            self.logger.error(
-                'Unable to send results to prometheus because {0}'.format(str(e)))
+        series = 0
+        series_hosts = self.select_series_hosts(active_hosts)
+        for host in series_hosts:
+            try:
+                families['behavior'].add_metric(
+                    [str(host[label]) for label in self.BEHAVIOR_LABELS],
+                    host['behavior'])
+                families['ipv4_table'].add_metric(
+                    [str(host['id' if label == 'hash_id' else label])
+                     for label in self.IPV4_TABLE_LABELS],
+                    ip2int(host['ipv4']))
+                series += 2
+            except Exception as e:  # pragma: no cover
+                self.logger.error(
+                    'Unable to send {0} results to prometheus because {1}'.format(host['id'], str(e)))
 
-    @staticmethod
-    def start(port=9304):
-        start_http_server(port)
+        for metric in ('roles', 'oses', 'current_states', 'vlans',
+                       'sources', 'port_tenants', 'port_hosts'):
+            for labels, value in metrics[metric].items():
+                families[metric].add_metric(list(labels), value)
+        families['inactive'].add_metric([], metrics['inactives'])
+        families['active'].add_metric([], metrics['actives'])
+        families['series'].add_metric([], series)
+        families['series_omitted'].add_metric(
+            [], len(active_hosts) - len(series_hosts))
+        return list(families.values())
@@ -3,12 +3,16 @@
 Created on 21 August 2017
 @author: dgrossman
 """
+import asyncio
+import collections
 import logging
+import queue
 import threading
 import time
 from functools import partial
 
 import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
 
 
 class Rabbit(object):
@@ -74,11 +78,393 @@ class Rabbit(object):
 
         return rabbit_channel, rabbit_connection, do_rabbit
 
-    def start_channel(self, channel, mycallback, queue, m_queue):
+    def start_channel(self, channel, mycallback, queue, m_queue, prefetch_count=0):
         ''' handle threading for messagetype '''
         self.logger.debug(
             'about to start channel {0}'.format(channel))
+        if prefetch_count:
+            channel.basic_qos(prefetch_count=prefetch_count)
         channel.basic_consume(queue, partial(mycallback, q=m_queue))
         mq_recv_thread = threading.Thread(target=channel.start_consuming)
         mq_recv_thread.start()
         return mq_recv_thread
+
+    def ack_messages(self, channel, delivery_tag):
+        '''
+        ack all messages on a channel up to delivery_tag. The ack is sent
+        from the thread consuming the channel, as pika channels aren't
+        thread safe.
+        '''
+        try:
+            connection = channel.connection
+            # asynchronous connections hand callbacks to their IO loop.
+            add_callback = getattr(
+                connection, 'add_callback_threadsafe', None)
+            if add_callback is None:
+                ioloop = connection.ioloop
+                add_callback = getattr(
+                    ioloop, 'add_callback_threadsafe', None) or ioloop.call_soon_threadsafe
+            add_callback(partial(self._ack, channel, delivery_tag))
+        except Exception as e:  # pragma: no cover
+            self.logger.warning(
+                'Unable to ack rabbitmq messages up to {0} because: {1}'.format(
+                    delivery_tag, str(e)))
+
+    def _ack(self, channel, delivery_tag):
+        # delivery tags don't survive the channel, so after a reconnect
+        # the broker redelivers instead.
+        if channel.is_open:
+            channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+
+
+class RabbitConsumer(object):
+    '''
+    Asynchronous RabbitMQ consumer. All bindings share one connection, each
+    on its own channel, and are serviced by an IO loop on a background
+    thread. A lost connection is retried with exponential backoff, and the
+    number of messages waiting in each queue is polled to report consumer
+    lag. While the callback raises queue.Full, messages are held and
+    consuming is paused.
+    '''
+
+    # seconds between attempts to hand held messages to the callback.
+    held_retry_interval = 0.1
+
+    def __init__(self, host, port, callback, prefetch_count=0, backoff=1,
+                 max_backoff=60, lag_interval=15,
+                 connection_cl=pika.SelectConnection):
+        self.logger = logging.getLogger('rabbit')
+        self.host = host
+        self.port = port
+        self.callback = callback
+        self.prefetch_count = prefetch_count
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lag_interval = lag_interval
+        self.connection_cl = connection_cl
+        self.connection = None
+        self.bindings = []
+        self.channels = {}
+        # (exchange, queue) -> consumer tag, or None while paused.
+        self.consumer_tags = {}
+        # messages the callback had no room for, in delivery order.
+        self.held = collections.deque()
+        # (exchange, queue) -> messages waiting in the broker.
+        self.lag = {}
+        self.reconnects = 0
+        self.delay = backoff
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def add_binding(self, exchange, queue_name, keys, exchange_type='topic'):
+        ''' consume from queue_name, bound to exchange with routing keys. '''
+        if isinstance(keys, str):
+            keys = [keys]
+        self.bindings.append((exchange, queue_name, keys, exchange_type))
+
+    def start(self):
+        ''' start consuming on a background thread, without waiting to connect. '''
+        self.thread = threading.Thread(
+            target=self.run, name='rabbit_consumer', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self, timeout=5):
+        ''' close the connection and wait for the consumer thread to exit. '''
+        self.stopping.set()
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._close)
+            except Exception as e:  # pragma: no cover
+                self.logger.debug(
+                    'Unable to close rabbitmq connection: {0}'.format(str(e)))
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def run(self):
+        ''' connect and run the IO loop, reconnecting until stopped. '''
+        while not self.stopping.is_set():
+            self.connection = self.connection_cl(
+                pika.ConnectionParameters(host=self.host, port=self.port),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed)
+            self.connection.ioloop.start()
+            if self.stopping.is_set():
+                break
+            self.logger.debug('reconnecting to {0} rabbitmq in {1}s'.format(
+                self.host, self.delay))
+            self.reconnects += 1
+            self.stopping.wait(self.delay)
+            self.delay = min(self.delay * 2, self.max_backoff)
+        self.connection = None
+
+    def _close(self):
+        connection = self.connection
+        if connection is None:
+            return
+        if connection.is_open:
+            connection.close()
+        elif not connection.is_closing:
+            self._connection_done(connection)
+
+    def _connection_done(self, connection):
+        connection.ioloop.stop()
+
+    def _on_connection_open(self, connection):
+        self.logger.debug('consumer connected to {0} rabbitmq'.format(self.host))
+        self.delay = self.backoff
+        for binding in self.bindings:
+            connection.channel(
+                on_open_callback=partial(self._on_channel_open, binding))
+        if self.lag_interval:
+            connection.ioloop.call_later(self.lag_interval, self._poll_lag)
+
+    def _on_connection_error(self, connection, err):
+        self.logger.debug(
+            'waiting for connection to {0} rabbitmq: {1}'.format(self.host, str(err)))
+        self._connection_done(connection)
+
+    def _on_connection_closed(self, connection, reason):
+        self.channels = {}
+        # held messages are redelivered on the next connection.
+        self.consumer_tags = {}
+        self.held.clear()
+        if not self.stopping.is_set():
+            self.logger.warning(
+                'Lost connection to {0} rabbitmq: {1}'.format(self.host, str(reason)))
+        self._connection_done(connection)
+
+    def _on_channel_open(self, binding, channel):
+        exchange, queue_name, _, exchange_type = binding
+        self.channels[(exchange, queue_name)] = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.exchange_declare(
+            exchange=exchange, exchange_type=exchange_type,
+            callback=partial(self._on_exchange_declared, binding, channel))
+
+    def _on_channel_closed(self, channel, reason):
+        # the broker closed a channel, so start over on a new connection.
+        connection = self.connection
+        if connection is not None and connection.is_open and not self.stopping.is_set():
+            self.logger.warning(
+                'rabbitmq channel {0} closed: {1}'.format(channel, str(reason)))
+            connection.close()
+
+    def _on_exchange_declared(self, binding, channel, _frame):
+        _, queue_name, _, _ = binding
+        channel.queue_declare(
+            queue=queue_name, exclusive=False, durable=True,
+            callback=partial(self._on_queue_declared, binding, channel))
+
+    def _on_queue_declared(self, binding, channel, frame):
+        exchange, queue_name, keys, _ = binding
+        self._record_lag(exchange, queue_name, frame)
+        # pika queues the RPCs, so these go out in order.
+        for key in keys:
+            self.logger.debug(
+                'adding key:{0} to rabbitmq channel'.format(key))
+            channel.queue_bind(queue_name, exchange, routing_key=key)
+        if self.prefetch_count:
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+        if self.held:
+            self.consumer_tags[(exchange, queue_name)] = None
+        else:
+            self._consume(exchange, queue_name, channel)
+
+    def _consume(self, exchange, queue_name, channel):
+        self.consumer_tags[(exchange, queue_name)] = channel.basic_consume(
+            queue_name, self._on_message)
+
+    def _on_message(self, channel, method, properties, body):
+        '''
+        pass a message to the callback. If the callback has no room for it
+        (it raises queue.Full), hold it and stop consuming until there is
+        room, rather than blocking the IO loop.
+        '''
+        if not self.held:
+            try:
+                self.callback(channel, method, properties, body)
+                return
+            except queue.Full:
+                self._pause()
+        self.held.append((channel, method, properties, body))
+
+    def _pause(self):
+        self.logger.debug('event queue is full, pausing rabbitmq consumer')
+        for (exchange, queue_name), consumer_tag in self.consumer_tags.items():
+            channel = self.channels.get((exchange, queue_name), None)
+            if consumer_tag is not None and channel is not None and channel.is_open:
+                channel.basic_cancel(consumer_tag)
+            self.consumer_tags[(exchange, queue_name)] = None
+        self.connection.ioloop.call_later(
+            self.held_retry_interval, self._retry_held)
+
+    def _retry_held(self):
+        connection = self.connection
+        if connection is None or not connection.is_open or not self.held:
+            return
+        while self.held:
+            try:
+                self.callback(*self.held[0])
+            except queue.Full:
+                connection.ioloop.call_later(
+                    self.held_retry_interval, self._retry_held)
+                return
+            self.held.popleft()
+        self.logger.debug('resuming rabbitmq consumer')
+        for (exchange, queue_name), consumer_tag in list(self.consumer_tags.items()):
+            channel = self.channels.get((exchange, queue_name), None)
+            if consumer_tag is None and channel is not None and channel.is_open:
+                self._consume(exchange, queue_name, channel)
+
+    def _record_lag(self, exchange, queue_name, frame):
+        self.lag[(exchange, queue_name)] = frame.method.message_count
+
+    def _poll_lag(self):
+        for (exchange, queue_name), channel in list(self.channels.items()):
+            if channel.is_open:
+                channel.queue_declare(
+                    queue=queue_name, passive=True,
+                    callback=partial(self._record_lag, exchange, queue_name))
+        connection = self.connection
+        if connection is not None and connection.is_open:
+            connection.ioloop.call_later(self.lag_interval, self._poll_lag)
+
+
+class AsyncRabbitConsumer(RabbitConsumer):
+    '''
+    RabbitConsumer for a running asyncio event loop, using pika's asyncio
+    adapter instead of an IO loop on its own thread.
+    '''
+
+    def __init__(self, host, port, callback, connection_cl=AsyncioConnection, **kwargs):
+        super().__init__(host, port, callback, connection_cl=connection_cl, **kwargs)
+        self.done = None
+        self.task = None
+
+    def start(self):
+        ''' start consuming in a task on the running event loop. '''
+        self.task = asyncio.ensure_future(self.run_async())
+        return self.task
+
+    def stop(self, timeout=5):
+        ''' close the connection, or stop waiting to reconnect. '''
+        self.stopping.set()
+        connection = self.connection
+        try:
+            if connection is not None and not (connection.is_closing or connection.is_closed):
+                connection.close()
+            elif self.done is not None:
+                self.done.set()
+        except Exception as e:  # pragma: no cover
+            self.logger.debug(
+                'Unable to close rabbitmq connection: {0}'.format(str(e)))
+
+    async def run_async(self):
+        ''' connect, reconnecting until stopped. '''
+        loop = asyncio.get_running_loop()
+        while not self.stopping.is_set():
+            self.done = asyncio.Event()
+            self.connection = self.connection_cl(
+                pika.ConnectionParameters(host=self.host, port=self.port),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed,
+                custom_ioloop=loop)
+            await self.done.wait()
+            if self.stopping.is_set():
+                break
+            self.logger.debug('reconnecting to {0} rabbitmq in {1}s'.format(
+                self.host, self.delay))
+            self.reconnects += 1
+            self.done = asyncio.Event()
+            try:
+                await asyncio.wait_for(self.done.wait(), self.delay)
+            except asyncio.TimeoutError:
+                pass
+            self.delay = min(self.delay * 2, self.max_backoff)
+        self.connection = None
+
+    def _connection_done(self, connection):
+        self.done.set()
+
+
+class RabbitPublisher(object):
+    '''
+    Long lived RabbitMQ publisher. The connection and channel are reused
+    across publishes and reopened when they fail. The channel is
+    transactional, so a publish only succeeds once the broker has accepted
+    the message, and a batch is published with one round trip (tx_commit)
+    rather than waiting for each message to be confirmed.
+    '''
+
+    def __init__(self, host, port=5672, exchange='topic-poseidon-internal',
+                 exchange_type='topic', retries=1, connection_cl=pika.BlockingConnection):
+        self.logger = logging.getLogger('rabbit')
+        self.host = host
+        self.port = port
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.retries = retries
+        self.connection_cl = connection_cl
+        self.connection = None
+        self.channel = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.connection = self.connection_cl(
+            pika.ConnectionParameters(host=self.host, port=self.port))
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(
+            exchange=self.exchange, exchange_type=self.exchange_type)
+        self.channel.tx_select()
+        self.logger.debug('publisher connected to {0} rabbitmq'.format(self.host))
+
+    def _connected(self):
+        return (self.connection is not None and self.connection.is_open and
+                self.channel is not None and self.channel.is_open)
+
+    def close(self):
+        ''' close the connection, if open. '''
+        connection = self.connection
+        self.connection = None
+        self.channel = None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except Exception as e:  # pragma: no cover
+                self.logger.debug(
+                    'Unable to close rabbitmq connection: {0}'.format(str(e)))
+
+    def publish(self, routing_key, body):
+        ''' publish a message, returning True if the broker confirmed it. '''
+        return self.publish_batch([(routing_key, body)]) == 1
+
+    def publish_batch(self, messages):
+        '''
+        publish (routing_key, body) pairs in order over one channel and
+        commit them together, returning how many the broker accepted (all or
+        none). A failed batch is discarded by the broker, so the connection
+        is reopened and the whole batch published again.
+        '''
+        confirmed = 0
+        with self.lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    if not self._connected():
+                        self.close()
+                        self._connect()
+                    for routing_key, body in messages:
+                        self.channel.basic_publish(
+                            exchange=self.exchange, routing_key=routing_key, body=body)
+                    self.channel.tx_commit()
+                    confirmed = len(messages)
+                    break
+                except Exception as e:
+                    self.logger.warning(
+                        'Unable to publish to rabbitmq (attempt {0}) because: {1}'.format(
+                            attempt + 1, str(e)))
+                    self.close()
+        return confirmed
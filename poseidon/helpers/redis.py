@@ -1,21 +1,36 @@
-import ast
 import ipaddress
+import json
 import time
 from redis import StrictRedis
 
+from poseidon.helpers.codec import decode_value
+from poseidon.helpers.codec import encode_value
+from poseidon.helpers.codec import get_codec
+from poseidon.helpers.codec import get_value_codec
 from poseidon.helpers.endpoint import EndpointDecoder
 from poseidon.helpers.endpoint import HistoryTypes
 from poseidon.helpers.endpoint import MACHINE_IP_FIELDS
+from poseidon.helpers.stages import timed
+
+# endpoint_data fields that reverse lookups are keyed by.
+REVERSE_INDEX_FIELDS = frozenset(('mac',) + tuple(MACHINE_IP_FIELDS))
 
 
 class PoseidonRedisClient:
 
-    def __init__(self, logger, host='redis', port=6379, db=0):
+    def __init__(self, logger, host='redis', port=6379, db=0,
+                 pipeline_chunk_size=1000, codec='json'):
         self.logger = logger
         self.host = host
         self.port = port
         self.db = db
+        self.pipeline_chunk_size = pipeline_chunk_size
+        self.codec = get_codec(codec)
         self.r = None
+        self.stored_endpoint_names = None
+        self.updated_metadata_keys = set()
+        self.store_counts = {'written': 0, 'skipped': 0}
+        self.flush_times = []
 
     def connect(self):
         try:
@@ -28,10 +43,12 @@ class PoseidonRedisClient:
             self.logger.error(
                 'Failed connect to Redis because: {0}'.format(str(e)))
 
-    def hmset(self, key, values):
-        str_values = {str(k): str(v) for k, v in values.items()}
+    def hmset(self, key, values, pipe=None):
+        str_values = {str(k): encode_value(v, self.codec) for k, v in values.items()}
         self.logger.debug('store key %s value %s', key, str_values)
-        self.r.hset(key, mapping=str_values)
+        if pipe is None:
+            pipe = self.r
+        pipe.hset(key, mapping=str_values)
 
     def store_p0f_result(self, data):
         # TODO: migrate to store_tool_result()
@@ -41,6 +58,7 @@ class PoseidonRedisClient:
                 # Don't overwrite with a blank result.
                 if ip_data and ip_data.get('full_os', None):
                     self.hmset('_'.join(('p0f', str(ip))), ip_data)
+                    self.updated_metadata_keys.add(str(ip))
                     valid = True
         return valid
 
@@ -62,11 +80,11 @@ class PoseidonRedisClient:
                 key = '_'.join((tool, source_mac, str(timestamp)))
                 redis_results = {poseidon_hash: results}
                 self.hmset(key, redis_results)
+                self.updated_metadata_keys.add(poseidon_hash)
                 update_list = []
                 try:
                     updates = self.r.hgetall(source_mac)
-                    update_list = ast.literal_eval(
-                        updates[b'timestamps'].decode('ascii'))
+                    update_list = decode_value(updates[b'timestamps'])
                 except KeyError:
                     pass
                 update_list.append(timestamp)
@@ -74,6 +92,7 @@ class PoseidonRedisClient:
                 redis_times = {'timestamps': update_list}
                 self.hmset(source_mac, redis_times)
 
+    @timed('get_stored_endpoints')
     def get_stored_endpoints(self):
         ''' load existing endpoints from Redis. '''
         if self.r:
@@ -81,12 +100,12 @@ class PoseidonRedisClient:
                 p_endpoints = self.r.get('p_endpoints')
                 if p_endpoints:
                     new_endpoints = {}
-                    p_endpoints = ast.literal_eval(
-                        p_endpoints.decode('ascii'))
+                    p_endpoints = decode_value(p_endpoints)
                     for p_endpoint in p_endpoints:
                         endpoint = EndpointDecoder(
-                            p_endpoint).get_endpoint()
+                            p_endpoint).get_persisted_endpoint()
                         new_endpoints[endpoint.name] = endpoint
+                    self.stored_endpoint_names = set(new_endpoints.keys())
                     return new_endpoints
             except Exception as e:  # pragma: no cover
                 self.logger.error(
@@ -99,7 +118,7 @@ class PoseidonRedisClient:
             raw_results = ml_info.get(poseidon_hash_key, None)
             if raw_results:
                 self.logger.debug('found %s by key %s' % (raw_results, poseidon_hash_key))
-                return ast.literal_eval(raw_results.decode('ascii'))
+                return decode_value(raw_results)
             return {}
 
         results = parse_raw_results(mac_info[b'poseidon_hash'])
@@ -129,7 +148,7 @@ class PoseidonRedisClient:
         if b'timestamps' in mac_info:
             raw_timestamps = mac_info[b'timestamps']
             try:
-                timestamps = ast.literal_eval(raw_timestamps.decode('ascii'))
+                timestamps = decode_value(raw_timestamps)
                 for timestamp in sorted(timestamps):
                     timestamp_str = str(timestamp)
                     # retrieve tool results by timestamp
@@ -154,7 +173,7 @@ class PoseidonRedisClient:
         try:
             poseidon_info = self.r.hgetall(mac_info[b'poseidon_hash'])
             if b'endpoint_data' in poseidon_info:
-                endpoint_data = ast.literal_eval(poseidon_info[b'endpoint_data'].decode('ascii'))
+                endpoint_data = decode_value(poseidon_info[b'endpoint_data'])
                 for ip_field in MACHINE_IP_FIELDS:
                     try:
                         raw_field = endpoint_data.get(ip_field, None)
@@ -177,6 +196,31 @@ class PoseidonRedisClient:
                 'Unable to get existing endpoint data from Redis because: {0}'.format(str(e)))
         return ip_addresses
 
+    @staticmethod
+    def hash_macs_key(hash_id):
+        ''' key of the set of MACs that have been stored for a poseidon hash. '''
+        return '_'.join(('poseidon_hash_macs', str(hash_id)))
+
+    def migrate_hash_macs(self):
+        ''' build the poseidon hash to MACs sets from existing MAC records, once. '''
+        migrated_key = 'poseidon_hash_macs_migrated'
+        if self.r:
+            try:
+                if self.r.exists(migrated_key):
+                    return False
+                pipe = self.r.pipeline(transaction=True)
+                for mac in self.r.smembers('mac_addresses'):
+                    poseidon_hash = self.r.hget(mac, 'poseidon_hash')
+                    if poseidon_hash:
+                        pipe.sadd(self.hash_macs_key(poseidon_hash.decode('ascii')), mac)
+                pipe.set(migrated_key, int(time.time()))
+                pipe.execute()
+                return True
+            except Exception as e:  # pragma: no cover
+                self.logger.error(
+                    'Unable to migrate MAC addresses in Redis because: {0}'.format(str(e)))
+        return False
+
     def get_stored_metadata(self, hash_id):
         mac_addresses = {}
         ip_addresses = {}
@@ -186,7 +230,7 @@ class PoseidonRedisClient:
         if self.r:
             macs = []
             try:
-                macs = self.r.smembers('mac_addresses')
+                macs = self.r.smembers(self.hash_macs_key(hash_id))
             except Exception as e:  # pragma: no cover
                 self.logger.error(
                     'Unable to get existing mac addresses from Redis because: {0}'.format(str(e)))
@@ -239,51 +283,174 @@ class PoseidonRedisClient:
                             prior[field['field_name']], record[field['field_name']])  # pytype: disable=unsupported-operands
                 prior = record
 
+    def store_endpoint(self, endpoint, pipe):
+        ''' queue writes for a single endpoint and its reverse lookups. '''
+        # set metadata
+        mac_addresses, ipv4_addresses, ipv6_addresses = self.get_stored_metadata(
+            str(endpoint.name))
+        self.update_history(
+            endpoint, mac_addresses, ipv4_addresses, ipv6_addresses)
+        endpoint.update_metadata({
+            'mac_addresses': mac_addresses,
+            'ipv4_addresses': ipv4_addresses,
+            'ipv6_addresses': ipv6_addresses})
+        redis_endpoint_data = {
+            'name': endpoint.name,
+            'state': endpoint.state,
+            'ignore': endpoint.ignore,
+            'endpoint_data': endpoint.endpoint_data,
+            'next_state': endpoint.p_next_state,
+            'prev_states': endpoint.p_prev_states,
+            'acl_data': endpoint.acl_data,
+            'metadata': endpoint.metadata,
+        }
+        self.hmset(endpoint.name, redis_endpoint_data, pipe=pipe)
+        # reverse lookups only change with the addresses they index.
+        if endpoint.persisted_encoding() is not None and \
+                not REVERSE_INDEX_FIELDS.intersection(endpoint.changed_fields):
+            return endpoint.encode()
+        mac = endpoint.endpoint_data['mac']
+        self.hmset(mac, {'poseidon_hash': endpoint.name}, pipe=pipe)
+        # sadd is idempotent, so there is no need to check membership first.
+        pipe.sadd('mac_addresses', mac)
+        pipe.sadd(self.hash_macs_key(endpoint.name), mac)
+        for ip_field in MACHINE_IP_FIELDS:
+            try:
+                machine_ip = ipaddress.ip_address(
+                    endpoint.endpoint_data.get(ip_field, None))
+            except ValueError:
+                machine_ip = None
+            if machine_ip:
+                self.hmset(str(machine_ip), {'poseidon_hash': endpoint.name}, pipe=pipe)
+                pipe.sadd('ip_addresses', str(machine_ip))
+        return endpoint.encode()
+
+    def _metadata_updated(self, endpoint):
+        ''' return True if tool results for the endpoint arrived since it was last stored. '''
+        if not self.updated_metadata_keys:
+            return False
+        if endpoint.name in self.updated_metadata_keys:
+            return True
+        endpoint_data = endpoint.endpoint_data or {}
+        for ip_field in MACHINE_IP_FIELDS:
+            if str(endpoint_data.get(ip_field, None)) in self.updated_metadata_keys:
+                return True
+        return False
+
+    @timed('store_endpoints')
     def store_endpoints(self, endpoints):
-        ''' store current endpoints in Redis. '''
+        '''
+        store changed endpoints in Redis.
+
+        Writes are batched into MULTI/EXEC pipelines of at most
+        pipeline_chunk_size endpoints each (or one pipeline, if the chunk
+        size is 0), so readers never see a partially written endpoint.
+        '''
+        written = 0
+        skipped = 0
         if self.r:
             try:
+                start_time = time.time()
                 serialized_endpoints = []
+                pipe = self.r.pipeline(transaction=True)
+                pipe_endpoints = []
+                pipelines = 0
                 for endpoint in endpoints.values():
-                    # set metadata
-                    mac_addresses, ipv4_addresses, ipv6_addresses = self.get_stored_metadata(
-                        str(endpoint.name))
-                    self.update_history(
-                        endpoint, mac_addresses, ipv4_addresses, ipv6_addresses)
-                    endpoint.metadata = {
-                        'mac_addresses': mac_addresses,
-                        'ipv4_addresses': ipv4_addresses,
-                        'ipv6_addresses': ipv6_addresses}
-                    redis_endpoint_data = {
-                        'name': endpoint.name,
-                        'state': endpoint.state,
-                        'ignore': endpoint.ignore,
-                        'endpoint_data': endpoint.endpoint_data,
-                        'next_state': endpoint.p_next_state,
-                        'prev_states': endpoint.p_prev_states,
-                        'acl_data': endpoint.acl_data,
-                        'metadata': endpoint.metadata,
-                    }
-                    self.hmset(endpoint.name, redis_endpoint_data)
-                    mac = endpoint.endpoint_data['mac']
-                    self.hmset(mac, {'poseidon_hash': endpoint.name})
-                    if not self.r.sismember('mac_addresses', mac):
-                        self.r.sadd('mac_addresses', mac)
-                    for ip_field in MACHINE_IP_FIELDS:
-                        try:
-                            machine_ip = ipaddress.ip_address(
-                                endpoint.endpoint_data.get(ip_field, None))
-                        except ValueError:
-                            machine_ip = None
-                        if machine_ip:
-                            self.hmset(str(machine_ip), {'poseidon_hash': endpoint.name})
-                            if not self.r.sismember('ip_addresses', str(machine_ip)):
-                                self.r.sadd('ip_addresses', str(machine_ip))
-                    serialized_endpoints.append(endpoint.encode())
-                self.r.set('p_endpoints', str(serialized_endpoints))
+                    if endpoint.is_dirty() or self._metadata_updated(endpoint):
+                        encoded = self.store_endpoint(endpoint, pipe)
+                        pipe_endpoints.append((endpoint, encoded))
+                        written += 1
+                        if self.pipeline_chunk_size and len(pipe_endpoints) >= self.pipeline_chunk_size:
+                            self._execute_store_pipeline(pipe, pipe_endpoints)
+                            pipelines += 1
+                            pipe_endpoints = []
+                    else:
+                        encoded = endpoint.persisted_encoding()
+                        skipped += 1
+                    serialized_endpoints.append(encoded)
+                endpoint_names = set(endpoints.keys())
+                if written or endpoint_names != self.stored_endpoint_names:
+                    pipe.set('p_endpoints', encode_value(serialized_endpoints, self.codec))
+                    self._execute_store_pipeline(pipe, pipe_endpoints)
+                    pipelines += 1
+                    self.stored_endpoint_names = endpoint_names
+                self.updated_metadata_keys = set()
+                if pipelines:
+                    flush_time = time.time() - start_time
+                    self.flush_times.append(flush_time)
+                    self.logger.debug('flushed {0} endpoints in {1} pipelines ({2:.3f} sec)'.format(
+                        written, pipelines, flush_time))
             except Exception as e:  # pragma: no cover
                 self.logger.error(
                     'Unable to store endpoints in Redis because {0}'.format(str(e)))
+        self.store_counts['written'] += written
+        self.store_counts['skipped'] += skipped
+        self.logger.debug(
+            'stored {0} changed endpoints, skipped {1} unchanged'.format(written, skipped))
+        return (written, skipped)
+
+    @staticmethod
+    def _execute_store_pipeline(pipe, pipe_endpoints):
+        pipe.execute()
+        # only consider endpoints stored, once Redis has them.
+        for endpoint, encoded in pipe_endpoints:
+            endpoint.mark_persisted(encoded)
+            # metadata is read before the store indexes the endpoint's MAC,
+            # so a new MAC's metadata is picked up by storing it again.
+            endpoint_data = endpoint.endpoint_data or {}
+            if endpoint_data.get('mac', None) not in endpoint.metadata.get('mac_addresses', {}):
+                endpoint.mark_dirty()
+
+    def _migrate_value(self, raw):
+        ''' return raw re-encoded with the current codec, or None if already current. '''
+        if get_value_codec(raw) is self.codec:
+            return None
+        try:
+            value = decode_value(raw)
+        except (ValueError, SyntaxError, TypeError):
+            # not a structured value (e.g. a plain string).
+            return None
+        if not isinstance(value, (dict, list, tuple)):
+            return None
+        return encode_value(value, self.codec)
+
+    def migrate_codec(self):
+        '''
+        re-encode structured values stored by Poseidon (including legacy
+        Python reprs) with the current codec. Intended to be run offline.
+        '''
+        migrated = 0
+        if not self.r:
+            return migrated
+        p_endpoints = self.r.get('p_endpoints')
+        hash_keys = set()
+        if p_endpoints:
+            new_p_endpoints = self._migrate_value(p_endpoints)
+            if new_p_endpoints is not None:
+                self.r.set('p_endpoints', new_p_endpoints)
+                migrated += 1
+            hash_keys.update(
+                json.loads(p_endpoint)['name']
+                for p_endpoint in decode_value(p_endpoints))
+        for addresses in ('mac_addresses', 'ip_addresses'):
+            for address in self.r.smembers(addresses):
+                hash_keys.add(address)
+                poseidon_hash = self.r.hget(address, 'poseidon_hash')
+                if poseidon_hash:
+                    hash_keys.add(poseidon_hash)
+        hash_keys.update(self.r.scan_iter(match='networkml_*'))
+        for key in hash_keys:
+            if self.r.type(key) not in (b'hash', 'hash'):
+                continue
+            new_values = {}
+            for field, raw in self.r.hgetall(key).items():
+                new_raw = self._migrate_value(raw)
+                if new_raw is not None:
+                    new_values[field] = new_raw
+            if new_values:
+                self.r.hset(key, mapping=new_values)
+                migrated += 1
+        return migrated
 
     def inc_network_tools_counts(self):
         if self.r is not None:
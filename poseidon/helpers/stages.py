@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Time the stages of the main loop (handling messages, checking FAUCET,
+storing endpoints and so on).
+
+Stages are timed with the timed() decorator or the stage_timer.stage()
+context manager, which keep each duration in memory until the Monitor sends
+them to Prometheus. While the timer is disabled, timing a stage costs one
+attribute check.
+"""
+import functools
+import time
+
+
+class StageTiming:
+    ''' context manager that records the duration of one stage. '''
+
+    __slots__ = ('timer', 'key', 'start_time')
+
+    def __init__(self, timer, key):
+        self.timer = timer
+        self.key = key
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.record(
+            self.key, time.monotonic() - self.start_time,
+            error=exc_type is not None)
+        return False
+
+
+class NoTiming:
+    ''' context manager for when the timer is disabled. '''
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_TIMING = NoTiming()
+
+
+class StageTimer:
+    '''
+    durations and error counts of stages, by (stage, routing_key) since they
+    were last popped.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.durations = {}
+        self.errors = {}
+
+    def record(self, key, duration, error=False):
+        self.durations.setdefault(key, []).append(duration)
+        if error:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def stage(self, stage, routing_key=''):
+        ''' return a context manager that times a stage. '''
+        if not self.enabled:
+            return NO_TIMING
+        return StageTiming(self, (stage, routing_key))
+
+    def pop(self):
+        ''' return ({key: [seconds]}, {key: errors}) since the last call. '''
+        durations, self.durations = self.durations, {}
+        errors, self.errors = self.errors, {}
+        return (durations, errors)
+
+
+stage_timer = StageTimer()
+
+
+def timed(stage, timer=stage_timer):
+    ''' decorator that times each call of a function as a stage. '''
+    key = (stage, '')
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not timer.enabled:
+                return function(*args, **kwargs)
+            start_time = time.monotonic()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                timer.record(key, time.monotonic() - start_time, error=error)
+        return wrapper
+    return decorator
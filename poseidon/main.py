@@ -7,7 +7,6 @@ controllers and defines the Monitor class.
 Created on 3 December 2018
 @author: Charlie Lewis
 """
-import difflib
 import ipaddress
 import json
 import logging
@@ -15,49 +14,65 @@ import queue
 import random
 import signal
 import sys
-import threading
 import time
-from copy import deepcopy
+from contextlib import contextmanager
+from contextlib import nullcontext
 from functools import partial
 
-import pika
-import requests
 import schedule
 
 from poseidon.constants import NO_DATA
 from poseidon.controllers.faucet.faucet import FaucetProxy
+from poseidon.controllers.faucet.parser import FaucetEventBuffer
 from poseidon.controllers.faucet.parser import Parser
 from poseidon.helpers.actions import Actions
 from poseidon.helpers.config import Config
+from poseidon.helpers.dispatch import Dispatcher
+from poseidon.helpers.endpoint import ACL_FIELDS
+from poseidon.helpers.endpoint import ACL_METADATA_FIELDS
 from poseidon.helpers.endpoint import Endpoint
 from poseidon.helpers.endpoint import endpoint_factory
+from poseidon.helpers.endpoint import EndpointIndex
 from poseidon.helpers.endpoint import MACHINE_IP_FIELDS
 from poseidon.helpers.endpoint import MACHINE_IP_PREFIXES
+from poseidon.helpers.endpoint import MachineRecord
 from poseidon.helpers.log import Logger
-from poseidon.helpers.metadata import get_ether_vendor
+from poseidon.helpers.metadata import get_ether_vendors
 from poseidon.helpers.metadata import DNSResolver
 from poseidon.helpers.prometheus import Prometheus
 from poseidon.helpers.rabbit import Rabbit
+from poseidon.helpers.rabbit import RabbitConsumer
+from poseidon.helpers.rabbit import RabbitPublisher
 from poseidon.helpers.redis import PoseidonRedisClient
+from poseidon.helpers.stages import stage_timer
+from poseidon.helpers.stages import timed
 
-requests.packages.urllib3.disable_warnings()
 logging.getLogger('pika').setLevel(logging.WARNING)
 
 CTRL_C = dict()
 CTRL_C['STOP'] = False
+
+# longest process() sleeps for when no timer is scheduled.
+MAX_IDLE_SECONDS = 60
+
 Logger()
 logger = logging.getLogger('main')
 
 
 def rabbit_callback(ch, method, properties, body, q=None):
-    ''' callback, places rabbit data into internal queue'''
-    logger.debug('got a message: {0}:{1}:{2} (qsize {3})'.format(
-        method.routing_key, body, type(body), q.qsize()))
+    '''
+    callback, places rabbit data into internal queue. Messages are acked
+    once the main loop has processed them. The put doesn't block the
+    consumer's IO loop: a full queue raises queue.Full, and the consumer
+    holds the message and stops consuming until there is room.
+    '''
     if q is not None:
-        q.put((method.routing_key, body))
+        logger.debug('got a message: {0}:{1}:{2} (qsize {3})'.format(
+            method.routing_key, body, type(body), q.qsize()))
+        q.put_nowait((method.routing_key, body, ch, method.delivery_tag))
     else:
         logger.debug('poseidonMain workQueue is None')
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 def schedule_job_coprocessing(schedule_func):
@@ -99,44 +114,57 @@ def schedule_job_coprocessing(schedule_func):
             schedule_func.s.pipette_running = False
 
 
-def schedule_thread_worker(schedule):
-    ''' schedule thread, takes care of running processes in the future '''
-    global CTRL_C
-    logger.debug('Starting thread_worker')
-    while not CTRL_C['STOP']:
-        sys.stdout.flush()
-        schedule.run_pending()
-        time.sleep(1)
-    logger.debug('Threading stop:{0}'.format(
-        threading.current_thread().getName()))
-    sys.exit()
-
-
 class SDNConnect:
 
+    # shared by all instances, so actions reuse one rabbitmq connection.
+    publisher = None
+
     def __init__(self, controller, first_time=True):
         self.controller = controller
         self.r = None
         self.first_time = first_time
         self.sdnc = None
-        self.endpoints = {}
+        self._endpoints = EndpointIndex()
         trunk_ports = self.controller['trunk_ports']
         if isinstance(trunk_ports, str):
             self.trunk_ports = json.loads(trunk_ports)
         else:
             self.trunk_ports = trunk_ports
         self.logger = logger
+        self.write_behind = self.controller.get('write_behind_endpoints', True)
+        self.reconcile_frequency = self.controller.get('reconcile_frequency', 300)
+        self.last_reconcile = 0
+        self.reload_requested = False
         self.get_sdn_context()
-        self.prc = PoseidonRedisClient(self.logger)
+        self.prc = PoseidonRedisClient(
+            self.logger,
+            pipeline_chunk_size=self.controller.get('redis_pipeline_chunk_size', 1000),
+            codec=self.controller.get('redis_codec', 'json'))
         self.prc.connect()
-        self.dns_resolver = DNSResolver()
+        self.dns_resolver = DNSResolver(
+            max_workers=self.controller.get('rdns_workers', 8),
+            cache_size=self.controller.get('rdns_cache_size', 4096),
+            ttl=self.controller.get('rdns_ttl', 3600),
+            negative_ttl=self.controller.get('rdns_negative_ttl', 300),
+            blocking=not self.controller.get('rdns_nonblocking', False))
         if self.first_time:
+            self.prc.migrate_hash_macs()
             self.endpoints = {}
             self.investigations = 0
             self.coprocessing = 0
             self.clear_filters()
             self.default_endpoints()
 
+    @property
+    def endpoints(self):
+        return self._endpoints
+
+    @endpoints.setter
+    def endpoints(self, endpoints):
+        if not isinstance(endpoints, EndpointIndex):
+            endpoints = EndpointIndex(endpoints)
+        self._endpoints = endpoints
+
     def mirror_endpoint(self, endpoint):
         ''' mirror an endpoint. '''
         status = Actions(endpoint, self.sdnc).mirror_endpoint()
@@ -172,7 +200,7 @@ class SDNConnect:
                         endpoint.p_next_state = 'queue'
                     elif endpoint.state in ['known', 'abnormal']:
                         endpoint.p_next_state = endpoint.state
-                    endpoint.endpoint_data['active'] = 0
+                    endpoint.update_endpoint_data(active=0)
                     endpoint.inactive()  # pytype: disable=attribute-error
                     endpoint.p_prev_states.append(
                         (endpoint.state, int(time.time())))
@@ -195,6 +223,20 @@ class SDNConnect:
                 'Unknown SDN controller config: {0}'.format(
                     self.controller))
 
+    @contextmanager
+    def config_transaction(self):
+        '''
+        write FAUCET config changes made in the block once, when it exits. If
+        the block raises, nothing is written and the state machine states of
+        endpoints are restored (see EndpointIndex.rollback_on_error()).
+        '''
+        sdnc_transaction = nullcontext()
+        if self.sdnc:
+            sdnc_transaction = self.sdnc.config_transaction()
+        with self.endpoints.rollback_on_error():
+            with sdnc_transaction:
+                yield
+
     def endpoint_by_name(self, name):
         return self.endpoints.get(name, None)
 
@@ -202,46 +244,17 @@ class SDNConnect:
         return self.endpoint_by_name(hash_id)
 
     def endpoints_by_ip(self, ip):
-        endpoints = [
-            endpoint for endpoint in self.endpoints.values()
-            if ip == endpoint.endpoint_data.get('ipv4', None) or
-            ip == endpoint.endpoint_data.get('ipv6', None)]
-        return endpoints
+        return self.endpoints.by_ip(ip)
 
     def endpoints_by_mac(self, mac):
-        endpoints = [
-            endpoint for endpoint in self.endpoints.values()
-            if mac == endpoint.endpoint_data['mac']]
-        return endpoints
-
-    @staticmethod
-    def _connect_rabbit():
-        # Rabbit settings
-        exchange = 'topic-poseidon-internal'
-        exchange_type = 'topic'
-
-        # Starting rabbit connection
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host='RABBIT_SERVER')
-        )
-
-        channel = connection.channel()
-        channel.exchange_declare(
-            exchange=exchange, exchange_type=exchange_type
-        )
-
-        return channel, exchange, connection
+        return self.endpoints.by_mac(mac)
 
-    @staticmethod
-    def publish_action(action, message):
-        try:
-            channel, exchange, connection = SDNConnect._connect_rabbit()
-            channel.basic_publish(exchange=exchange,
-                                  routing_key=action,
-                                  body=message)
-            connection.close()
-        except Exception as e:  # pragma: no cover
-            print(str(e))
+    @classmethod
+    def publish_action(cls, action, message):
+        if cls.publisher is None:
+            cls.publisher = RabbitPublisher('RABBIT_SERVER')
+        if not cls.publisher.publish(action, message):
+            print('Unable to publish action {0}'.format(action))
 
     def show_endpoints(self, arg):
         endpoints = []
@@ -249,15 +262,16 @@ class SDNConnect:
             endpoints = list(self.endpoints.values())
         else:
             show_type, arg = arg.split(' ', 1)
+            if show_type == 'state':
+                if arg == 'active':
+                    return [
+                        endpoint for endpoint in self.endpoints.values()
+                        if endpoint.state != 'inactive']
+                if arg == 'ignored':
+                    return self.endpoints.ignored()
+                return self.endpoints.by_state(arg)
             for endpoint in self.endpoints.values():
-                if show_type == 'state':
-                    if arg == 'active' and endpoint.state != 'inactive':
-                        endpoints.append(endpoint)
-                    elif arg == 'ignored' and endpoint.ignore:
-                        endpoints.append(endpoint)
-                    elif endpoint.state == arg:
-                        endpoints.append(endpoint)
-                elif show_type in ['os', 'behavior', 'role']:
+                if show_type in ['os', 'behavior', 'role']:
                     mac_addresses = endpoint.metadata.get(
                         'mac_addresses', None)
                     endpoint_mac = endpoint.endpoint_data['mac']
@@ -290,6 +304,15 @@ class SDNConnect:
                                 endpoints.append(endpoint)
         return endpoints
 
+    def reconcile_due(self):
+        ''' return True if all endpoints should be rescanned. '''
+        now = time.time()
+        if self.reconcile_frequency <= 0 or now - self.last_reconcile >= self.reconcile_frequency:
+            self.last_reconcile = now
+            return True
+        return False
+
+    @timed('check_endpoints')
     def check_endpoints(self, messages=None):
         if not self.sdnc:
             return
@@ -302,7 +325,11 @@ class SDNConnect:
         parsed = None
 
         try:
-            current = self.sdnc.get_endpoints(messages=messages)
+            reconcile = self.reconcile_due()
+            current = self.sdnc.get_endpoints(
+                messages=messages, changed_only=not reconcile)
+            self.logger.debug('checking {0} {1} endpoints'.format(
+                len(current), 'all' if reconcile else 'changed'))
             parsed = self.sdnc.format_endpoints(current)
             retval['machines'] = parsed
             retval['resp'] = 'ok'
@@ -314,15 +341,18 @@ class SDNConnect:
         self.find_new_machines(parsed)
 
     @staticmethod
-    def _diff_machine(machine_a, machine_b):
-
-        def _machine_strlines(machine):
-            return str(json.dumps(machine, indent=2)).splitlines()
+    def diff_machine(machine_a, machine_b):
+        ''' return {field: (old value, new value)} for fields that differ. '''
+        return {
+            field: (machine_a.get(field, None), machine_b.get(field, None))
+            for field in set(machine_a).union(machine_b)
+            if machine_a.get(field, None) != machine_b.get(field, None)}
 
-        machine_a_strlines = _machine_strlines(machine_a)
-        machine_b_strlines = _machine_strlines(machine_b)
-        return '\n'.join(difflib.unified_diff(
-            machine_a_strlines, machine_b_strlines, n=1))
+    @staticmethod
+    def _diff_machine_text(machine_diff):
+        return ', '.join(
+            '{0}: {1} -> {2}'.format(field, old, new)
+            for field, (old, new) in sorted(machine_diff.items()))
 
     def _parse_machine_ip(self, machine):
         machine_ips = set()
@@ -355,6 +385,15 @@ class SDNConnect:
              resolved_ip = resolved_machine_ips.get(machine_ip, machine_ip)
              machine[rdns_field] = resolved_ip
 
+    def update_resolved_rdns(self):
+        ''' fill in reverse DNS names for lookups that finished since the last scan. '''
+        for ip, resolved_ip in self.dns_resolver.pop_resolved().items():
+            for endpoint in self.endpoints_by_ip(ip):
+                for ip_field in MACHINE_IP_FIELDS:
+                    rdns_field = '_'.join((ip_field, 'rdns'))
+                    if endpoint.endpoint_data.get(ip_field, None) == ip:
+                        endpoint.update_endpoint_data({rdns_field: resolved_ip})
+
     @staticmethod
     def merge_machine_ip(old_machine, new_machine):
         for ip_field, fields in MACHINE_IP_FIELDS.items():
@@ -366,6 +405,7 @@ class SDNConnect:
                     if field in old_machine:
                         new_machine[field] = old_machine[field]
 
+    @timed('find_new_machines')
     def find_new_machines(self, machines):
         '''parse switch structure to find new machines added to network
         since last call'''
@@ -373,9 +413,11 @@ class SDNConnect:
         change_acls = False
         machine_ips = set()
 
+        ether_vendors = get_ether_vendors(
+            [machine['mac'] for machine in machines],
+            '/poseidon/poseidon/metadata/nmap-mac-prefixes.txt')
         for machine in machines:
-            machine['ether_vendor'] = get_ether_vendor(
-                machine['mac'], '/poseidon/poseidon/metadata/nmap-mac-prefixes.txt')
+            machine['ether_vendor'] = ether_vendors[machine['mac']]
             machine_ips.update(self._parse_machine_ip(machine))
             if 'controller_type' not in machine:
                 machine.update({
@@ -401,7 +443,7 @@ class SDNConnect:
                 change_acls = True
                 m = endpoint_factory(h)
                 m.p_prev_states.append((m.state, int(time.time())))
-                m.endpoint_data = deepcopy(machine)
+                m.endpoint_data = MachineRecord(machine)
                 self.endpoints[m.name] = m
                 self.logger.info(
                     'Detected new endpoint: {0}:{1}'.format(m.name, machine))
@@ -409,11 +451,12 @@ class SDNConnect:
                 self.merge_machine_ip(ep.endpoint_data, machine)
 
             if ep and ep.endpoint_data != machine and not ep.ignore:
-                diff_txt = self._diff_machine(ep.endpoint_data, machine)
-                self.logger.info(
-                    'Endpoint changed: {0}:{1}'.format(h, diff_txt))
-                change_acls = True
-                ep.endpoint_data = deepcopy(machine)
+                machine_diff = self.diff_machine(ep.endpoint_data, machine)
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info('Endpoint changed: {0}:{1}'.format(
+                        h, self._diff_machine_text(machine_diff)))
+                ep.changed_fields.update(machine_diff)
+                ep.endpoint_data = MachineRecord(machine)
                 if ep.state == 'inactive' and machine['active'] == 1:
                     if ep.p_next_state in ['known', 'abnormal']:
                         # pytype: disable=attribute-error
@@ -433,6 +476,11 @@ class SDNConnect:
                     ep.inactive()  # pytype: disable=attribute-error
                     ep.p_prev_states.append((ep.state, int(time.time())))
 
+        # ACLs only depend on where the endpoint is and what tools found.
+        acl_fields = ACL_FIELDS | ACL_METADATA_FIELDS
+        change_acls = change_acls or any(
+            acl_fields.intersection(endpoint.changed_fields)
+            for endpoint in self.endpoints.values())
         if change_acls and self.controller['AUTOMATED_ACLS']:
             status = Actions(None, self.sdnc).update_acls(
                 rules_file=self.controller['RULES_FILE'],
@@ -448,28 +496,43 @@ class SDNConnect:
                     if ep:
                         ep.acl_data.append(
                             ((item[0], item[4], item[5]), int(time.time())))
+        for endpoint in self.endpoints.values():
+            endpoint.changed_fields -= ACL_METADATA_FIELDS
+        self.update_resolved_rdns()
         self.refresh_endpoints()
 
     def store_endpoints(self):
         ''' store current endpoints in Redis. '''
         self.prc.store_endpoints(self.endpoints)
 
+    def request_reload(self):
+        ''' reload endpoints from Redis on the next refresh. '''
+        self.reload_requested = True
+
     def refresh_endpoints(self):
+        ''' store changed endpoints, and reload them if needed. '''
         self.logger.debug('refresh endpoints')
         self.store_endpoints()
-        self.get_stored_endpoints()
+        # with write behind, the endpoints in memory are authoritative and
+        # are only reloaded when something else changed them in Redis.
+        if self.reload_requested or not self.write_behind:
+            self.reload_requested = False
+            self.get_stored_endpoints()
 
 
 class Monitor:
 
+    dispatcher_cl = Dispatcher
+
     def __init__(self, skip_rabbit, controller=None):
-        self.faucet_event = []
-        self.m_queue = queue.Queue()
-        self.job_queue = queue.Queue()
+        self.rabbit = Rabbit()
+        self.dispatcher = self.dispatcher_cl()
+        self.job_queue = self.dispatcher.queue('jobs')
         self.skip_rabbit = skip_rabbit
         self.logger = logger
         self.rabbit_channel_connection_local = None
         self.rabbit_channel_connection_local_fa = None
+        self.rabbit_consumer = None
 
         # get config options
         if controller is None:
@@ -477,10 +540,19 @@ class Monitor:
         else:
             self.controller = controller
 
-        # timer class to call things periodically in own thread
+        # the rabbit consumer waits while the queue is full, and the main
+        # loop stops taking messages off it while the FAUCET event buffer
+        # is, so unacked messages back up to the broker.
+        self.m_queue = self.dispatcher.queue(
+            'rabbit', maxsize=self.controller['event_queue_size'])
+        self.faucet_event = FaucetEventBuffer(
+            maxsize=self.controller['event_queue_size'])
+
+        # timer class to call things periodically, run by process()
         self.schedule = schedule
 
         # setup prometheus
+        stage_timer.enabled = self.controller['stage_metrics']
         self.prom = Prometheus()
         try:
             self.prom.initialize_metrics()
@@ -492,6 +564,16 @@ class Monitor:
         # initialize sdnconnect
         self.s = SDNConnect(self.controller)
 
+        # endpoint metrics are read from SDNConnect when Prometheus scrapes
+        try:
+            self.prom.register_endpoint_collector(
+                lambda: self.s.endpoints.values(),
+                series_limit=self.controller['prometheus_endpoint_series_limit'],
+                aggregate_only=self.controller['prometheus_aggregate_only'])
+        except Exception as e:  # pragma: no cover
+            self.logger.debug(
+                'Prometheus endpoint collector is already registered: {0}'.format(str(e)))
+
         # schedule periodic scan of endpoints thread
         self.schedule.every(self.controller['scan_frequency']).seconds.do(
             self.schedule_job_kickurl)
@@ -500,29 +582,94 @@ class Monitor:
         self.schedule.every(self.controller['reinvestigation_frequency']).seconds.do(
             self.schedule_job_reinvestigation)
 
-        # schedule all threads
-        self.schedule_thread = threading.Thread(
-            target=partial(
-                schedule_thread_worker,
-                schedule=self.schedule),
-            name='st_worker')
+    def _update_store_metrics(self):
+        store_counts = self.s.prc.store_counts
+        for result, count in store_counts.items():
+            self.prom.prom_metrics['endpoints_stored'].labels(
+                result=result).inc(count)
+            store_counts[result] = 0
+        flush_times = self.s.prc.flush_times
+        for flush_time in flush_times:
+            self.prom.prom_metrics['endpoint_store_flush_time'].observe(flush_time)
+        del flush_times[:]
+
+    def _update_parser_metrics(self):
+        sdnc = self.s.sdnc
+        if sdnc is None:
+            return
+        self.prom.prom_metrics['mac_history_evictions'].inc(
+            sdnc.mac_history_evictions)
+        sdnc.mac_history_evictions = 0
+
+    def _update_queue_metrics(self):
+        for queue_name, latencies in self.dispatcher.pop_latencies().items():
+            histogram = self.prom.prom_metrics['dispatch_latency'].labels(
+                queue=queue_name)
+            for latency in latencies:
+                histogram.observe(latency)
+        faucet_event = self.faucet_event
+        self.prom.prom_metrics['event_queue_depth'].labels(
+            queue='rabbit').set(self.m_queue.qsize())
+        self.prom.prom_metrics['event_queue_depth'].labels(
+            queue='faucet_events').set(len(faucet_event))
+        self.prom.prom_metrics['faucet_events_coalesced'].inc(
+            faucet_event.coalesced)
+        faucet_event.coalesced = 0
+        self.prom.prom_metrics['faucet_events_dropped'].inc(
+            faucet_event.dropped)
+        faucet_event.dropped = 0
+
+    def _update_stage_metrics(self):
+        durations, errors = stage_timer.pop()
+        for (stage, routing_key), stage_durations in durations.items():
+            histogram = self.prom.prom_metrics['stage_time'].labels(
+                stage=stage, routing_key=routing_key)
+            for duration in stage_durations:
+                histogram.observe(duration)
+        for (stage, routing_key), count in errors.items():
+            self.prom.prom_metrics['stage_errors'].labels(
+                stage=stage, routing_key=routing_key).inc(count)
+
+    def _update_rabbit_metrics(self):
+        consumer = self.rabbit_consumer
+        if consumer is None:
+            return
+        for (exchange, queue_name), lag in list(consumer.lag.items()):
+            self.prom.prom_metrics['rabbit_consumer_lag'].labels(
+                exchange=exchange, queue=queue_name).set(lag)
+        self.prom.prom_metrics['rabbit_reconnects'].inc(consumer.reconnects)
+        consumer.reconnects = 0
 
     def _update_metrics(self):
         self.logger.debug('updating metrics')
         try:
-            # get current state
-            req = requests.get(
-                'http://poseidon-api:8000/v1/network_full', timeout=10)
-            # send results to prometheus
-            hosts = req.json()['dataset']
-            self.prom.update_metrics(hosts)
-        except (requests.exceptions.ConnectionError, Exception) as e:  # pragma: no cover
+            self._update_store_metrics()
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to send endpoint store counts to Prometheus because: {0}'.format(str(e)))
+        try:
+            self._update_parser_metrics()
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to send MAC history evictions to Prometheus because: {0}'.format(str(e)))
+        try:
+            self._update_rabbit_metrics()
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to send RabbitMQ consumer lag to Prometheus because: {0}'.format(str(e)))
+        try:
+            self._update_stage_metrics()
+        except Exception as e:  # pragma: no cover
             self.logger.error(
-                'Unable to get current state and send it to Prometheus because: {0}'.format(str(e)))
+                'Unable to send stage timings to Prometheus because: {0}'.format(str(e)))
 
     def job_kickurl(self):
-        self.s.check_endpoints(messages=self.faucet_event)
-        del self.faucet_event[:]
+        try:
+            self._update_queue_metrics()
+        except Exception as e:  # pragma: no cover
+            self.logger.error(
+                'Unable to send work queue depths to Prometheus because: {0}'.format(str(e)))
+        self.s.check_endpoints(messages=self.faucet_event.pop_all())
         self._update_metrics()
 
     def job_reinvestigation(self):
@@ -659,6 +806,10 @@ class Monitor:
                             'Unable to apply rules: {0} to endpoint: {1} because {2}'.format(rules, endpoint.name, str(e)))
             return ({}, None)
 
+        def handler_action_reload(_my_obj):
+            self.s.request_reload()
+            return ({}, None)
+
         def handler_action_remove(my_obj):
             remove_list = [name for name in my_obj]
             return ({}, remove_list)
@@ -678,8 +829,8 @@ class Monitor:
         def handler_faucet_event(my_obj):
             if self.s and self.s.sdnc:
                 if not self.s.sdnc.ignore_event(my_obj):
-                    self.faucet_event.append(my_obj)
-                    return (my_obj, None)
+                    if self.faucet_event.add(my_obj):
+                        return (my_obj, None)
             return ({}, None)
 
         handlers = {
@@ -688,6 +839,7 @@ class Monitor:
             'poseidon.action.clear.ignored': handler_action_clear_ignored,
             'poseidon.action.change': handler_action_change,
             'poseidon.action.update_acls': handler_action_update_acls,
+            'poseidon.action.reload': handler_action_reload,
             'poseidon.action.remove': handler_action_remove,
             'poseidon.action.remove.ignored': handler_action_remove_ignored,
             'poseidon.action.remove.inactives': handler_action_remove_inactives,
@@ -709,6 +861,7 @@ class Monitor:
 
         return ({}, False)
 
+    @timed('schedule_mirroring')
     def schedule_mirroring(self):
         queued_endpoints = [
             endpoint for endpoint in self.s.endpoints.values()
@@ -812,25 +965,60 @@ class Monitor:
                         endpoint.copro_nominal()  # pytype: disable=attribute-error
 
     def process(self):
+        '''
+        handle work as it arrives: wait until a message or job is queued or
+        the next timer is due, then handle everything that is ready.
+        '''
         global CTRL_C
         signal.signal(signal.SIGINT, partial(self.signal_handler))
         while not CTRL_C['STOP']:
-            while True:
+            self.schedule.run_pending()
+            self.process_ready()
+            if not CTRL_C['STOP']:
+                self.dispatcher.wait(self.idle_seconds())
+
+        self.s.refresh_endpoints()
+
+    def process_ready(self):
+        '''
+        handle the queued messages and jobs. FAUCET config changes they make
+        are written once, at the end.
+        '''
+        ack_tags = {}
+        with self.s.config_transaction():
+            # leave messages queued while the event buffer is full.
+            while not self.faucet_event.full():
                 found_work, rabbit_msg = self.get_q_item(
                     self.m_queue, timeout=0)
                 if not found_work:
                     break
-                self.format_rabbit_message(rabbit_msg)
+                with stage_timer.stage('format_rabbit_message', rabbit_msg[0]):
+                    self.format_rabbit_message(rabbit_msg[:2])
+                if len(rabbit_msg) > 2:
+                    ch, delivery_tag = rabbit_msg[2:]
+                    ack_tags[ch] = delivery_tag
             self.s.refresh_endpoints()
-            found_work, schedule_func = self.get_q_item(self.job_queue)
-            if found_work and callable(schedule_func):
-                self.logger.info('calling %s', schedule_func)
-                start_time = time.time()
-                schedule_func()
-                self.logger.debug('%s done (%.1f sec)' % (schedule_func, time.time() - start_time))
+            while True:
+                found_work, schedule_func = self.get_q_item(
+                    self.job_queue, timeout=0)
+                if not found_work:
+                    break
+                if callable(schedule_func):
+                    self.logger.info('calling %s', schedule_func)
+                    start_time = time.time()
+                    schedule_func()
+                    self.logger.debug('%s done (%.1f sec)' % (schedule_func, time.time() - start_time))
             self.schedule_mirroring()
+        # the batch is processed, stored and configured, so it can be acked.
+        for ch, delivery_tag in ack_tags.items():
+            self.rabbit.ack_messages(ch, delivery_tag)
 
-        self.s.refresh_endpoints()
+    def idle_seconds(self):
+        ''' return how long process() can sleep before a timer is due. '''
+        idle_seconds = self.schedule.idle_seconds()
+        if idle_seconds is None:
+            return MAX_IDLE_SECONDS
+        return min(max(idle_seconds, 0), MAX_IDLE_SECONDS)
 
     def get_q_item(self, q, timeout=1):
         '''
@@ -850,6 +1038,29 @@ class Monitor:
 
         return (False, None)
 
+    def make_rabbit_consumer(self, consumer_cl=RabbitConsumer):
+        '''
+        return a consumer for the FAUCET exchange (and unless skip_rabbit,
+        the internal poseidon exchange), with one channel per exchange on
+        one connection that connects (and reconnects) in the background.
+        '''
+        consumer = consumer_cl(
+            self.controller['FA_RABBIT_HOST'],
+            int(self.controller['FA_RABBIT_PORT']),
+            partial(rabbit_callback, q=self.m_queue),
+            prefetch_count=self.controller['rabbit_prefetch_count'],
+            max_backoff=self.controller['rabbit_max_backoff'],
+            lag_interval=self.controller['rabbit_lag_frequency'])
+        queue_name = 'poseidon_main'
+        if not self.skip_rabbit:
+            consumer.add_binding(
+                'topic-poseidon-internal', queue_name,
+                ['poseidon.algos.#', 'poseidon.action.#'])
+        consumer.add_binding(
+            self.controller['FA_RABBIT_EXCHANGE'], queue_name,
+            [self.controller['FA_RABBIT_ROUTING_KEY']+'.#'])
+        return consumer
+
     def shutdown(self):
         ''' gracefully shut down. '''
         self.s.clear_filters()
@@ -860,6 +1071,8 @@ class Monitor:
             self.rabbit_channel_connection_local.close()
         if self.rabbit_channel_connection_local_fa:
             self.rabbit_channel_connection_local_fa.close()
+        if self.rabbit_consumer:
+            self.rabbit_consumer.stop()
         self.logger.debug('SHUTTING DOWN')
         self.logger.debug('EXITING')
         sys.exit()
@@ -868,6 +1081,7 @@ class Monitor:
         ''' hopefully eat a CTRL_C and signal system shutdown '''
         global CTRL_C
         CTRL_C['STOP'] = True
+        self.dispatcher.notify()
         self.logger.debug('CTRL-C: {0}'.format(CTRL_C))
         try:
             self.shutdown()
@@ -877,42 +1091,14 @@ class Monitor:
 
 
 def main(skip_rabbit=False):  # pragma: no cover
+    if Config().get_config()['runtime'] == 'asyncio':
+        from poseidon.async_main import async_main
+        return async_main(skip_rabbit=skip_rabbit)
+
     # setup rabbit and monitoring of the network
     pmain = Monitor(skip_rabbit=skip_rabbit)
-    if not skip_rabbit:
-        rabbit = Rabbit()
-        host = pmain.controller['FA_RABBIT_HOST']
-        port = int(pmain.controller['FA_RABBIT_PORT'])
-        exchange = 'topic-poseidon-internal'
-        queue_name = 'poseidon_main'
-        binding_key = ['poseidon.algos.#', 'poseidon.action.#']
-        retval = rabbit.make_rabbit_connection(
-            host, port, exchange, queue_name, binding_key)
-        pmain.rabbit_channel_local = retval[0]
-        pmain.rabbit_channel_connection_local = retval[1]
-        pmain.rabbit_thread = rabbit.start_channel(
-            pmain.rabbit_channel_local,
-            rabbit_callback,
-            queue_name,
-            pmain.m_queue)
-
-    rabbit = Rabbit()
-    host = pmain.controller['FA_RABBIT_HOST']
-    port = pmain.controller['FA_RABBIT_PORT']
-    exchange = pmain.controller['FA_RABBIT_EXCHANGE']
-    queue_name = 'poseidon_main'
-    binding_key = [pmain.controller['FA_RABBIT_ROUTING_KEY']+'.#']
-    retval = rabbit.make_rabbit_connection(
-        host, port, exchange, queue_name, binding_key)
-    pmain.rabbit_channel_local = retval[0]
-    pmain.rabbit_channel_connection_local_fa = retval[1]
-    pmain.rabbit_thread = rabbit.start_channel(
-        pmain.rabbit_channel_local,
-        rabbit_callback,
-        queue_name,
-        pmain.m_queue)
-
-    pmain.schedule_thread.start()
+    pmain.rabbit_consumer = pmain.make_rabbit_consumer()
+    pmain.rabbit_consumer.start()
 
     # loop here until told not to
     try:
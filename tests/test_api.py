@@ -138,6 +138,23 @@ def test_network_full(client, redis_my):
     verify_endpoints(response)
 
 
+def test_network_full_encoded(client, redis_my):
+    setup_redis()
+    r = redis.StrictRedis(host='localhost', port=6379, db=0)
+    r.hset('6cd09124a66ef1bbc72c1aff4e333766d3533f83', mapping={
+        'endpoint_data': 'j1:{"mac":"00:00:00:00:00:03","ipv4":"10.0.0.3","segment":"1","port":"1","tenant":"VLAN100","active":1}',
+        'prev_states': 'j1:[["UNKNOWN",1527208228]]'})
+    r.hset('00:00:00:00:00:03', mapping={'timestamps': 'j1:[1527208228]'})
+    response = client.simulate_get('/v1/network_full')
+    assert response.status == falcon.HTTP_OK
+    nodes = {node['id']: node for node in response.json['dataset']}
+    node = nodes['6cd09124a66ef1bbc72c1aff4e333766d3533f83']
+    assert node['ipv4'] == '10.0.0.3'
+    assert node['ipv4_subnet'] == '10.0.0.0/24'
+    assert node['prev_states'] == "[['UNKNOWN', 1527208228]]"
+    assert node['role'] == 'Developer workstation'
+
+
 def test_info(client, redis_my):
     response = client.simulate_get('/v1/info')
     assert response.status == falcon.HTTP_OK
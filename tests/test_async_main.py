@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for async_main.py
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from poseidon.async_main import AsyncMonitor
+from poseidon.controllers.faucet.parser import FaucetEventBuffer
+from poseidon.helpers.config import Config
+from poseidon.helpers.dispatch import AsyncDispatcher
+from poseidon.helpers.rabbit import Rabbit
+from poseidon.main import CTRL_C
+from poseidon.main import SDNConnect
+
+logger = logging.getLogger('test')
+
+
+def get_test_controller():
+    controller = Config().get_config()
+    controller['faucetconfrpc_address'] = None
+    controller['TYPE'] = 'faucet'
+    return controller
+
+
+def test_process_async():
+
+    class MockSchedule:
+
+        def run_pending(self):
+            pass
+
+        def idle_seconds(self):
+            return None
+
+    class MockChannel:
+
+        def __init__(self):
+            self.is_open = True
+            self.acked = []
+            self.connection = self
+
+        def add_callback_threadsafe(self, callback):
+            callback()
+
+        def basic_ack(self, delivery_tag, multiple):
+            self.acked.append(delivery_tag)
+
+    class MockAsyncMonitor(AsyncMonitor):
+
+        def __init__(self):
+            self.logger = logger
+            self.controller = get_test_controller()
+            self.s = SDNConnect(self.controller)
+            self.s.refresh_endpoints = lambda: None
+            self.rabbit = Rabbit()
+            self.faucet_event = FaucetEventBuffer()
+            self.schedule = MockSchedule()
+            self.dispatcher = AsyncDispatcher()
+            self.job_queue = self.dispatcher.queue('jobs')
+            self.m_queue = self.dispatcher.queue('rabbit')
+            self.state_executor = ThreadPoolExecutor(max_workers=1)
+            self.handled = []
+
+        def format_rabbit_message(self, item):
+            self.handled.append((item, threading.current_thread().name))
+            return ({}, True)
+
+        def schedule_mirroring(self):
+            return
+
+    monitor = MockAsyncMonitor()
+    channel = MockChannel()
+    jobs = []
+
+    def job():
+        jobs.append(threading.current_thread().name)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, monitor.m_queue.put,
+                        ('poseidon.action.ignore', '[]', channel, 1))
+        loop.call_later(0.1, monitor.queue_job, job)
+        loop.call_later(0.2, monitor.stop)
+        start = time.time()
+        await monitor.process_async()
+        return time.time() - start
+
+    CTRL_C['STOP'] = False
+    elapsed = asyncio.run(run())
+    CTRL_C['STOP'] = False
+    assert elapsed < 0.5
+    assert monitor.handled[0][0] == ('poseidon.action.ignore', '[]')
+    assert monitor.handled[0][1] != threading.current_thread().name
+    assert channel.acked == [1]
+    assert jobs == [monitor.handled[0][1]]
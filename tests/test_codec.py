@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for codec.py
+"""
+import pytest
+
+from poseidon.helpers.codec import decode_value
+from poseidon.helpers.codec import encode_value
+from poseidon.helpers.codec import get_codec
+from poseidon.helpers.codec import get_value_codec
+from poseidon.helpers.codec import JSONCodec
+
+
+def test_encode_decode():
+    value = {'mac': '00:00:00:00:00:00', 'active': 1, 'ipv4': None,
+             'prev_states': [['unknown', 1551805502]]}
+    raw = encode_value(value)
+    assert raw.startswith(b'j1:')
+    assert get_value_codec(raw) is JSONCodec
+    assert decode_value(raw) == value
+    assert decode_value(raw.decode('utf-8')) == value
+    assert encode_value('known') == 'known'
+    assert encode_value(True) == 'True'
+    assert encode_value(None) == 'None'
+    assert decode_value(None) is None
+
+
+def test_decode_legacy():
+    assert get_value_codec(b"[('unknown', 1551805502)]") is None
+    assert decode_value(b"[('unknown', 1551805502)]") == [('unknown', 1551805502)]
+    assert decode_value("{'ipv4': '10.0.0.1', 'name': None}") == {'ipv4': '10.0.0.1', 'name': None}
+
+
+def test_get_codec():
+    assert get_codec('json') is JSONCodec
+    with pytest.raises(ValueError):
+        get_codec('pickle')
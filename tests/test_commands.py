@@ -3,10 +3,18 @@
 Created on 18 Jan 2019
 @author: Charlie Lewis
 """
+import pytest
+
 from poseidon.cli.commands import Commands
 from poseidon.helpers.config import Config
 from poseidon.helpers.endpoint import Endpoint
 from poseidon.helpers.endpoint import endpoint_factory
+from poseidon.helpers.endpoint import EndpointIndex
+
+
+@pytest.fixture(autouse=True)
+def endpoint_index_self_check(monkeypatch):
+    monkeypatch.setattr(EndpointIndex, 'self_check', True)
 
 
 def get_test_controller():
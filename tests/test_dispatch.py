@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for dispatch.py
+"""
+import asyncio
+import queue
+import threading
+import time
+
+import pytest
+
+from poseidon.helpers.dispatch import AsyncDispatcher
+from poseidon.helpers.dispatch import Dispatcher
+
+
+def test_dispatcher():
+    dispatcher = Dispatcher()
+    jobs = dispatcher.queue('jobs')
+    messages = dispatcher.queue('rabbit', maxsize=1)
+    assert not dispatcher.wait(0)
+
+    # a put on any queue wakes the waiting thread.
+    timer = threading.Timer(0.1, messages.put, args=('message',))
+    timer.start()
+    start = time.time()
+    assert dispatcher.wait(5)
+    assert time.time() - start < 5
+    timer.join()
+    assert messages.get_nowait() == 'message'
+    assert not dispatcher.wait(0)
+
+    # work queued while busy wakes the next wait immediately.
+    jobs.put('job1')
+    jobs.put('job2')
+    assert dispatcher.wait(0)
+    assert [jobs.get_nowait(), jobs.get_nowait()] == ['job1', 'job2']
+    latencies = dispatcher.pop_latencies()
+    assert len(latencies['jobs']) == 2
+    assert len(latencies['rabbit']) == 1
+    assert dispatcher.pop_latencies() == {}
+
+    dispatcher.notify()
+    assert dispatcher.wait(0)
+
+
+def test_async_dispatcher():
+
+    async def dispatch():
+        dispatcher = AsyncDispatcher()
+        messages = dispatcher.queue('rabbit', maxsize=1)
+        assert not await dispatcher.wait(0.01)
+        asyncio.get_running_loop().call_later(0.05, messages.put, 'message1')
+        start = time.time()
+        assert await dispatcher.wait(5)
+        assert time.time() - start < 5
+        # puts from the loop never block, even when the queue is full.
+        with pytest.raises(queue.Full):
+            messages.put('message2')
+        assert messages.get_nowait() == 'message1'
+        messages.put('message2')
+        assert await dispatcher.wait(0)
+        assert messages.get_nowait() == 'message2'
+        dispatcher.notify()
+        assert await dispatcher.wait(0)
+        return dispatcher.pop_latencies()
+
+    latencies = asyncio.run(dispatch())
+    assert len(latencies['rabbit']) == 2
@@ -3,11 +3,18 @@
 Test module for endpoints.
 @author: Charlie Lewis
 """
+import copy
+import json
 import os
 
+import pytest
+from transitions import MachineError
+
 from poseidon.helpers.endpoint import Endpoint
 from poseidon.helpers.endpoint import endpoint_factory
 from poseidon.helpers.endpoint import EndpointDecoder
+from poseidon.helpers.endpoint import EndpointIndex
+from poseidon.helpers.endpoint import MachineRecord
 
 
 def test_Endpoint():
@@ -17,5 +24,128 @@ def test_Endpoint():
     endpoint = endpoint_factory('foo')
     b = endpoint.encode()
     c = EndpointDecoder(b).get_endpoint()
+    assert c.copro_state == 'copro_unknown'
+    # endpoints stored without a coprocessing state can still be coprocessed.
+    stored = json.loads(b)
+    stored['copro_state'] = None
+    c = EndpointDecoder(json.dumps(stored)).get_endpoint()
+    c.copro_coprocess()
+    assert c.copro_state == 'copro_coprocessing'
     a = {'tenant': 'foo', 'mac': '00:00:00:00:00:00'}
     hashed_val = Endpoint.make_hash(a)
+
+
+def test_endpoint_triggers():
+    endpoint = endpoint_factory('foo')
+    assert endpoint.state == 'unknown'
+    assert endpoint.mirror()
+    assert endpoint.state == 'mirroring'
+    assert endpoint.history[-1]['message'] == 'State changed from unknown to mirroring'
+    endpoint.trigger('known')
+    assert endpoint.state == 'known'
+    with pytest.raises(MachineError):
+        endpoint.shutdown()
+    with pytest.raises(AttributeError):
+        endpoint.trigger('foo')
+    with pytest.raises(AttributeError):
+        endpoint.foo = 'bar'
+    endpoint.copro_queue()
+    assert endpoint.copro_state == 'copro_queued'
+    assert endpoint.state == 'known'
+    assert endpoint.history[-1]['type'] == 'Coprocessor Change'
+    assert len(endpoint.history) == 3
+    endpoint = endpoint_factory('bar')
+    endpoint.copro_coprocess()
+    assert endpoint.copro_state == 'copro_coprocessing'
+
+
+def test_endpoint_dirty():
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {'tenant': 'foo', 'mac': '00:00:00:00:00:00'}
+    assert endpoint.is_dirty()
+    endpoint.mark_persisted(endpoint.encode())
+    assert not endpoint.is_dirty()
+    assert endpoint.persisted_encoding() == endpoint.encode()
+    endpoint.p_prev_states.append((endpoint.state, 1))
+    assert endpoint.is_dirty()
+    endpoint.mark_persisted(endpoint.encode())
+    endpoint.endpoint_data['tenant'] = 'bar'
+    assert endpoint.is_dirty()
+    c = EndpointDecoder(endpoint.encode()).get_persisted_endpoint()
+    assert isinstance(c.endpoint_data, MachineRecord)
+    assert c.endpoint_data == endpoint.endpoint_data
+    assert not c.is_dirty()
+    c.mark_dirty()
+    assert c.is_dirty()
+    assert c.persisted_encoding() is None
+
+
+def test_endpoint_index(monkeypatch):
+    monkeypatch.setattr(EndpointIndex, 'self_check', True)
+    endpoints = EndpointIndex()
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'mac': '00:00:00:00:00:00', 'ipv4': '0.0.0.0', 'ipv6': ''}
+    endpoints[endpoint.name] = endpoint
+    endpoint2 = endpoint_factory('foo2')
+    endpoint2.endpoint_data = {
+        'mac': '00:00:00:00:00:00', 'ipv4': '0.0.0.1', 'ipv6': '1212::1'}
+    endpoints[endpoint2.name] = endpoint2
+    assert endpoints.by_mac('00:00:00:00:00:00') == [endpoint, endpoint2]
+    assert endpoints.by_ip('0.0.0.1') == [endpoint2]
+    assert endpoints.by_ip('1212::1') == [endpoint2]
+    assert endpoints.by_ip('') == []
+    assert endpoints.by_state('unknown') == [endpoint, endpoint2]
+
+    endpoint.mirror()  # pytype: disable=attribute-error
+    endpoint2.ignore = True
+    endpoint2.endpoint_data = {
+        'mac': '00:00:00:00:00:01', 'ipv4': '0.0.0.1', 'ipv6': ''}
+    assert endpoints.by_state('unknown') == [endpoint2]
+    assert endpoints.by_state('mirroring') == [endpoint]
+    assert endpoints.by_mac('00:00:00:00:00:00') == [endpoint]
+    assert endpoints.by_ip('1212::1') == []
+    assert endpoints.ignored() == [endpoint2]
+
+    endpoint.endpoint_data['ipv4'] = '0.0.0.2'
+    with pytest.raises(AssertionError):
+        endpoints.check()
+    endpoints.reindex(endpoint)
+    assert endpoints.by_ip('0.0.0.2') == [endpoint]
+
+    assert endpoints.pop('foo2') is endpoint2
+    endpoint2.ignore = False
+    assert endpoints.ignored() == []
+    del endpoints['foo']
+    assert endpoints.by_mac('00:00:00:00:00:00') == []
+    endpoints.update({'foo': endpoint})
+    endpoints.clear()
+    assert endpoints.by_state('mirroring') == []
+
+
+def test_machine_record():
+    record = MachineRecord({'mac': '00:00:00:00:00:00', 'active': 1})
+    with pytest.raises(TypeError):
+        record['active'] = 0
+    with pytest.raises(TypeError):
+        record.update(active=0)
+    updated = record.updated(active=0)
+    assert record['active'] == 1
+    assert updated == {'mac': '00:00:00:00:00:00', 'active': 0}
+    assert isinstance(updated, MachineRecord)
+    assert copy.deepcopy(record) is record
+    assert json.loads(json.dumps(record)) == record
+
+    endpoints = EndpointIndex()
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = record
+    endpoints[endpoint.name] = endpoint
+    endpoint.mark_persisted(endpoint.encode())
+    endpoint.update_endpoint_data(ipv4='10.0.0.1')
+    assert endpoint.is_dirty()
+    assert endpoints.by_ip('10.0.0.1') == [endpoint]
+    assert 'ipv4' not in record
+    endpoint.endpoint_data = {'mac': '00:00:00:00:00:00'}
+    endpoint.update_endpoint_data(active=0)
+    assert isinstance(endpoint.endpoint_data, MachineRecord)
+    assert endpoint.endpoint_data == {'mac': '00:00:00:00:00:00', 'active': 0}
@@ -43,6 +43,32 @@ def test_get_endpoints():
         assert isinstance(a, list)
 
 
+def test_get_endpoints_changed_only():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        faucetconfgetsetter_cl = FaucetLocalConfGetSetter
+        faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE = os.path.join(tmpdir, 'faucet.yaml')
+        shutil.copy(SAMPLE_CONFIG, faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE)
+        controller = Config().get_config()
+        controller['LEARN_PUBLIC_ADDRESSES'] = True
+        proxy = _get_proxy(faucetconfgetsetter_cl, controller)
+
+        def learn(mac, port):
+            return {'dp_name': 'switch', 'L2_LEARN': {
+                'l3_src_ip': '10.0.0.1', 'eth_src': mac, 'port_no': port, 'vid': '100'}}
+
+        a = proxy.get_endpoints(messages=[learn('00:00:00:00:00:00', 1), learn('00:00:00:00:00:01', 2)], changed_only=True)
+        assert len(a) == 2
+        assert proxy.get_endpoints(changed_only=True) == []
+        a = proxy.get_endpoints(messages=[{'dp_name': 'switch', 'L2_EXPIRE': {
+            'eth_src': '00:00:00:00:00:01', 'port_no': 2, 'vid': '100'}}], changed_only=True)
+        assert [entry[0]['mac'] for entry in a] == ['00:00:00:00:00:01']
+        assert a[0][0]['active'] == 0
+        a = proxy.get_endpoints(messages=[{'dp_name': 'switch', 'PORT_CHANGE': {
+            'port_no': 1, 'reason': 'MODIFY', 'status': False}}], changed_only=True)
+        assert [entry[0]['mac'] for entry in a] == ['00:00:00:00:00:00']
+        assert len(proxy.get_endpoints()) == 2
+
+
 def test_FaucetProxy():
     """
     Tests Faucet
@@ -78,3 +104,6 @@ def test_format_endpoints():
     data = [[{'ip-state': 'foo'}, {'ip-state': 'bar'}],
             [{'ip-state': 'foo', 'ip-address': '0.0.0.0'}, {'ip-state': 'bar', 'ip-address': '::1'}]]
     output = FaucetProxy.format_endpoints(data)
+    assert data[1] == [{'ip-state': 'foo', 'ip-address': '0.0.0.0'}, {'ip-state': 'bar', 'ip-address': '::1'}]
+    assert output[1]['ipv4'] == '0.0.0.0'
+    assert output[1]['ipv6'] == '::1'
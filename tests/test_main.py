@@ -9,18 +9,29 @@ import json
 import logging
 import os
 import queue
+import tempfile
+import threading
 import time
 
+import pytest
 from prometheus_client import Gauge
+from prometheus_client import REGISTRY
 
+import poseidon.main
 from poseidon.constants import NO_DATA
+from poseidon.controllers.faucet.parser import FaucetEventBuffer
 from poseidon.helpers.config import Config
+from poseidon.helpers.dispatch import Dispatcher
 from poseidon.helpers.endpoint import endpoint_factory
+from poseidon.helpers.endpoint import EndpointIndex
 from poseidon.helpers.metadata import DNSResolver
+from poseidon.helpers.metadata import get_ether_vendor
+from poseidon.helpers.metadata import get_ether_vendors
+from poseidon.helpers.rabbit import RabbitConsumer
+from poseidon.helpers.stages import stage_timer
 from poseidon.main import CTRL_C
 from poseidon.main import Monitor
 from poseidon.main import rabbit_callback
-from poseidon.main import schedule_thread_worker
 from poseidon.main import SDNConnect
 
 logger = logging.getLogger('test')
@@ -36,6 +47,86 @@ def test_rdns():
     assert not res
 
 
+def test_dns_resolver_cache():
+    lookups = []
+    lookup_done = threading.Event()
+
+    class MockDNSResolver(DNSResolver):
+
+        def _resolve_ip(self, ip):
+            lookup_done.wait(5)
+            lookups.append(ip)
+            if ip == '10.0.0.1':
+                return 'one.internal'
+            return NO_DATA
+
+    resolver = MockDNSResolver(cache_size=2, ttl=60, negative_ttl=10)
+    lookup_done.set()
+    assert resolver.resolve_ips(['10.0.0.1', '10.0.0.2']) == {
+        '10.0.0.1': 'one.internal', '10.0.0.2': NO_DATA}
+    assert resolver.resolve_ips(['10.0.0.1', '10.0.0.2']) == {
+        '10.0.0.1': 'one.internal', '10.0.0.2': NO_DATA}
+    assert sorted(lookups) == ['10.0.0.1', '10.0.0.2']
+    assert resolver.cache['10.0.0.1'][1] - resolver.cache['10.0.0.2'][1] > 40
+    resolver.resolve_ips(['10.0.0.3'])
+    assert list(resolver.cache.keys()) == ['10.0.0.2', '10.0.0.3']
+
+    resolver = MockDNSResolver(blocking=False)
+    lookup_done.clear()
+    assert resolver.resolve_ips(['10.0.0.1']) == {'10.0.0.1': NO_DATA}
+    lookup_done.set()
+    resolver.pending['10.0.0.1'].result()
+    assert resolver.pop_resolved() == {'10.0.0.1': 'one.internal'}
+    assert resolver.pop_resolved() == {}
+    assert resolver.resolve_ips(['10.0.0.1']) == {'10.0.0.1': 'one.internal'}
+    # expired results are still used while they are refreshed.
+    resolver.cache['10.0.0.1'] = ('old.internal', 0)
+    lookup_done.clear()
+    assert resolver.resolve_ips(['10.0.0.1']) == {'10.0.0.1': 'old.internal'}
+    lookup_done.set()
+    resolver.pending['10.0.0.1'].result()
+    assert resolver.resolve_ips(['10.0.0.1']) == {'10.0.0.1': 'one.internal'}
+
+
+def test_get_ether_vendors():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        lookup_path = os.path.join(tmpdir, 'nmap-mac-prefixes.txt')
+        with open(lookup_path, 'w') as f:
+            f.write('# comment\n0050C2\tIEEE Registration Authority\n0050C2123\tFoo Systems\n3CD92B\tHP\n')
+        assert get_ether_vendors(
+            ['00:50:c2:12:34:56', '00:50:c2:99:34:56', '3c:d9:2b:00:00:01', '00:00:00:00:00:01'],
+            lookup_path) == {
+                '00:50:c2:12:34:56': 'Foo',
+                '00:50:c2:99:34:56': 'IEEE',
+                '3c:d9:2b:00:00:01': 'HP',
+                '00:00:00:00:00:01': None}
+        with open(lookup_path, 'w') as f:
+            f.write('3CD92B\tHewlett Packard\n')
+        os.utime(lookup_path, (0, 0))
+        assert get_ether_vendor('3c:d9:2b:00:00:01', lookup_path) == 'Hewlett'
+        assert get_ether_vendor('00:50:c2:12:34:56', lookup_path) is None
+    assert get_ether_vendor('3c:d9:2b:00:00:01', lookup_path) == NO_DATA
+
+
+def test_update_resolved_rdns():
+    controller = get_test_controller()
+    s = SDNConnect(controller)
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1',
+        'ipv4': '10.0.0.1', 'ipv4_rdns': NO_DATA, 'ipv6': '', 'ipv6_rdns': NO_DATA}
+    s.endpoints[endpoint.name] = endpoint
+    s.dns_resolver.resolved = {'10.0.0.1': 'one.internal'}
+    s.update_resolved_rdns()
+    assert endpoint.endpoint_data['ipv4_rdns'] == 'one.internal'
+    assert endpoint.endpoint_data['ipv6_rdns'] == NO_DATA
+
+
+@pytest.fixture(autouse=True)
+def endpoint_index_self_check(monkeypatch):
+    monkeypatch.setattr(EndpointIndex, 'self_check', True)
+
+
 def get_test_controller():
     controller = Config().get_config()
     controller['faucetconfrpc_address'] = None
@@ -87,6 +178,27 @@ def test_check_endpoints():
     s.check_endpoints()
 
 
+def test_check_endpoints_reconcile():
+    controller = get_test_controller()
+    controller['reconcile_frequency'] = 300
+    s = SDNConnect(controller)
+    assert s.reconcile_due()
+    assert not s.reconcile_due()
+    s.last_reconcile -= 300
+    assert s.reconcile_due()
+    s.reconcile_frequency = 0
+    assert s.reconcile_due()
+
+    s.reconcile_frequency = 300
+    s.sdnc.mac_table = {}
+    s.check_endpoints(messages=[{'dp_name': 'switch', 'L2_LEARN': {
+        'l3_src_ip': '10.0.0.1', 'eth_src': '00:00:00:00:00:01', 'port_no': 1, 'vid': '100'}}])
+    assert len(s.endpoints_by_mac('00:00:00:00:00:01')) == 1
+    s.check_endpoints(messages=[{'dp_name': 'switch', 'L2_EXPIRE': {
+        'eth_src': '00:00:00:00:00:01', 'port_no': 1, 'vid': '100'}}])
+    assert s.endpoints_by_mac('00:00:00:00:00:01')[0].state == 'inactive'
+
+
 def test_endpoint_by_name():
     controller = get_test_controller()
     s = SDNConnect(controller)
@@ -139,6 +251,24 @@ def test_endpoints_by_mac():
     assert [endpoint] == endpoint2
 
 
+def test_refresh_endpoints_write_behind():
+    controller = get_test_controller()
+    s = SDNConnect(controller)
+    reloads = []
+    s.get_stored_endpoints = lambda: reloads.append(True)
+    s.write_behind = True
+    s.refresh_endpoints()
+    assert not reloads
+    s.request_reload()
+    s.refresh_endpoints()
+    assert len(reloads) == 1
+    s.refresh_endpoints()
+    assert len(reloads) == 1
+    s.write_behind = False
+    s.refresh_endpoints()
+    assert len(reloads) == 2
+
+
 def test_signal_handler():
 
     class MockLogger:
@@ -158,6 +288,7 @@ def test_signal_handler():
             self.logger = logger
             self.controller = get_test_controller()
             self.s = SDNConnect(self.controller)
+            self.dispatcher = Dispatcher()
 
     class MockSchedule:
         call_log = []
@@ -229,7 +360,7 @@ def test_format_rabbit_message():
             self.logger = logger
             self.controller = get_test_controller()
             self.s = SDNConnect(self.controller)
-            self.faucet_event = []
+            self.faucet_event = FaucetEventBuffer()
             self.s.sdnc = MockParser()
 
         def update_routing_key_time(self, routing_key):
@@ -248,7 +379,7 @@ def test_format_rabbit_message():
     retval, msg_valid = mockMonitor.format_rabbit_message(message)
     assert retval == {'Key1': 'Val1'}
     assert msg_valid
-    assert mockMonitor.faucet_event == [{'Key1': 'Val1'}]
+    assert list(mockMonitor.faucet_event) == [{'Key1': 'Val1'}]
 
     message = (None, json.dumps(data))
     retval, msg_valid = mockMonitor.format_rabbit_message(message)
@@ -287,6 +418,12 @@ def test_format_rabbit_message():
     assert retval == {}
     assert msg_valid
 
+    message = ('poseidon.action.reload', json.dumps({}))
+    retval, msg_valid = mockMonitor.format_rabbit_message(message)
+    assert retval == {}
+    assert msg_valid
+    assert mockMonitor.s.reload_requested
+
     data = [('foo', 'unknown')]
     message = ('poseidon.action.change', json.dumps(data))
     retval, msg_valid = mockMonitor.format_rabbit_message(message)
@@ -303,7 +440,11 @@ def test_rabbit_callback():
     assert mock_method()
 
     class MockChannel:
-        def basic_ack(self, delivery_tag): return True
+        acked = None
+
+        def basic_ack(self, delivery_tag):
+            self.acked = delivery_tag
+            return True
 
     class MockQueue:
         item = None
@@ -311,7 +452,7 @@ def test_rabbit_callback():
         def qsize(self):
             return 1
 
-        def put(self, item):
+        def put_nowait(self, item):
             self.item = item
             return True
 
@@ -327,14 +468,91 @@ def test_rabbit_callback():
         'properties',
         'body',
         mock_queue)
-    assert mock_queue.get_item() == (mock_method.routing_key, 'body')
+    # acked later, once processed.
+    assert mock_queue.get_item() == (
+        mock_method.routing_key, 'body', mock_channel, mock_method.delivery_tag)
+    assert mock_channel.acked is None
 
     rabbit_callback(
         mock_channel,
         mock_method,
         'properties',
-        'body',
-        mock_queue)
+        'body')
+    assert mock_channel.acked == mock_method.delivery_tag
+
+    # a full queue doesn't block the consumer.
+    full_queue = queue.Queue(maxsize=1)
+    full_queue.put('item')
+    with pytest.raises(queue.Full):
+        rabbit_callback(
+            mock_channel,
+            mock_method,
+            'properties',
+            'body',
+            full_queue)
+    assert full_queue.qsize() == 1
+
+
+def test_diff_machine():
+    machine_a = {'mac': '00:00:00:00:00:00', 'port': '1', 'active': 1, 'ipv4': '10.0.0.1'}
+    machine_b = {'mac': '00:00:00:00:00:00', 'port': '2', 'active': 1, 'ipv6': '::1'}
+    machine_diff = SDNConnect.diff_machine(machine_a, machine_b)
+    assert machine_diff == {
+        'port': ('1', '2'), 'ipv4': ('10.0.0.1', None), 'ipv6': (None, '::1')}
+    assert SDNConnect._diff_machine_text(machine_diff) == (
+        'ipv4: 10.0.0.1 -> None, ipv6: None -> ::1, port: 1 -> 2')
+
+
+def test_find_new_machines_changed_fields():
+    controller = get_test_controller()
+    s = SDNConnect(controller)
+    s.prc.store_endpoints = lambda endpoints: None
+    machine = {'active': 1, 'tenant': 'vlan1', 'port': 1, 'segment': 'switch1',
+               'ipv4': '10.0.0.1', 'mac': '00:00:00:00:00:00', 'ipv6': '0'}
+    s.find_new_machines([dict(machine)])
+    endpoint = s.endpoints_by_mac('00:00:00:00:00:00')[0]
+    endpoint.mark_persisted(endpoint.encode())
+    assert not endpoint.is_dirty()
+    machine['active'] = 0
+    s.find_new_machines([dict(machine)])
+    assert endpoint.changed_fields == {'active'}
+    assert endpoint.is_dirty()
+    endpoint.mark_persisted(endpoint.encode())
+    assert endpoint.changed_fields == set()
+
+
+def test_find_new_machines_role_change_updates_acls(monkeypatch):
+    acl_updates = []
+
+    class MockActions:
+
+        def __init__(self, endpoint, sdnc):
+            pass
+
+        def update_acls(self, rules_file=None, endpoints=None):
+            acl_updates.append(rules_file)
+            return True
+
+    monkeypatch.setattr(poseidon.main, 'Actions', MockActions)
+    controller = get_test_controller()
+    controller['AUTOMATED_ACLS'] = True
+    s = SDNConnect(controller)
+    s.prc.store_endpoints = lambda endpoints: None
+    machine = {'active': 1, 'tenant': 'vlan1', 'port': 1, 'segment': 'switch1',
+               'ipv4': '10.0.0.1', 'mac': '00:00:00:00:00:00', 'ipv6': '0'}
+    s.find_new_machines([dict(machine)])
+    assert len(acl_updates) == 1
+    endpoint = s.endpoints_by_mac('00:00:00:00:00:00')[0]
+    endpoint.mark_persisted(endpoint.encode())
+    s.find_new_machines([dict(machine)])
+    assert len(acl_updates) == 1
+    endpoint.update_metadata({'mac_addresses': {'00:00:00:00:00:00': {
+        '1551805502': {'labels': ['developer workstation'], 'confidences': [0.8]}}}})
+    assert endpoint.changed_fields == {'role'}
+    assert not endpoint.is_dirty()
+    s.find_new_machines([dict(machine)])
+    assert len(acl_updates) == 2
+    assert endpoint.changed_fields == set()
 
 
 def test_find_new_machines():
@@ -365,8 +583,27 @@ def test_Monitor_init():
              {'active': 1, 'source': 'poseidon1', 'role': 'unknown', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1',
                  'port': 2, 'segment': 'switch1', 'ipv4': '2106::1', 'mac': '00:00:00:00:00:00', 'id': 'foo4', 'behavior': 1, 'ipv6': '0'},
              {'active': 1, 'source': 'poseidon', 'role': 'unknown', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1', 'port': 1, 'segment': 'switch1', 'ipv4': '::', 'mac': '00:00:00:00:00:00', 'id': 'foo5', 'behavior': 1, 'ipv6': '0'}]
-    monitor.prom.update_metrics(hosts)
+    monitor.s.find_new_machines(hosts)
+    assert REGISTRY.get_sample_value('poseidon_endpoint_active') is not None
     monitor.update_routing_key_time('foo')
+    monitor.s.sdnc.mac_history_evictions = 2
+    monitor._update_parser_metrics()
+    assert monitor.s.sdnc.mac_history_evictions == 0
+    stage_timer.record(('format_rabbit_message', 'foo'), 0.1, error=True)
+    monitor._update_stage_metrics()
+    assert REGISTRY.get_sample_value('poseidon_stage_errors_total', {
+        'stage': 'format_rabbit_message', 'routing_key': 'foo'}) >= 1
+    assert stage_timer.pop() == ({}, {})
+    monitor.faucet_event.add({'dp_name': 't1-1', 'PORT_CHANGE': {'port_no': 1, 'status': False}})
+    monitor.faucet_event.add({'dp_name': 't1-1', 'PORT_CHANGE': {'port_no': 1, 'status': True}})
+    monitor._update_queue_metrics()
+    assert monitor.faucet_event.coalesced == 0
+    monitor._update_rabbit_metrics()
+    monitor.rabbit_consumer = RabbitConsumer('localhost', 5672, rabbit_callback)
+    monitor.rabbit_consumer.lag[('topic-recs', 'poseidon_main')] = 4
+    monitor.rabbit_consumer.reconnects = 3
+    monitor._update_rabbit_metrics()
+    assert monitor.rabbit_consumer.reconnects == 0
 
 
 def test_SDNConnect_init():
@@ -383,21 +620,32 @@ def test_process():
         CTRL_C['STOP'] = False
         time.sleep(5)
         CTRL_C['STOP'] = True
+        mock_monitor.dispatcher.notify()
+
+    class MockSchedule:
+
+        def run_pending(self):
+            pass
+
+        def idle_seconds(self):
+            return None
 
     class MockMonitor(Monitor):
 
         def __init__(self):
             self.logger = logger
             self.fa_rabbit_routing_key = 'FAUCET.Event'
-            self.faucet_event = None
+            self.faucet_event = FaucetEventBuffer()
             self.controller = get_test_controller()
             self.s = SDNConnect(self.controller)
             self.s.controller['TYPE'] = 'None'
             self.s.get_sdn_context()
             self.s.controller['TYPE'] = 'faucet'
             self.s.get_sdn_context()
-            self.job_queue = queue.Queue()
-            self.m_queue = queue.Queue()
+            self.schedule = MockSchedule()
+            self.dispatcher = Dispatcher()
+            self.job_queue = self.dispatcher.queue('jobs')
+            self.m_queue = self.dispatcher.queue('rabbit')
             endpoint = endpoint_factory('foo')
             endpoint.endpoint_data = {
                 'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
@@ -450,6 +698,141 @@ def test_process():
     t1.join()
 
 
+def test_process_dispatch():
+    from threading import Thread
+
+    class MockSchedule:
+
+        def __init__(self):
+            self.next_run = time.time() + 0.5
+            self.runs = 0
+
+        def run_pending(self):
+            if time.time() >= self.next_run:
+                self.runs += 1
+                self.next_run = time.time() + 60
+
+        def idle_seconds(self):
+            return self.next_run - time.time()
+
+    class MockMonitor(Monitor):
+
+        def __init__(self):
+            self.logger = logger
+            self.controller = get_test_controller()
+            self.s = SDNConnect(self.controller)
+            self.s.refresh_endpoints = lambda: None
+            self.faucet_event = FaucetEventBuffer()
+            self.schedule = MockSchedule()
+            self.dispatcher = Dispatcher()
+            self.job_queue = self.dispatcher.queue('jobs')
+            self.m_queue = self.dispatcher.queue('rabbit')
+
+        def schedule_mirroring(self):
+            return
+
+    monitor = MockMonitor()
+    calls = []
+
+    def job():
+        calls.append(time.time())
+        if monitor.schedule.runs:
+            CTRL_C['STOP'] = True
+
+    def queue_jobs():
+        time.sleep(0.1)
+        monitor.queue_job(job)
+        time.sleep(0.6)
+        monitor.queue_job(job)
+
+    CTRL_C['STOP'] = False
+    t1 = Thread(target=queue_jobs)
+    start = time.time()
+    t1.start()
+    monitor.process()
+    t1.join()
+    # jobs run as soon as they are queued, and timers fire when due.
+    assert len(calls) == 2
+    assert calls[0] - start < 0.5
+    assert monitor.schedule.runs == 1
+    latencies = monitor.dispatcher.pop_latencies()
+    assert len(latencies['jobs']) == 2
+    assert max(latencies['jobs']) < 0.5
+    CTRL_C['STOP'] = False
+
+
+def test_process_ready_rollback():
+    from poseidon.controllers.faucet.config import FaucetLocalConfGetSetter
+
+    class MockRabbit:
+
+        def __init__(self):
+            self.acks = []
+
+        def ack_messages(self, ch, delivery_tag):
+            self.acks.append((ch, delivery_tag))
+
+    class MockMonitor(Monitor):
+
+        def __init__(self):
+            self.logger = logger
+            self.controller = get_test_controller()
+            self.s = SDNConnect(self.controller)
+            self.s.refresh_endpoints = lambda: None
+            self.faucet_event = FaucetEventBuffer()
+            self.dispatcher = Dispatcher()
+            self.job_queue = self.dispatcher.queue('jobs')
+            self.m_queue = self.dispatcher.queue('rabbit')
+            self.rabbit = MockRabbit()
+
+        def format_rabbit_message(self, item):
+            # mirror the endpoint, then fail in a later stage of the cycle.
+            endpoint = self.s.endpoints['foo']
+            endpoint.trigger(endpoint.p_next_state)
+            endpoint.p_next_state = None
+            endpoint.p_prev_states.append((endpoint.state, int(time.time())))
+            self.s.sdnc.faucetconfgetsetter.set_mirror_config('t1-1', 2, [3])
+            return ({}, True)
+
+        def schedule_mirroring(self):
+            raise ValueError('fail')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        faucet_conf_file = os.path.join(tmpdir, 'faucet.yaml')
+        FaucetLocalConfGetSetter.DEFAULT_CONFIG_FILE = faucet_conf_file
+        with open('tests/sample_faucet_config.yaml') as f:
+            faucet_conf = f.read()
+        with open(faucet_conf_file, 'w') as f:
+            f.write(faucet_conf)
+        monitor = MockMonitor()
+        with open(faucet_conf_file) as f:
+            faucet_conf = f.read()
+        endpoint = endpoint_factory('foo')
+        endpoint.endpoint_data = {
+            'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1'}
+        endpoint.p_next_state = 'mirror'
+        endpoint.queue()
+        endpoint.p_prev_states.append((endpoint.state, int(time.time())))
+        monitor.s.endpoints[endpoint.name] = endpoint
+        history = len(endpoint.history)
+        endpoint.mark_persisted('{}')
+        monitor.m_queue.put(('foo', {}, 'ch', 1))
+        with pytest.raises(ValueError):
+            monitor.process_ready()
+        # the config changes and the endpoint's state changes are undone.
+        with open(faucet_conf_file) as f:
+            assert f.read() == faucet_conf
+        assert endpoint.state == 'queued'
+        assert endpoint.p_next_state == 'mirror'
+        assert len(endpoint.p_prev_states) == 1
+        assert len(endpoint.history) == history
+        assert monitor.s.endpoints.by_state('queued') == [endpoint]
+        # stored again, as Redis may have the undone state.
+        assert endpoint._persisted is None
+        assert not monitor.rabbit.acks
+        assert monitor.s.endpoints.journal is None
+
+
 def test_show_endpoints():
     endpoint = endpoint_factory('foo')
     endpoint.endpoint_data = {
@@ -479,35 +862,3 @@ def test_merge_machine():
     assert old_machine['ipv4'] == new_machine['ipv4']
     assert new_machine['ipv6'] == new_machine['ipv6']
 
-
-def test_schedule_thread_worker():
-    from threading import Thread
-
-    def thread1():
-        global CTRL_C
-        CTRL_C['STOP'] = False
-        time.sleep(5)
-        CTRL_C['STOP'] = True
-
-    class mockSchedule():
-
-        def __init__(self):
-            pass
-
-        def run_pending(self):
-            pass
-
-    class mocksys():
-
-        def __init__(self):
-            pass
-
-    sys = mocksys()
-    t1 = Thread(target=thread1)
-    t1.start()
-    try:
-        schedule_thread_worker(mockSchedule())
-    except SystemExit:
-        pass
-
-    t1.join()
@@ -8,8 +8,10 @@ import os
 import shutil
 import tempfile
 import yaml
+from poseidon.controllers.faucet.config import FaucetRemoteConfGetSetter
 from poseidon.controllers.faucet.faucet import FaucetProxy
 from poseidon.controllers.faucet.helpers import get_config_file, parse_rules, represent_none
+from poseidon.controllers.faucet.parser import FaucetEventBuffer
 from poseidon.controllers.faucet.parser import Parser, FaucetLocalConfGetSetter
 from poseidon.helpers.config import Config
 from poseidon.helpers.endpoint import endpoint_factory
@@ -49,6 +51,265 @@ def test_ignore_events():
             {'dp_name': 'switch123', 'UNKNOWN': {'vid': 123, 'port_no': 123}})
 
 
+def test_faucet_conf_cache(monkeypatch):
+    import poseidon.controllers.faucet.config as faucet_config
+    parses = []
+    orig_yaml_in = faucet_config.yaml_in
+
+    def counting_yaml_in(config_file):
+        parses.append(config_file)
+        return orig_yaml_in(config_file)
+
+    monkeypatch.setattr(faucet_config, 'yaml_in', counting_yaml_in)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_file = os.path.join(tmpdir, 'faucet.yaml')
+        shutil.copy(SAMPLE_CONFIG, config_file)
+        getsetter = FaucetLocalConfGetSetter()
+        getsetter.DEFAULT_CONFIG_FILE = config_file
+        dps = getsetter.get_dps()
+        assert getsetter.get_dps() is dps
+        getsetter.get_port_conf('t1-1', 2)
+        assert len(parses) == 1
+
+        # our own writes don't need parsing again.
+        getsetter.set_mirror_config('t1-1', 2, [2])
+        assert getsetter.get_port_conf('t1-1', 2)['mirror'] == [2]
+        assert len(parses) == 1
+
+        # but changes made by others do.
+        with open(config_file) as f:
+            faucet_conf = yaml.safe_load(f)
+        faucet_conf['dps']['t1-1']['interfaces'][2]['mirror'] = [3, 4]
+        with open(config_file, 'w') as f:
+            yaml.dump(faucet_conf, f)
+        assert getsetter.get_port_conf('t1-1', 2)['mirror'] == [3, 4]
+        assert len(parses) == 2
+
+        # as does replacing the config in memory.
+        getsetter.faucet_conf = {}
+        assert getsetter.get_dps()
+        assert len(parses) == 3
+
+
+def test_faucet_conf_transaction(monkeypatch):
+    import poseidon.controllers.faucet.config as faucet_config
+    writes = []
+    orig_yaml_out = faucet_config.yaml_out
+
+    def counting_yaml_out(config_file, obj_doc):
+        writes.append(config_file)
+        return orig_yaml_out(config_file, obj_doc)
+
+    monkeypatch.setattr(faucet_config, 'yaml_out', counting_yaml_out)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        faucetconfgetsetter_cl = FaucetLocalConfGetSetter
+        faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE = os.path.join(tmpdir, 'faucet.yaml')
+        shutil.copy(SAMPLE_CONFIG, faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE)
+        parser = _get_parser(
+            faucetconfgetsetter_cl=faucetconfgetsetter_cl,
+            mirror_ports={'t1-1': 2, 't1-2': 3}, reinvestigation_frequency=900)
+        assert len(writes) == 1
+        getsetter = parser.faucetconfgetsetter
+
+        del writes[:]
+        with parser.config_transaction():
+            parser.config_mirror('mirror', 't1-1', 3)
+            parser.config_mirror('mirror', 't1-2', 2)
+            assert getsetter.get_port_conf('t1-2', 3)['mirror'] == [2]
+            assert not writes
+        assert len(writes) == 1
+        parser.clear_mirrors()
+        assert len(writes) == 2
+        with open(faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE) as f:
+            faucet_conf = yaml.safe_load(f)
+        assert 'mirror' not in faucet_conf['dps']['t1-1']['interfaces'][2]
+        assert 'mirror' not in faucet_conf['dps']['t1-2']['interfaces'][3]
+
+        # nothing is written if the transaction fails.
+        del writes[:]
+        try:
+            with parser.config_transaction():
+                parser.config_mirror('mirror', 't1-1', 3)
+                raise ValueError('fail')
+        except ValueError:
+            pass
+        assert not writes
+        assert 'mirror' not in getsetter.get_port_conf('t1-1', 2)
+
+        # no changes, no write.
+        with parser.config_transaction():
+            parser.check_mirror('t1-1')
+        assert not writes
+
+
+def test_config_acls_transaction(monkeypatch):
+    import poseidon.controllers.faucet.config as faucet_config
+    writes = []
+    orig_yaml_out = faucet_config.yaml_out
+
+    def counting_yaml_out(config_file, obj_doc):
+        writes.append(config_file)
+        return orig_yaml_out(config_file, obj_doc)
+
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 't1-1', 'port': '3'}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        faucetconfgetsetter_cl = FaucetLocalConfGetSetter
+        faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE = os.path.join(tmpdir, 'faucet.yaml')
+        with open(SAMPLE_CONFIG) as f:
+            faucet_conf = yaml.safe_load(f)
+        faucet_conf['dps']['t1-1']['interfaces'][3]['acls_in'] = ['office-vlan-protect']
+        with open(faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE, 'w') as f:
+            yaml.dump(faucet_conf, f)
+        rules_file = os.path.join(tmpdir, 'rules.yaml')
+        with open(rules_file, 'w') as f:
+            f.write("""
+rules:
+    no-internal:
+        - rule:
+            acls: [no-internal]
+""")
+        parser = _get_parser(
+            faucetconfgetsetter_cl=faucetconfgetsetter_cl,
+            mirror_ports={'t1-1': 2})
+        monkeypatch.setattr(faucet_config, 'yaml_out', counting_yaml_out)
+
+        # nothing is written if the transaction fails after applying ACLs.
+        try:
+            with parser.config_transaction():
+                parser.config_mirror('mirror', 't1-1', 1)
+                parser.config_acls(rules_file, [endpoint], ['no-internal'], [], [])
+                assert not writes
+                raise ValueError('fail')
+        except ValueError:
+            pass
+        assert not writes
+        with open(faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE) as f:
+            faucet_conf = yaml.safe_load(f)
+        assert faucet_conf['dps']['t1-1']['interfaces'][2]['mirror'] == [3]
+        assert faucet_conf['dps']['t1-1']['interfaces'][3]['acls_in'] == ['office-vlan-protect']
+
+        # otherwise, mirroring and ACLs are written once.
+        with parser.config_transaction():
+            parser.config_mirror('mirror', 't1-1', 1)
+            parser.config_acls(rules_file, [endpoint], ['no-internal'], [], [])
+        assert len(writes) == 1
+        with open(faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE) as f:
+            faucet_conf = yaml.safe_load(f)
+        assert sorted(faucet_conf['dps']['t1-1']['interfaces'][2]['mirror']) == [1, 3]
+        assert sorted(faucet_conf['dps']['t1-1']['interfaces'][3]['acls_in']) == [
+            'no-internal', 'office-vlan-protect']
+
+
+def test_remote_faucet_conf_transaction():
+
+    class MockClient:
+
+        def __init__(self, faucet_conf):
+            self.faucet_conf = faucet_conf
+            self.calls = []
+
+        def get_config_file(self, config_filename=None):
+            self.calls.append('get_config_file')
+            return copy.deepcopy(self.faucet_conf)
+
+        def set_config_file(self, config, config_filename=None, merge=False):
+            self.calls.append(('set_config_file', merge))
+            if not merge:
+                self.faucet_conf = copy.deepcopy(config)
+                return
+            for dp, switch_conf in config['dps'].items():
+                self.faucet_conf['dps'][dp].update(copy.deepcopy(switch_conf))
+
+        def set_dp_interfaces(self, dp_interfaces):
+            self.calls.append(('set_dp_interfaces', sorted(
+                (dp, sorted(interfaces)) for dp, interfaces in dp_interfaces)))
+            for dp, interfaces in dp_interfaces:
+                for port, port_conf in interfaces.items():
+                    self.faucet_conf['dps'][dp]['interfaces'][port] = yaml.safe_load(port_conf)
+
+    class MockRemoteConfGetSetter(FaucetRemoteConfGetSetter):
+
+        def __init__(self, client):
+            super(FaucetRemoteConfGetSetter, self).__init__()
+            self.client = client
+
+    with open(SAMPLE_CONFIG) as f:
+        client = MockClient(yaml.safe_load(f))
+    getsetter = MockRemoteConfGetSetter(client)
+    with getsetter.transaction():
+        getsetter.set_mirror_config('t1-1', 2, [3])
+        # changed outside the transaction, so it must not be overwritten.
+        client.faucet_conf['dps']['t1-1']['timeout'] = 99
+        getsetter.set_mirror_config('t1-2', 3, [2])
+        # pending changes are applied to the config read again.
+        assert getsetter.get_port_conf('t1-1', 2)['mirror'] == [3]
+        getsetter.update_switch_conf('t1-2', {'timeout': 1801})
+        assert client.calls.count('get_config_file') == 3
+        assert 'timeout' not in client.faucet_conf['dps']['t1-2']
+    # one write of the changed interfaces, one merge of the changed switches.
+    assert client.calls[3:] == [
+        ('set_dp_interfaces', [('t1-1', [2]), ('t1-2', [3])]),
+        ('set_config_file', True)]
+    assert client.faucet_conf['dps']['t1-1']['interfaces'][2]['mirror'] == [3]
+    assert client.faucet_conf['dps']['t1-2']['interfaces'][3]['mirror'] == [2]
+    assert client.faucet_conf['dps']['t1-2']['timeout'] == 1801
+    assert client.faucet_conf['dps']['t1-1']['timeout'] == 99
+
+    del client.calls[:]
+    getsetter.set_mirror_config('t1-1', 2, None)
+    assert client.calls == ['get_config_file', ('set_dp_interfaces', [('t1-1', [2])])]
+
+    # the config is read if it hasn't been, rather than the change dropped.
+    getsetter = MockRemoteConfGetSetter(client)
+    del client.calls[:]
+    with getsetter.transaction():
+        assert getsetter.set_port_conf('t1-2', 2, {'native_vlan': 'office', 'mirror': [3]})
+        assert getsetter.update_switch_conf('t1-2', {'timeout': 901})
+        assert getsetter.set_port_conf('t9-9', 2, {}) is None
+    assert client.calls == [
+        'get_config_file', ('set_dp_interfaces', [('t1-2', [2])]),
+        ('set_config_file', True)]
+    assert client.faucet_conf['dps']['t1-2']['interfaces'][2]['mirror'] == [3]
+    assert client.faucet_conf['dps']['t1-2']['timeout'] == 901
+
+    # nothing is sent if the transaction fails.
+    del client.calls[:]
+    try:
+        with getsetter.transaction():
+            getsetter.set_mirror_config('t1-1', 2, [3])
+            raise ValueError('fail')
+    except ValueError:
+        pass
+    assert client.calls == ['get_config_file']
+    assert 'mirror' not in client.faucet_conf['dps']['t1-1']['interfaces'][2]
+
+
+def test_remote_update_switch_conf():
+
+    class MockClient:
+
+        def __init__(self):
+            self.set_config_files = []
+
+        def set_config_file(self, config, config_filename=None, merge=False):
+            self.set_config_files.append((config, merge))
+
+    class MockRemoteConfGetSetter(FaucetRemoteConfGetSetter):
+
+        def __init__(self, client):
+            super(FaucetRemoteConfGetSetter, self).__init__()
+            self.client = client
+
+    client = MockClient()
+    getsetter = MockRemoteConfGetSetter(client)
+    getsetter.faucet_conf = {'dps': {'t1-1': {'timeout': 1}, 't1-2': {'timeout': 1}}}
+    getsetter.update_switch_conf('t1-2', {'timeout': 1801})
+    # only the partial config is merged, not the whole cached config.
+    assert client.set_config_files == [({'dps': {'t1-2': {'timeout': 1801}}}, True)]
+
+
 def test_parse_rules():
     with tempfile.TemporaryDirectory() as tmpdir:
         shutil.copy(SAMPLE_CONFIG, tmpdir)
@@ -333,3 +594,109 @@ def test_Parser():
         check_config(parser, endpoints)
         check_config(parser2, endpoints)
         check_config(proxy, endpoints)
+
+
+def test_mac_history():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        faucetconfgetsetter_cl = FaucetLocalConfGetSetter
+        faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE = os.path.join(tmpdir, 'faucet.yaml')
+        parser = _get_parser(faucetconfgetsetter_cl=faucetconfgetsetter_cl, mac_history_size=2)
+
+        def learn(port):
+            parser.event({'dp_name': 't1-1', 'L2_LEARN': {
+                'l3_src_ip': '10.0.0.1', 'eth_src': '00:00:00:00:00:01', 'port_no': port, 'vid': 100}})
+
+        def expire():
+            parser.event({'dp_name': 't1-1', 'L2_EXPIRE': {
+                'eth_src': '00:00:00:00:00:01', 'port_no': 1, 'vid': 100}})
+
+        learn(1)
+        learn(2)
+        expire()
+        learn(2)
+        mac_history = parser.mac_table['00:00:00:00:00:01']
+        assert [data['port'] for data in mac_history] == ['2', '1']
+        assert mac_history[0]['active'] == 1
+        assert parser.mac_history_evictions == 0
+        learn(1)
+        learn(3)
+        assert [data['port'] for data in mac_history] == ['3', '1']
+        assert [data['port'] for data in reversed(mac_history)] == ['1', '3']
+        assert parser.mac_history_evictions == 1
+        assert ('t1-1', '2') not in parser.port_macs
+        assert parser.port_macs[('t1-1', '1')] == {'00:00:00:00:00:01'}
+        parser.event({'dp_name': 't1-1', 'PORT_CHANGE': {
+            'port_no': 2, 'reason': 'MODIFY', 'status': False}})
+        assert mac_history[0]['active'] == 1
+
+
+def test_port_change_storm():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        faucetconfgetsetter_cl = FaucetLocalConfGetSetter
+        faucetconfgetsetter_cl.DEFAULT_CONFIG_FILE = os.path.join(tmpdir, 'faucet.yaml')
+        parser = _get_parser(faucetconfgetsetter_cl=faucetconfgetsetter_cl)
+        switches = ['switch%u' % i for i in range(10)]
+        for i in range(20000):
+            # hosts move once, so they have a history on two ports.
+            for port in (i % 48 + 1, (i + 1) % 48 + 1):
+                parser.event({'dp_name': switches[i % len(switches)], 'L2_LEARN': {
+                    'l3_src_ip': '10.0.0.1', 'eth_src': '%012x' % i, 'port_no': port, 'vid': 100}})
+        down_ports = {(switch, str(port)) for switch in switches[:5] for port in range(1, 49, 2)}
+        expected = {
+            mac for mac, entries in parser.mac_table.items()
+            if any((entry['segment'], entry['port']) in down_ports for entry in entries)}
+        for dp_name, port in sorted(down_ports):
+            parser.event({'dp_name': dp_name, 'PORT_CHANGE': {
+                'port_no': int(port), 'reason': 'MODIFY', 'status': False}})
+        inactive = {mac for mac, entries in parser.mac_table.items() if entries[0]['active'] == 0}
+        assert expected
+        assert inactive == expected
+
+
+def test_faucet_event_buffer():
+
+    def learn(mac, port):
+        return {'dp_name': 't1-1', 'L2_LEARN': {
+            'eth_src': mac, 'port_no': port, 'vid': 2, 'l3_src_ip': '10.0.0.1'}}
+
+    def expire(mac):
+        return {'dp_name': 't1-1', 'L2_EXPIRE': {'eth_src': mac, 'port_no': 1, 'vid': 2}}
+
+    def port_change(port, status):
+        return {'dp_name': 't1-1', 'PORT_CHANGE': {'port_no': port, 'status': status}}
+
+    buffer = FaucetEventBuffer(maxsize=3)
+    assert buffer.add(learn('00:00:00:00:00:01', 1))
+    assert buffer.add(port_change(1, False))
+    assert buffer.add(learn('00:00:00:00:00:01', 2))
+    assert buffer.add(expire('00:00:00:00:00:01'))
+    assert buffer.add(port_change(1, True))
+    assert buffer.add(learn('00:00:00:00:00:02', 1))
+    assert buffer.full()
+    assert not buffer.add(learn('00:00:00:00:00:03', 1))
+    assert buffer.add(expire('00:00:00:00:00:02'))
+    assert buffer.coalesced == 2
+    assert buffer.dropped == 1
+    events = buffer.pop_all()
+    assert events == [
+        port_change(1, False),
+        learn('00:00:00:00:00:01', 2),
+        expire('00:00:00:00:00:01'),
+        learn('00:00:00:00:00:02', 1),
+        expire('00:00:00:00:00:02')]
+    assert len(buffer) == 0
+
+    # the coalesced events leave the parser in the same state as all of them.
+    messages = [
+        learn('00:00:00:00:00:01', 1), port_change(1, False),
+        learn('00:00:00:00:00:01', 2), expire('00:00:00:00:00:01'),
+        port_change(1, True), learn('00:00:00:00:00:02', 1),
+        expire('00:00:00:00:00:02')]
+    parser = Parser(mac_history_size=1)
+    coalesced_parser = Parser(mac_history_size=1)
+    for message in messages:
+        parser.event(message)
+    for message in events:
+        coalesced_parser.event(message)
+    assert {mac: list(history) for mac, history in parser.mac_table.items()} == {
+        mac: list(history) for mac, history in coalesced_parser.mac_table.items()}
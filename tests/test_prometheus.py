@@ -3,6 +3,11 @@
 Test module for prometheus
 @author: Charlie Lewis
 """
+from prometheus_client import CollectorRegistry
+
+from poseidon.constants import NO_DATA
+from poseidon.helpers.endpoint import endpoint_factory
+from poseidon.helpers.prometheus import ip2int
 from poseidon.helpers.prometheus import Prometheus
 
 
@@ -10,14 +15,91 @@ def test_Prometheus():
     """
     Tests Prometheus
     """
-    p = Prometheus.get_metrics()
-    hosts = [{'active': 0, 'source': 'poseidon', 'role': 'unknown', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1', 'port': 1, 'segment': 'switch1', 'ipv4': '123.123.123.123', 'mac': '00:00:00:00:00:00', 'id': 'foo1', 'behavior': 1},
-             {'active': 1, 'source': 'poseidon', 'role': 'unknown', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1',
-                 'port': 1, 'segment': 'switch1', 'ipv4': '123.123.123.123', 'mac': '00:00:00:00:00:00', 'id': 'foo2', 'behavior': 1},
-             {'active': 0, 'source': 'poseidon', 'role': 'unknown', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1',
-                 'port': 1, 'segment': 'switch1', 'ipv4': '123.123.123.123', 'mac': '00:00:00:00:00:00', 'id': 'foo3', 'behavior': 1},
-             {'active': 1, 'source': 'poseidon1', 'role': 'unknown', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1',
-                 'port': 2, 'segment': 'switch1', 'ipv4': '2106::1', 'mac': '00:00:00:00:00:00', 'id': 'foo4', 'behavior': 1},
-             {'active': 1, 'source': 'poseidon', 'role': 'unknown', 'state': 'unknown', 'ipv4_os': 'unknown', 'tenant': 'vlan1', 'port': 1, 'segment': 'switch1', 'ipv4': '::', 'mac': '00:00:00:00:00:00', 'id': 'foo5', 'behavior': 1}]
+    hosts = [{'active': 0, 'source': 'poseidon', 'tenant': 'vlan1', 'port': 1, 'segment': 'switch1', 'ipv4': '123.123.123.123', 'mac': '00:00:00:00:00:00', 'id': 'foo1'},
+             {'active': 1, 'source': 'poseidon', 'tenant': 'vlan1',
+                 'port': 1, 'segment': 'switch1', 'ipv4': '123.123.123.123', 'mac': '00:00:00:00:00:01', 'id': 'foo2'},
+             {'active': 0, 'source': 'poseidon', 'tenant': 'vlan1',
+                 'port': 1, 'segment': 'switch1', 'ipv4': '123.123.123.123', 'mac': '00:00:00:00:00:02', 'id': 'foo3'},
+             {'active': 1, 'source': 'poseidon1', 'tenant': 'vlan1',
+                 'port': 2, 'segment': 'switch1', 'ipv4': '2106::1', 'mac': '00:00:00:00:00:03', 'id': 'foo4'},
+             {'active': 1, 'tenant': 'vlan1', 'port': 1, 'segment': 'switch1', 'ipv4': '::', 'mac': '00:00:00:00:00:04', 'id': 'foo5'}]
+    endpoints = {}
+    for host in hosts:
+        endpoint = endpoint_factory(host.pop('id'))
+        endpoint.endpoint_data = host
+        endpoints[endpoint.name] = endpoint
+    endpoints['foo2'].state = 'known'
+    endpoints['foo2'].metadata = {
+        'mac_addresses': {'00:00:00:00:00:01': {
+            '1': {'labels': ['Developer workstation'], 'behavior': 'normal'},
+            '2': {'labels': ['Printer'], 'behavior': 'abnormal'}}},
+        'ipv4_addresses': {'123.123.123.123': {'os': 'Linux'}}}
+
+    registry = CollectorRegistry()
+    p = Prometheus()
+    p.register_endpoint_collector(endpoints.values, registry=registry)
+    assert registry.get_sample_value('poseidon_endpoint_active') == 3
+    assert registry.get_sample_value('poseidon_endpoint_inactive') == 2
+    assert registry.get_sample_value('poseidon_endpoint_roles', {
+        'source': 'poseidon', 'role': 'Printer'}) == 1
+    assert registry.get_sample_value('poseidon_endpoint_roles', {
+        'source': 'poseidon', 'role': NO_DATA}) == 0
+    assert registry.get_sample_value('poseidon_endpoint_oses', {
+        'source': 'poseidon', 'ipv4_os': 'Linux'}) == 1
+    assert registry.get_sample_value('poseidon_endpoint_current_states', {
+        'source': 'poseidon', 'current_state': 'unknown'}) == 0
+    assert registry.get_sample_value('poseidon_endpoint_current_states', {
+        'source': 'Poseidon', 'current_state': 'known'}) == 0
+    assert registry.get_sample_value('poseidon_endpoint_sources', {
+        'source': NO_DATA}) == 1
+    assert registry.get_sample_value('poseidon_endpoint_port_hosts', {
+        'port': '1'}) == 2
+    assert registry.get_sample_value('poseidon_endpoint_port_tenants', {
+        'port': '2', 'tenant': 'vlan1'}) == 1
+    assert registry.get_sample_value('poseidon_endpoint_behavior', {
+        'ipv4': '123.123.123.123', 'mac': '00:00:00:00:00:01', 'tenant': 'vlan1',
+        'segment': 'switch1', 'port': '1', 'role': 'Printer', 'ipv4_os': 'Linux',
+        'source': 'poseidon'}) == 1
+    assert registry.get_sample_value('poseidon_endpoint_ip_table', {
+        'mac': '00:00:00:00:00:03', 'tenant': 'vlan1', 'segment': 'switch1',
+        'port': '2', 'role': NO_DATA, 'ipv4_os': NO_DATA, 'hash_id': 'foo4',
+        'source': 'poseidon1'}) == ip2int('2106::1')
+
+    # series for endpoints that have gone away are not reported.
+    del endpoints['foo4']
+    assert registry.get_sample_value('poseidon_endpoint_active') == 2
+    assert registry.get_sample_value('poseidon_endpoint_port_tenants', {
+        'port': '2', 'tenant': 'vlan1'}) is None
+    assert registry.get_sample_value('poseidon_endpoint_ip_table', {
+        'mac': '00:00:00:00:00:03', 'tenant': 'vlan1', 'segment': 'switch1',
+        'port': '2', 'role': NO_DATA, 'ipv4_os': NO_DATA, 'hash_id': 'foo4',
+        'source': 'poseidon1'}) is None
+
+
+def test_endpoint_series_limit():
+    endpoints = {}
+    for i in range(4):
+        endpoint = endpoint_factory('foo{0}'.format(i))
+        endpoint.endpoint_data = {
+            'active': 1, 'tenant': 'vlan1', 'port': i, 'segment': 'switch1',
+            'ipv4': '10.0.0.{0}'.format(i), 'mac': '00:00:00:00:00:0{0}'.format(i)}
+        endpoints[endpoint.name] = endpoint
+    endpoints['foo3'].metadata = {
+        'mac_addresses': {'00:00:00:00:00:03': {'1': {'behavior': 'abnormal'}}}}
+
+    registry = CollectorRegistry()
     p = Prometheus()
-    p.update_metrics(hosts)
+    collector = p.register_endpoint_collector(
+        endpoints.values, series_limit=2, registry=registry)
+    assert registry.get_sample_value('poseidon_endpoint_series') == 4
+    assert registry.get_sample_value('poseidon_endpoint_series_omitted') == 2
+    assert registry.get_sample_value('poseidon_endpoint_active') == 4
+    reported = sorted(
+        sample.labels['hash_id'] for metric in registry.collect()
+        if metric.name == 'poseidon_endpoint_ip_table' for sample in metric.samples)
+    assert reported == ['foo0', 'foo3']
+
+    collector.aggregate_only = True
+    assert registry.get_sample_value('poseidon_endpoint_series') == 0
+    assert registry.get_sample_value('poseidon_endpoint_series_omitted') == 4
+    assert registry.get_sample_value('poseidon_endpoint_port_hosts', {'port': '3'}) == 1
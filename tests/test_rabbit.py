@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for rabbit.py
+"""
+import asyncio
+import queue
+from types import SimpleNamespace
+
+import pika
+
+from poseidon.helpers.rabbit import AsyncRabbitConsumer
+from poseidon.helpers.rabbit import Rabbit
+from poseidon.helpers.rabbit import RabbitConsumer
+from poseidon.helpers.rabbit import RabbitPublisher
+
+
+class MockChannel:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+        self.transactional = False
+        self.pending = []
+
+    def exchange_declare(self, exchange, exchange_type):
+        pass
+
+    def tx_select(self):
+        self.transactional = True
+
+    def tx_commit(self):
+        self.connection.published.extend(self.pending)
+        MockConnection.commits += 1
+        self.pending = []
+
+    def basic_publish(self, exchange, routing_key, body):
+        if MockConnection.fail_after is not None:
+            if MockConnection.fail_after == 0:
+                MockConnection.fail_after = None
+                self.connection.is_open = False
+                raise pika.exceptions.StreamLostError('lost')
+            MockConnection.fail_after -= 1
+        self.pending.append((routing_key, body))
+
+
+class MockConnection:
+
+    connections = []
+    published = []
+    commits = 0
+    fail_after = None
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.is_open = True
+        MockConnection.connections.append(self)
+
+    def channel(self):
+        return MockChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+
+def test_publisher():
+    MockConnection.commits = 0
+    publisher = RabbitPublisher('localhost', connection_cl=MockConnection)
+    assert publisher.publish('poseidon.action.ignore', '["foo"]')
+    assert publisher.publish('poseidon.action.remove', '["foo"]')
+    assert len(MockConnection.connections) == 1
+    assert publisher.channel.transactional
+    assert MockConnection.commits == 2
+
+    # a batch is committed once.
+    messages = [('poseidon.action.change', str(i)) for i in range(5)]
+    assert publisher.publish_batch(messages) == 5
+    assert MockConnection.commits == 3
+    assert MockConnection.published[2:] == messages
+
+    # a batch that fails part way through is discarded, and published again.
+    del MockConnection.published[:]
+    MockConnection.fail_after = 2
+    assert publisher.publish_batch(messages) == 5
+    assert len(MockConnection.connections) == 2
+    assert MockConnection.published == messages
+    assert MockConnection.commits == 4
+
+    publisher.close()
+    assert publisher.publish('poseidon.action.reload', '')
+    assert len(MockConnection.connections) == 3
+
+    publisher = RabbitPublisher('localhost', retries=0, connection_cl=MockConnection)
+    MockConnection.fail_after = 0
+    assert not publisher.publish('poseidon.action.reload', '')
+
+
+def test_ack_messages():
+
+    class MockBlockingConnection:
+
+        def add_callback_threadsafe(self, callback):
+            callback()
+
+    class MockBlockingChannel:
+
+        connection = MockBlockingConnection()
+        is_open = True
+        acked = []
+        qos = None
+
+        def basic_ack(self, delivery_tag, multiple):
+            self.acked.append((delivery_tag, multiple))
+
+        def basic_qos(self, prefetch_count):
+            self.qos = prefetch_count
+
+        def basic_consume(self, queue, callback):
+            pass
+
+        def start_consuming(self):
+            pass
+
+    channel = MockBlockingChannel()
+    rabbit = Rabbit()
+    rabbit.start_channel(
+        channel, print, 'poseidon_main', None, prefetch_count=10).join()
+    assert channel.qos == 10
+    rabbit.ack_messages(channel, 5)
+    assert channel.acked == [(5, True)]
+
+
+class MockIOLoop:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.timers = []
+        self.stopped = False
+
+    def start(self):
+        self.connection.open()
+
+    def stop(self):
+        self.stopped = True
+
+    def call_later(self, delay, callback):
+        self.timers.append((delay, callback))
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+
+class MockAsyncChannel:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+        self.bound = []
+        self.qos = None
+        self.consumer = None
+        self.consumes = 0
+        self.cancelled = []
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def exchange_declare(self, exchange, exchange_type, callback):
+        callback(None)
+
+    def queue_declare(self, queue, callback, passive=False, exclusive=False, durable=False):
+        callback(SimpleNamespace(method=SimpleNamespace(
+            message_count=MockSelectConnection.waiting)))
+
+    def queue_bind(self, queue, exchange, routing_key):
+        self.bound.append((exchange, queue, routing_key))
+
+    def basic_qos(self, prefetch_count):
+        self.qos = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        self.consumer = on_message_callback
+        self.consumes += 1
+        return 'ctag{0}'.format(self.consumes)
+
+    def basic_cancel(self, consumer_tag):
+        self.cancelled.append(consumer_tag)
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.connection.acked.append((delivery_tag, multiple))
+
+
+class MockSelectConnection:
+
+    connections = []
+    failures = 0
+    waiting = 3
+
+    def __init__(self, parameters, on_open_callback, on_open_error_callback,
+                 on_close_callback):
+        self.on_open_callback = on_open_callback
+        self.on_open_error_callback = on_open_error_callback
+        self.on_close_callback = on_close_callback
+        self.ioloop = MockIOLoop(self)
+        self.is_open = False
+        self.is_closing = False
+        self.channels = []
+        self.acked = []
+        MockSelectConnection.connections.append(self)
+
+    def open(self):
+        if MockSelectConnection.failures:
+            MockSelectConnection.failures -= 1
+            self.on_open_error_callback(self, pika.exceptions.AMQPConnectionError())
+            return
+        self.is_open = True
+        self.on_open_callback(self)
+        for channel in self.channels:
+            channel.consumer(channel, SimpleNamespace(
+                routing_key='FAUCET.Event', delivery_tag=1), None, b'{}')
+
+    def channel(self, on_open_callback):
+        channel = MockAsyncChannel(self)
+        self.channels.append(channel)
+        on_open_callback(channel)
+
+    def close(self):
+        self.is_open = False
+        self.on_close_callback(self, 'closed')
+
+
+def test_consumer():
+    received = []
+
+    def callback(ch, method, properties, body):
+        received.append((ch, method.delivery_tag))
+        if len(received) == 2:
+            # lag is polled periodically.
+            MockSelectConnection.waiting = 7
+            _, poll = ch.connection.ioloop.timers[0]
+            poll()
+            consumer.stop()
+
+    MockSelectConnection.failures = 2
+    consumer = RabbitConsumer(
+        'localhost', 5672, callback, prefetch_count=10, backoff=0.001,
+        max_backoff=0.002, connection_cl=MockSelectConnection)
+    consumer.add_binding('topic-poseidon-internal', 'poseidon_main',
+                         ['poseidon.algos.#', 'poseidon.action.#'])
+    consumer.add_binding('topic-recs', 'poseidon_main', 'FAUCET.Event.#')
+    consumer.run()
+
+    # two failed attempts, backing off, then both bindings on one connection.
+    assert consumer.reconnects == 2
+    assert len(MockSelectConnection.connections) == 3
+    connection = MockSelectConnection.connections[-1]
+    assert consumer.delay == consumer.backoff
+    assert len(connection.channels) == 2
+    internal, faucet = connection.channels
+    assert internal.bound == [
+        ('topic-poseidon-internal', 'poseidon_main', 'poseidon.algos.#'),
+        ('topic-poseidon-internal', 'poseidon_main', 'poseidon.action.#')]
+    assert faucet.bound == [('topic-recs', 'poseidon_main', 'FAUCET.Event.#')]
+    assert internal.qos == 10
+    assert [ch for ch, _ in received] == [internal, faucet]
+    assert consumer.lag == {
+        ('topic-poseidon-internal', 'poseidon_main'): 7,
+        ('topic-recs', 'poseidon_main'): 7}
+    assert connection.ioloop.stopped
+    assert not connection.is_open
+
+    # acks go through the IO loop, and are dropped once the channel is gone.
+    Rabbit().ack_messages(faucet, 1)
+    faucet.is_open = False
+    Rabbit().ack_messages(faucet, 2)
+    assert connection.acked == [(1, True)]
+
+
+def test_consumer_full_queue():
+    messages = queue.Queue(maxsize=1)
+
+    def callback(ch, method, properties, body):
+        messages.put_nowait(method.delivery_tag)
+
+    def deliver(delivery_tag):
+        channel.consumer(channel, SimpleNamespace(
+            routing_key='FAUCET.Event', delivery_tag=delivery_tag), None, b'{}')
+
+    consumer = RabbitConsumer(
+        'localhost', 5672, callback, lag_interval=0,
+        connection_cl=MockSelectConnection)
+    consumer.add_binding('topic-recs', 'poseidon_main', 'FAUCET.Event.#')
+    connection = MockSelectConnection(
+        None, consumer._on_connection_open, consumer._on_connection_error,
+        consumer._on_connection_closed)
+    MockSelectConnection.failures = 0
+    consumer.connection = connection
+    connection.open()
+    channel = connection.channels[0]
+    assert messages.queue[0] == 1
+
+    # no room, so the message is held and consuming stops.
+    deliver(2)
+    assert channel.cancelled == ['ctag1']
+    assert [method.delivery_tag for _, method, _, _ in consumer.held] == [2]
+    # a message already on its way is held behind it.
+    deliver(3)
+    assert len(consumer.held) == 2
+    _, retry = connection.ioloop.timers.pop()
+    retry()
+    assert len(consumer.held) == 2
+
+    # held messages are handed over in order as room is made.
+    assert messages.get_nowait() == 1
+    _, retry = connection.ioloop.timers.pop()
+    retry()
+    assert messages.get_nowait() == 2
+    assert channel.consumes == 1
+    _, retry = connection.ioloop.timers.pop()
+    retry()
+    assert messages.get_nowait() == 3
+    assert not consumer.held
+    assert not connection.ioloop.timers
+    assert channel.consumes == 2
+    assert consumer.consumer_tags == {('topic-recs', 'poseidon_main'): 'ctag2'}
+
+
+class MockAsyncioConnection(MockSelectConnection):
+
+    def __init__(self, parameters, on_open_callback, on_open_error_callback,
+                 on_close_callback, custom_ioloop):
+        super().__init__(parameters, on_open_callback, on_open_error_callback,
+                         on_close_callback)
+        self.ioloop = custom_ioloop
+        self.is_closed = False
+        custom_ioloop.call_soon(self.open)
+
+    def close(self):
+        self.is_open = False
+        self.is_closed = True
+        self.ioloop.call_soon(self.on_close_callback, self, 'closed')
+
+
+def test_async_consumer():
+    received = []
+
+    def callback(ch, method, properties, body):
+        received.append((ch, method.delivery_tag))
+        # acks from another thread are handed to the event loop.
+        Rabbit().ack_messages(ch, method.delivery_tag)
+
+    async def consume():
+        consumer = AsyncRabbitConsumer(
+            'localhost', 5672, callback, backoff=0.001, max_backoff=0.002,
+            lag_interval=0, connection_cl=MockAsyncioConnection)
+        consumer.add_binding('topic-recs', 'poseidon_main', 'FAUCET.Event.#')
+        task = consumer.start()
+        while not received:
+            await asyncio.sleep(0.01)
+        connection = consumer.connection
+        await asyncio.sleep(0.01)
+        consumer.stop()
+        await asyncio.wait_for(task, 5)
+        return consumer, connection
+
+    MockSelectConnection.connections = []
+    MockSelectConnection.failures = 1
+    MockSelectConnection.waiting = 2
+    consumer, connection = asyncio.run(consume())
+    assert consumer.reconnects == 1
+    assert len(MockSelectConnection.connections) == 2
+    assert consumer.lag == {('topic-recs', 'poseidon_main'): 2}
+    assert connection.acked == [(1, True)]
+    assert consumer.connection is None
@@ -71,6 +71,7 @@ def test_update_networkml(redis_my, redis_my_proc):
         'mac_addresses': {source_mac: {timestamp: {'labels': ['role1', 'role2', 'role3'], 'confidences': [0.9, 0.8, 0.7], 'behavior': 'normal', 'pcap_labels': 'null'}}},
         'ipv4_addresses': {ipv4: {'os': 'Linux'}}, 'ipv6_addresses': {'1212::1': {}}}
     assert endpoint.metadata == correlated_metadata
+    assert endpoint.changed_fields == {'role', 'behavior', 'os'}
     bad_pof_results = {
         ipv4: {"full_os": "", "short_os": "", "link": "", "raw_mtu": "", "mac": source_mac}}
     prc.store_p0f_result(bad_pof_results)
@@ -111,3 +112,120 @@ def test_parse_networkml_metadata():
         'notmyhash': b'{"pcap_labels": "mylabels", "classification": {"labels": ["foo", "bar"], "confidences": [1.0, 2.0]}, "decisions": {"behavior": "definitely"}}',
     }
     assert prc.parse_networkml_metadata(mac_info, ml_info) == {}
+
+
+def test_store_endpoints_dirty(redis_my, redis_my_proc):
+    logger = logging.getLogger('test')
+    logger.setLevel(logging.DEBUG)
+    prc = PoseidonRedisClient(logger, host='localhost', port=redis_my_proc.port)
+    prc.connect()
+    prc.r.flushall()
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1', 'ipv4': '0.0.0.0', 'ipv6': '1212::1'}
+    endpoints = {endpoint.name: endpoint}
+    assert prc.store_endpoints(endpoints) == (1, 0)
+    assert endpoint.metadata['mac_addresses'] == {}
+    # stored again, with the metadata of the MAC indexed by the first store.
+    assert prc.store_endpoints(endpoints) == (1, 0)
+    assert '00:00:00:00:00:00' in endpoint.metadata['mac_addresses']
+    assert prc.store_endpoints(endpoints) == (0, 1)
+    endpoint.queue()
+    assert prc.store_endpoints(endpoints) == (1, 0)
+    endpoint.endpoint_data['active'] = 0
+    assert prc.store_endpoints(endpoints) == (1, 0)
+    endpoint.acl_data.append((('foo', 'bar', 'baz'), 1))
+    assert prc.store_endpoints(endpoints) == (1, 0)
+    # an entry replaced in place, without changing the length.
+    endpoint.acl_data[0] = (('foo', 'bar', 'qux'), 2)
+    assert prc.store_endpoints(endpoints) == (1, 0)
+    endpoint.ignore = True
+    assert prc.store_endpoints(endpoints) == (1, 0)
+    endpoint.mark_dirty()
+    assert prc.store_endpoints(endpoints) == (1, 0)
+    assert prc.store_counts == {'written': 8, 'skipped': 1}
+    stored_endpoints = prc.get_stored_endpoints()
+    stored_endpoint = stored_endpoints[endpoint.name]
+    assert stored_endpoint.state == 'queued'
+    assert stored_endpoint.ignore
+    assert not stored_endpoint.is_dirty()
+    assert prc.store_endpoints(stored_endpoints) == (0, 1)
+    # removing an endpoint rewrites the stored list.
+    prc.store_endpoints({})
+    assert prc.get_stored_endpoints() == {}
+
+
+def test_store_endpoints_chunked(redis_my, redis_my_proc):
+    logger = logging.getLogger('test')
+    prc = PoseidonRedisClient(
+        logger, host='localhost', port=redis_my_proc.port, pipeline_chunk_size=2)
+    prc.connect()
+    prc.r.flushall()
+    endpoints = {}
+    for i in range(5):
+        endpoint = endpoint_factory('foo%u' % i)
+        endpoint.endpoint_data = {
+            'tenant': 'foo', 'mac': '00:00:00:00:00:0%u' % i, 'segment': 'foo', 'port': '1', 'ipv4': '10.0.0.%u' % i, 'ipv6': ''}
+        endpoints[endpoint.name] = endpoint
+    assert prc.store_endpoints(endpoints) == (5, 0)
+    assert len(prc.flush_times) == 1
+    assert len(prc.r.smembers('mac_addresses')) == 5
+    assert len(prc.r.smembers('ip_addresses')) == 5
+    assert prc.r.hgetall('10.0.0.3') == {b'poseidon_hash': b'foo3'}
+    assert set(prc.get_stored_endpoints().keys()) == set(endpoints.keys())
+
+
+def test_migrate_hash_macs(redis_my, redis_my_proc):
+    logger = logging.getLogger('test')
+    prc = PoseidonRedisClient(logger, host='localhost', port=redis_my_proc.port)
+    prc.connect()
+    prc.r.flushall()
+    for mac, poseidon_hash in (
+            ('00:00:00:00:00:01', 'foo'),
+            ('00:00:00:00:00:02', 'foo'),
+            ('00:00:00:00:00:03', 'bar')):
+        prc.r.sadd('mac_addresses', mac)
+        prc.r.hset(mac, mapping={'poseidon_hash': poseidon_hash})
+    assert prc.migrate_hash_macs()
+    assert not prc.migrate_hash_macs()
+    assert prc.r.smembers(prc.hash_macs_key('foo')) == {b'00:00:00:00:00:01', b'00:00:00:00:00:02'}
+    assert prc.r.smembers(prc.hash_macs_key('bar')) == {b'00:00:00:00:00:03'}
+    mac_addresses, _, _ = prc.get_stored_metadata('foo')
+    assert set(mac_addresses.keys()) == {'00:00:00:00:00:01', '00:00:00:00:00:02'}
+    # a MAC that moved to another hash is no longer reported for the old one.
+    prc.r.hset('00:00:00:00:00:02', mapping={'poseidon_hash': 'bar'})
+    mac_addresses, _, _ = prc.get_stored_metadata('foo')
+    assert set(mac_addresses.keys()) == {'00:00:00:00:00:01'}
+
+
+def test_migrate_codec(redis_my, redis_my_proc):
+    logger = logging.getLogger('test')
+    prc = PoseidonRedisClient(logger, host='localhost', port=redis_my_proc.port)
+    prc.connect()
+    prc.r.flushall()
+    endpoint = endpoint_factory('foo')
+    endpoint.endpoint_data = {
+        'tenant': 'foo', 'mac': '00:00:00:00:00:00', 'segment': 'foo', 'port': '1', 'ipv4': '0.0.0.0', 'ipv6': ''}
+    # values as stored by older versions.
+    prc.r.set('p_endpoints', str([endpoint.encode()]))
+    prc.r.hset('foo', mapping={
+        'state': 'unknown', 'ignore': 'False',
+        'endpoint_data': str(endpoint.endpoint_data),
+        'prev_states': str([('unknown', 1551805502)])})
+    prc.r.hset('00:00:00:00:00:00', mapping={
+        'poseidon_hash': 'foo', 'timestamps': str([1551805502.0])})
+    prc.r.sadd('mac_addresses', '00:00:00:00:00:00')
+    prc.r.hset('networkml_00:00:00:00:00:00_1551805502.0', mapping={
+        'foo': str({'valid': True, 'classification': {'labels': ['foo'], 'confidences': [1.0]}})})
+    assert prc.get_stored_endpoints()['foo'].endpoint_data == endpoint.endpoint_data
+    assert prc.migrate_codec() == 4
+    assert prc.migrate_codec() == 0
+    assert prc.r.get('p_endpoints').startswith(b'j1:')
+    assert prc.r.hget('foo', 'state') == b'unknown'
+    assert prc.r.hget('foo', 'ignore') == b'False'
+    assert prc.r.hget('foo', 'prev_states') == b'j1:[["unknown",1551805502]]'
+    assert prc.r.hget('00:00:00:00:00:00', 'timestamps') == b'j1:[1551805502.0]'
+    assert prc.get_stored_endpoints()['foo'].endpoint_data == endpoint.endpoint_data
+    prc.migrate_hash_macs()
+    mac_addresses, _, _ = prc.get_stored_metadata('foo')
+    assert mac_addresses['00:00:00:00:00:00']['1551805502.0']['labels'] == ['foo']
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Test module for stages.py
+"""
+import pytest
+
+from poseidon.helpers.stages import NO_TIMING
+from poseidon.helpers.stages import StageTimer
+from poseidon.helpers.stages import timed
+
+
+def test_timed():
+    timer = StageTimer()
+
+    @timed('double', timer=timer)
+    def double(x):
+        return x * 2
+
+    @timed('fail', timer=timer)
+    def fail():
+        raise ValueError('fail')
+
+    assert double(2) == 4
+    with pytest.raises(ValueError):
+        fail()
+    durations, errors = timer.pop()
+    assert len(durations[('double', '')]) == 1
+    assert len(durations[('fail', '')]) == 1
+    assert errors == {('fail', ''): 1}
+    assert timer.pop() == ({}, {})
+
+    timer.enabled = False
+    assert double(3) == 6
+    assert timer.pop() == ({}, {})
+
+
+def test_stage():
+    timer = StageTimer()
+    with timer.stage('format_rabbit_message', 'poseidon.action.ignore'):
+        pass
+    with pytest.raises(KeyError):
+        with timer.stage('format_rabbit_message', 'poseidon.action.ignore'):
+            raise KeyError('fail')
+    durations, errors = timer.pop()
+    assert len(durations[('format_rabbit_message', 'poseidon.action.ignore')]) == 2
+    assert errors == {('format_rabbit_message', 'poseidon.action.ignore'): 1}
+
+    timer.enabled = False
+    assert timer.stage('format_rabbit_message') is NO_TIMING
+    with timer.stage('format_rabbit_message'):
+        pass
+    assert timer.pop() == ({}, {})